@@ -5,8 +5,8 @@ import sys
 import argparse
 import configparser
 
-from Base.activity_store import ActivityStore
 from Base import config as cfg
+from Base.startup import StartupProfile
 
 
 def parse_config():
@@ -33,17 +33,33 @@ def parse_config():
     parser.set_defaults(**defaults)
     parser.add_argument('-d', '--data-dir', help=f'Data directory for Base, where the database is stored. Remember that Base must have read/write access. Default is {cfg.DATA_DIR}', default=cfg.DATA_DIR)
     parser.add_argument('-n', '--no-text', action='store_true', help='Do not store what you type. This will make your database smaller and less sensitive to security breaches. Process name, window titles, window geometry, mouse clicks, number of keys pressed and key timings will still be stored, but not the actual letters. Key timings are stored to enable activity calculation in selfstats.')
+    parser.add_argument('--single-process', action='store_true', help='Read X events and store them in one process. By default a small capture process hands events to a persistence process through shared memory, so database work never delays input.')
+    parser.add_argument('--no-journal', action='store_true', help=f'Write events straight to the database instead of appending them to the crash safe journal in DATA_DIR/{cfg.JOURNAL_DIR} first.')
     parser.add_argument('-r', '--no-repeat', action='store_true', help='Do not store special characters as repeated characters.')
+    parser.add_argument('--hot-days', type=int, default=cfg.HOT_DAYS, help=f'Number of days kept in the SQLite database. Older days are moved to compressed Parquet files in DATA_DIR/{cfg.PARQUET_DIR}, one directory per day. Default is {cfg.HOT_DAYS}')
+    parser.add_argument('--activity-cutoff', type=int, default=cfg.ACTIVITY_CUTOFF, help=f'Seconds after a key press or click that count as active in the activity table. Baseview reads the table for --active and the like when they use the same number of seconds. Default is {cfg.ACTIVITY_CUTOFF}')
+    parser.add_argument('--capture-fps', type=float, default=cfg.CAPTURE_MAX_FPS, help=f'Maximum number of screenshots taken per second. 0 means no limit. Default is {cfg.CAPTURE_MAX_FPS}')
+    parser.add_argument('--capture-queue', type=int, default=cfg.CAPTURE_QUEUE_SIZE, help=f'How many window changes may wait for a screenshot before the backpressure policy kicks in. Default is {cfg.CAPTURE_QUEUE_SIZE}')
+    parser.add_argument('--screenshot-codec', choices=['png', 'webp', 'zstd', 'zlib'], default=cfg.SCREENSHOT_CODEC, help=f'How screenshot keyframes are compressed. Frames in between only store the tiles that changed. Default is {cfg.SCREENSHOT_CODEC}')
+    parser.add_argument('--screenshot-quality', type=int, default=cfg.SCREENSHOT_QUALITY, help=f'Quality of webp screenshots, 100 means lossless. Default is {cfg.SCREENSHOT_QUALITY}')
+    parser.add_argument('--change-threshold', type=float, default=cfg.CHANGE_THRESHOLD, help=f'Share of the screen (0-1) that must have changed since the last stored screenshot before a new one is stored. Default is {cfg.CHANGE_THRESHOLD}')
+    parser.add_argument('--metrics', action='store_true', help=f'Print the counters and durations of the running Base from DATA_DIR/{cfg.METRICS_FILE}, and of its X capture process from DATA_DIR/{cfg.CAPTURE_METRICS_FILE}, and exit. The snapshot is rewritten every {cfg.METRICS_INTERVAL} seconds')
+    parser.add_argument('--startup-profile', action='store_true', help='Print how long the imports and the initialization of the daemon take and exit.')
+    parser.add_argument('--capture-policy', choices=['drop_oldest', 'drop_newest'], default=cfg.CAPTURE_BACKPRESSURE, help=f'What to do with window changes when the screenshot queue is full. Default is {cfg.CAPTURE_BACKPRESSURE}')
 
     return parser.parse_args()
 
 
 def main():
+    profile = StartupProfile()
     try:
         args = vars(parse_config())
     except EnvironmentError as e:
         print(str(e))
         sys.exit(1)
+    if args['startup_profile']:
+        profile.watch_imports()
+    profile.phase('arguments')
 
     args['data_dir'] = os.path.expanduser(args['data_dir'])
 
@@ -52,9 +68,57 @@ def main():
     except OSError:
         pass
 
-    astore = ActivityStore(os.path.join(args['data_dir'], cfg.DBNAME),
-                           store_text=(not args['no_text']),
-                           repeat_char=(not args['no_repeat']))
+    if args['metrics']:
+        from Base import metrics
+        path = metrics.snapshot_path(os.path.join(args['data_dir'], cfg.DBNAME))
+        try:
+            snapshot = metrics.read_snapshot(path)
+        except (OSError, ValueError) as e:
+            print(f'Could not read the metrics at {path}: {e}')
+            sys.exit(1)
+        print(metrics.format_snapshot(snapshot))
+        # the X event loop runs in a process of its own unless --single-process is given
+        path = metrics.snapshot_path(os.path.join(args['data_dir'], cfg.DBNAME), cfg.CAPTURE_METRICS_FILE)
+        if os.path.exists(path):
+            try:
+                snapshot = metrics.read_snapshot(path)
+            except (OSError, ValueError) as e:
+                print(f'Could not read the metrics at {path}: {e}')
+                sys.exit(1)
+            print('\nCapture process')
+            print(metrics.format_snapshot(snapshot))
+        sys.exit(0)
+
+    db_name = os.path.join(args['data_dir'], cfg.DBNAME)
+    options = dict(store_text=(not args['no_text']),
+                   repeat_char=(not args['no_repeat']),
+                   capture_fps=float(args['capture_fps']),
+                   capture_queue=int(args['capture_queue']),
+                   capture_policy=args['capture_policy'],
+                   screenshot_codec=args['screenshot_codec'],
+                   screenshot_quality=int(args['screenshot_quality']),
+                   change_threshold=float(args['change_threshold']),
+                   hot_days=int(args['hot_days']),
+                   activity_cutoff=int(args['activity_cutoff']),
+                   journal=(not args['no_journal']))
+
+    # the heavy modules are only imported once it is clear the daemon runs
+    from Base.activity_store import ActivityStore
+    profile.phase('daemon imports')
+    if args['startup_profile']:
+        import Base.sniff_x
+        profile.phase('X sniffer imports')
+        astore = ActivityStore(db_name, **options)
+        profile.phase('ActivityStore init')
+        astore.dimensions.close()
+        profile.report(file=sys.stdout)
+        sys.exit(0)
+
+    if args['single_process']:
+        astore = ActivityStore(db_name, **options)
+    else:
+        from Base.processes import Supervisor
+        astore = Supervisor(db_name, options)
     try:
         astore.run()
     except KeyboardInterrupt:
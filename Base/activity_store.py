@@ -1,12 +1,19 @@
 import time
 from datetime import datetime
-NOW = datetime.now
 
-
-from Base import sniff_x as sniffer
-
-from Base import models
-from Base.models import Process, Window, Geometry, Click, Keys
+from Base import config as cfg
+from Base import keycodec
+from Base import metrics
+from Base.blobstore import BlobMigration
+from Base.capture import CaptureWorker
+from Base.dimensions import Dimensions
+from Base.journal import RecordEncoder, JournalWriter, JournalIngest, journal_dir, segments
+from Base.materialize import ActivityMaterializer
+from Base.rollups import Rollups
+from Base.scheduler import Scheduler, Housekeeping
+from Base.tiering import ColdTier
+from Base.trajectory import Trajectory
+from Base.writer import BatchWriter
 
 
 SKIP_MODIFIERS = {"", "Shift_L", "Control_L", "Super_L", "Alt_L", "Super_R", "Control_R", "Shift_R", "[65027]"}  # [65027] is AltGr in X for some ungodly reason.
@@ -30,46 +37,145 @@ class KeyPress:
 
 
 class ActivityStore:
-    def __init__(self, db_name, store_text=True, repeat_char=True):
-        self.session_maker = models.initialize(db_name)
+    def __init__(self, db_name, store_text=True, repeat_char=True, capture_fps=cfg.CAPTURE_MAX_FPS,
+                 capture_queue=cfg.CAPTURE_QUEUE_SIZE, capture_policy=cfg.CAPTURE_BACKPRESSURE,
+                 screenshot_codec=cfg.SCREENSHOT_CODEC, screenshot_quality=cfg.SCREENSHOT_QUALITY,
+                 change_threshold=cfg.CHANGE_THRESHOLD, hot_days=cfg.HOT_DAYS, activity_cutoff=cfg.ACTIVITY_CUTOFF, journal=True,
+                 flush_idle=cfg.KEY_FLUSH_IDLE, flush_length=cfg.KEY_FLUSH_LENGTH, flush_age=cfg.KEY_FLUSH_AGE):
+        self.db_name = db_name
+        self.dimensions = Dimensions(db_name)
+        self.use_journal = journal
+        if journal:
+            # the ingest thread decides the transactions, each ends with its checkpoint
+            self.writer = BatchWriter(db_name, batch_size=None, flush_interval=None)
+        else:
+            self.writer = BatchWriter(db_name)
+        self.cold_tier = ColdTier(db_name, keep_days=hot_days)
+        self.rollups = Rollups(db_name)
+        self.activity = ActivityMaterializer(db_name, cutoff=activity_cutoff)
+        self.blob_migration = BlobMigration(db_name)
+        self.recall = None  # created by the first update, numpy is not needed before
+        self.metrics = metrics.SnapshotWriter(metrics.snapshot_path(db_name))
+        self.scheduler = Scheduler()
+        self.housekeeping = Housekeeping()
+        self.capture = CaptureWorker(db_name, self.dimensions, max_fps=capture_fps, queue_size=capture_queue, policy=capture_policy,
+                                     codec=screenshot_codec, quality=screenshot_quality, threshold=change_threshold)
 
         self.store_text = store_text
         self.repeat_char = repeat_char
         self.curtext = ""
 
+        # a key sequence is also stored after an idle gap, at a maximum length and at a maximum age
+        self.flush_idle = flush_idle
+        self.flush_length = flush_length
+        self.flush_age = flush_age
+
         self.key_presses = []
-        self.mouse_path = []
+        metrics.gauge('keys.pending', lambda: len(self.key_presses))
+        self.trajectory = Trajectory()
 
         self.current_window = Display()
 
         self.last_scroll = {button: 0 for button in SCROLL_BUTTONS}
 
-        self.last_key_time = time.time()
-        self.last_commit = time.time()
+        self.event_time = None  # set while events are replayed from the journal
+        self.last_key_time = self.now()
+        self.sequence_start = self.last_key_time  # time of the first queued key press
 
-        self.started = NOW()
+        self.started = self.now_datetime()
         self.last_screen_change = None
 
-    def trycommit(self):
-        self.last_commit = time.time()
-        for _ in range(1000):
-            try:
-                self.session.commit()
-                break
-            except:
-                self.session.rollback()
-
-    def run(self):
-        self.session = self.session_maker()
-
-        self.sniffer = sniffer.Sniffer()
-        self.sniffer.screen_hook = self.got_screen_change
-        self.sniffer.key_hook = self.got_key
-        self.sniffer.mouse_button_hook = self.got_mouse_click
-        self.sniffer.mouse_move_hook = self.got_mouse_move
+    def now(self):
+        """ Epoch seconds of the event being handled, its journal time while ingesting. """
+        return time.time() if self.event_time is None else self.event_time
+
+    def now_datetime(self):
+        return datetime.fromtimestamp(self.now())
+
+    def run(self, source=None):
+        """ Starts the workers and blocks on the event source, the X sniffer unless another
+            object with the same hooks and run()/cancel() is given. With the journal on, the
+            source only appends to the journal and the ingest thread calls the hooks below. """
+        self.writer.start()
+        self.capture.start()
+        self.housekeeping.start()
+        self.schedule()
+        if source is None:
+            from Base.sniff_x import Sniffer  # Xlib is only needed when reading a display
+            source = Sniffer(self.capture)
+        self.sniffer = source
+        self.sniffer.scheduler = self.scheduler
+        if self.use_journal:
+            directory = journal_dir(self.db_name)
+            self.journal = JournalWriter(directory)
+            self.ingest = JournalIngest(self, directory, self.journal)
+            self.ingest.start()
+            encoder = RecordEncoder(self.journal.write)
+            self.sniffer.screen_hook = encoder.focus
+            self.sniffer.key_hook = encoder.key
+            self.sniffer.mouse_button_hook = encoder.button
+            self.sniffer.mouse_move_hook = encoder.motion
+            self.sniffer.records_hook = self.journal.write_batch  # sources with encoded records skip the hooks
+        else:
+            # a journal left by an earlier run goes in first, it would hold back the rollups otherwise
+            directory = journal_dir(self.db_name)
+            if segments(directory):
+                JournalIngest(self, directory).finish()
+            self.sniffer.screen_hook = self.got_screen_change
+            self.sniffer.key_hook = self.got_key
+            self.sniffer.mouse_button_hook = self.got_mouse_click
+            self.sniffer.mouse_move_hook = self.got_mouse_move
 
         self.sniffer.run()
 
+    def schedule(self):
+        """ Sets up the timers run by the event loop. The activity table, rollups, the recall
+            index, the move of old screenshots into the blob store and the rollover are slow,
+            the timers only hand them to the housekeeping thread. All of them run once right
+            at the start in this order, so rows are materialized before they can move to Parquet. """
+        self.scheduler.every(self.activity.interval, lambda: self.housekeeping.submit('activity', self.activity.step),
+                             name='activity', delay=0)
+        self.scheduler.every(self.rollups.interval, lambda: self.housekeeping.submit('rollups', self.rollups.step),
+                             name='rollups', delay=0)
+        self.scheduler.every(cfg.RECALL_INTERVAL, lambda: self.housekeeping.submit('recall', self.update_recall),
+                             name='recall', delay=0)
+        self.scheduler.every(self.blob_migration.interval, lambda: self.housekeeping.submit('blobs', self.blob_migration.step),
+                             name='blobs', delay=0)
+        self.scheduler.every(self.cold_tier.interval, lambda: self.housekeeping.submit('rollover', self.cold_tier.step),
+                             name='rollover', delay=0)
+        if self.metrics.interval > 0:
+            self.scheduler.every(self.metrics.interval, self.metrics.write, name='metrics')
+        if not self.use_journal:
+            # with the journal the keys belong to the ingest thread, which checks them itself
+            self.scheduler.every(cfg.KEY_FLUSH_CHECK, self.flush_due, name='keys')
+
+    def update_recall(self):
+        if self.recall is None:
+            from Base.recall import RecallIndex
+            self.recall = RecallIndex(self.db_name)
+        self.recall.step()
+
+    def state(self):
+        """ What the store buffers between events, for the journal checkpoints. """
+        return {'key_presses': [[press.key, press.time, press.is_repeat] for press in self.key_presses],
+                'last_key_time': self.last_key_time,
+                'sequence_start': self.sequence_start,
+                'started': self.started.isoformat(),
+                'window': [self.current_window.proc_id, self.current_window.win_id, self.current_window.geo_id],
+                'last_screen_change': self.last_screen_change,
+                'last_scroll': self.last_scroll,
+                'trajectory': self.trajectory.state()}
+
+    def restore(self, state):
+        self.key_presses = [KeyPress(*press) for press in state['key_presses']]
+        self.last_key_time = state['last_key_time']
+        self.sequence_start = state.get('sequence_start', self.last_key_time)
+        self.started = datetime.fromisoformat(state['started'])
+        self.current_window.proc_id, self.current_window.win_id, self.current_window.geo_id = state['window']
+        self.last_screen_change = state['last_screen_change']
+        self.last_scroll = {int(button): moment for button, moment in state['last_scroll'].items()}
+        self.trajectory.restore(state['trajectory'])
+
     def got_screen_change(self, process_name, window_name, win_x, win_y, win_width, win_height):
         """Receives a screen change and stores any changes.
         If the process or window has changed it will also store any queued pressed keys.
@@ -88,40 +194,16 @@ class ActivityStore:
 
         self.last_screen_change = args
 
-        cur_process = self.session.query(
-            Process
-        ).filter_by(
-            name=process_name
-        ).scalar()
-        if not cur_process:
-            cur_process = Process(process_name)
-            self.session.add(cur_process)
-
-        cur_geometry = self.session.query(
-            Geometry
-        ).filter_by(
-            xpos=win_x,
-            ypos=win_y,
-            width=win_width,
-            height=win_height
-        ).scalar()
-        if not cur_geometry:
-            cur_geometry = Geometry(win_x, win_y, win_width, win_height)
-            self.session.add(cur_geometry)
-
-        cur_window = self.session.query(Window).filter_by(title=window_name,
-                                                          process_id=cur_process.id).scalar()
-        if not cur_window:
-            cur_window = Window(window_name, cur_process.id)
-            self.session.add(cur_window)
-
-        if not (self.current_window.proc_id == cur_process.id
-                and self.current_window.win_id == cur_window.id):
-            self.trycommit()
+        proc_id = self.dimensions.process_id(process_name)
+        geo_id = self.dimensions.geometry_id(win_x, win_y, win_width, win_height)
+        win_id = self.dimensions.window_id(window_name, proc_id)
+
+        if not (self.current_window.proc_id == proc_id
+                and self.current_window.win_id == win_id):
             self.store_keys()  # happens before as these keypresses belong to the previous window
-            self.current_window.proc_id = cur_process.id
-            self.current_window.win_id = cur_window.id
-            self.current_window.geo_id = cur_geometry.id
+            self.current_window.proc_id = proc_id
+            self.current_window.win_id = win_id
+        self.current_window.geo_id = geo_id
 
     def filter_many(self):
         specials_in_row = 0
@@ -165,20 +247,40 @@ class ActivityStore:
             else:
                 curtext = ''.join(keys)
 
-            self.session.add(Keys(curtext,
-                                  keys,
-                                  timings,
-                                  nrkeys,
-                                  self.started,
-                                  self.current_window.proc_id,
-                                  self.current_window.win_id,
-                                  self.current_window.geo_id))
-
-            self.trycommit()
-
-            self.started = NOW()
+            # keys pressed before the first focus event have no window and are not kept
+            if self.current_window.proc_id is not None:
+                self.writer.put("""
+                    INSERT INTO keys (text, keys, timings, nrkeys, started, process_id, window_id, geometry_id, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (curtext,
+                      keycodec.encode_keys(keys, self.dimensions.key_code),
+                      keycodec.encode_timings(timings),
+                      nrkeys, self.started,
+                      # the timings count back from created_at, so it is the time of the last key
+                      self.current_window.proc_id, self.current_window.win_id, self.current_window.geo_id,
+                      datetime.fromtimestamp(self.last_key_time)))
+
+            self.started = self.now_datetime()
             self.key_presses = []
-            self.last_key_time = time.time()
+            self.last_key_time = self.now()
+
+    def flush_keys(self):
+        """ Stores the queued key-presses while the window stays the same. The next sequence
+            times its first key from the last one, not from the flush. """
+        last_key_time = self.last_key_time
+        self.store_keys()
+        self.last_key_time = last_key_time
+
+    def flush_due(self):
+        """ Stores the queued key-presses after an idle gap or once the sequence is too old.
+            Returns True if it did. """
+        if not self.key_presses:
+            return False
+        now = self.now()
+        if now - self.last_key_time < self.flush_idle and now - self.sequence_start < self.flush_age:
+            return False
+        self.flush_keys()
+        return True
 
     def got_key(self, keycode, state, string, is_repeat):
         """ Receives key-presses and queues them for storage.
@@ -188,7 +290,7 @@ class ActivityStore:
                   specifier, i.e: SHIFT or SHIFT_L/SHIFT_R, ALT, CTRL
             string is the string representation of the key press
             repeat is True if the current key is a repeat sent by the keyboard """
-        now = time.time()
+        now = self.now()
 
         if string in SKIP_MODIFIERS:
             return
@@ -198,20 +300,24 @@ class ActivityStore:
         elif len(string) > 1:
             string = f'<[{string}]>'
 
+        self.flush_due()
+        if not self.key_presses:
+            self.sequence_start = now
         self.key_presses.append(KeyPress(string, now - self.last_key_time, is_repeat))
         self.last_key_time = now
+        if len(self.key_presses) >= self.flush_length:
+            self.flush_keys()
 
     def store_click(self, button, x, y):
-        """ Stores incoming mouse-clicks """
-        self.session.add(Click(button,
-                               True,
-                               x, y,
-                               len(self.mouse_path),
-                               self.current_window.proc_id,
-                               self.current_window.win_id,
-                               self.current_window.geo_id))
-        self.mouse_path = []
-        self.trycommit()
+        """ Stores incoming mouse-clicks together with the simplified path that led there """
+        self.trajectory.finish(x, y)
+        if self.current_window.proc_id is not None:  # like keys, a click before the first focus event is not kept
+            self.writer.put("""
+                INSERT INTO click (button, press, x, y, nrmoves, path, process_id, window_id, geometry_id, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (button, True, x, y, self.trajectory.moves, self.trajectory.to_blob(),
+                  self.current_window.proc_id, self.current_window.win_id, self.current_window.geo_id, self.now_datetime()))
+        self.trajectory.reset()
 
     def got_mouse_click(self, button, x, y):
         """ Receives mouse clicks and sends them for storage.
@@ -219,20 +325,30 @@ class ActivityStore:
             x,y are the coordinates of the keypress
             press is True if it pressed down, False if released"""
         if button in [4, 5, 6, 7]:
-            if time.time() - self.last_scroll[button] < SCROLL_COOLOFF:
+            if self.now() - self.last_scroll[button] < SCROLL_COOLOFF:
                 return
-            self.last_scroll[button] = time.time()
+            self.last_scroll[button] = self.now()
 
         self.store_click(button, x, y)
 
     def got_mouse_move(self, x, y):
         """ Queues mouse movements.
             x,y are the new coorinates on moving the mouse"""
-        self.mouse_path.append([x, y])
+        self.trajectory.add(x, y)
 
     def close(self):
         """ stops the sniffer and stores the latest keys. To be used on shutdown of program"""
         self.sniffer.cancel()
-        self.store_keys()
+        self.capture.cancel()
+        self.housekeeping.cancel()
+        if self.use_journal:
+            self.ingest.cancel()
+            self.journal.close()
+            self.ingest.finish()
+        else:
+            self.store_keys()
+        self.writer.close()
+        self.dimensions.close()
+        self.metrics.write()
 
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+""" Ingest benchmark for the Base daemon that needs no X display.
+
+A synthetic or recorded stream of focus, key, motion and click events is fed through
+the same ActivityStore hooks the X sniffer calls, into a fresh database in a temporary
+directory. Reports events/sec, per-event hook latency, commit latency and database
+size per hour of simulated activity. """
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+from array import array
+
+from Base import config as cfg
+from Base.activity_store import ActivityStore
+from Base.scheduler import Scheduler
+
+# event kind -> ActivityStore hook
+HOOKS = {'focus': 'screen_hook',
+         'key': 'key_hook',
+         'click': 'mouse_button_hook',
+         'move': 'mouse_move_hook'}
+
+LETTERS = 'etaoinshrdlucmfwypvbgkjqxz     '
+SPECIAL = ['Return', 'BackSpace', 'Tab', 'Left', 'Right', 'Up', 'Down']
+
+
+def generate_events(count, seed=0, windows=50, processes=8):
+    """ A reproducible session of count events as (gap seconds, kind, args) tuples.
+        Typing comes in bursts with short gaps, mouse paths end in clicks and the focus
+        moves between a fixed set of windows now and then. """
+    rng = random.Random(seed)
+    titles = [(f'process{rng.randrange(processes)}', f'Window title {i} - {rng.getrandbits(32):08x}',
+               rng.randrange(0, 1920), rng.randrange(0, 1080), rng.randrange(200, 1920), rng.randrange(200, 1080))
+              for i in range(windows)]
+    events = [(0.0, 'focus', list(titles[0]))]
+    x, y = 960, 540
+    while len(events) < count:
+        action = rng.random()
+        if action < 0.01:
+            events.append((rng.uniform(0.5, 5), 'focus', list(rng.choice(titles))))
+        elif action < 0.6:
+            for _ in range(rng.randrange(1, 40)):
+                if rng.random() < 0.05:
+                    string, state = rng.choice(SPECIAL), []
+                elif rng.random() < 0.03:
+                    string, state = rng.choice(LETTERS.strip()), ['Control']
+                else:
+                    string, state = rng.choice(LETTERS), []
+                events.append((rng.expovariate(1 / 0.15), 'key', [rng.randrange(8, 255), state, string, False]))
+        else:
+            for _ in range(rng.randrange(5, 80)):
+                x = min(32767, max(0, x + rng.randrange(-25, 26)))
+                y = min(32767, max(0, y + rng.randrange(-25, 26)))
+                events.append((0.01, 'move', [x, y]))
+            events.append((rng.uniform(0.05, 1), 'click', [rng.choice([1, 1, 1, 3, 4, 5]), x, y]))
+    return events[:count]
+
+
+def load_events(path):
+    """ Reads a recording, one JSON [gap, kind, args] list per line. """
+    with open(path) as f:
+        return [tuple(json.loads(line)) for line in f if line.strip()]
+
+
+def save_events(path, events):
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class SyntheticSource:
+    """ Stands in for sniff_x.Sniffer: calls the hooks for a list of events.
+        rate is in events per second, 0 replays as fast as the hooks allow. The wall time
+        of every hook call is kept for the latency report. """
+
+    def __init__(self, events, rate=0):
+        self.events = events
+        self.rate = rate
+        self.screen_hook = lambda *args: True
+        self.key_hook = lambda *args: True
+        self.mouse_button_hook = lambda *args: True
+        self.mouse_move_hook = lambda *args: True
+        self.latencies = array('d')
+        self.scheduler = Scheduler()
+        self.running = False
+
+    def run(self):
+        self.running = True
+        hooks = {kind: getattr(self, hook) for kind, hook in HOOKS.items()}
+        clock = time.perf_counter
+        start = clock()
+        for i, (_, kind, args) in enumerate(self.events):
+            if not self.running:
+                break
+            if self.rate:
+                delay = start + i / self.rate - clock()
+                if delay > 0:
+                    time.sleep(delay)
+            before = clock()
+            hooks[kind](*args)
+            self.latencies.append(clock() - before)
+            self.scheduler.run_due()
+        self.elapsed = clock() - start
+
+    def cancel(self):
+        self.running = False
+
+
+def database_bytes(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def run_benchmark(events, rate=0, store_text=True, journal=True):
+    """ Replays events into a new database in a temporary directory and returns the measurements. """
+    with tempfile.TemporaryDirectory(prefix='base-bench-') as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)  # the database lives in ./data
+        try:
+            store = ActivityStore(cfg.DBNAME, store_text=store_text, journal=journal)
+            source = SyntheticSource(events, rate)
+            store.run(source)
+            store.close()
+            size = database_bytes(os.path.join('data', cfg.DBNAME))
+        finally:
+            os.chdir(cwd)
+
+    simulated = sum(event[0] for event in events)
+    latencies = list(source.latencies)
+    commits = list(store.writer.latencies)
+    return {'events': len(latencies),
+            'seconds': source.elapsed,
+            'events_per_second': len(latencies) / source.elapsed if source.elapsed else 0.0,
+            'event_p50_us': percentile(latencies, 0.5) * 1e6,
+            'event_p99_us': percentile(latencies, 0.99) * 1e6,
+            'commits': store.writer.commits,
+            'rows': store.writer.rows,
+            'commit_p50_ms': percentile(commits, 0.5) * 1e3,
+            'commit_p99_ms': percentile(commits, 0.99) * 1e3,
+            'db_bytes': size,
+            'simulated_hours': simulated / 3600,
+            'db_bytes_per_hour': size / (simulated / 3600) if simulated else 0.0}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-e', '--events', type=int, default=100000, help='Number of generated events. Default is 100000')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated session. Default is 0')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second to replay at. 0 means as fast as possible, which is the default')
+    parser.add_argument('--replay', metavar='FILE', help='Replay a recorded event stream instead of generating one')
+    parser.add_argument('--save', metavar='FILE', help='Save the event stream, e.g. to replay the same session later')
+    parser.add_argument('-n', '--no-text', action='store_true', help='Benchmark with text storage disabled, like Base --no-text')
+    parser.add_argument('--no-journal', action='store_true', help='Benchmark writing straight to the database, like Base --no-journal')
+    parser.add_argument('--json', action='store_true', help='Print the results as one JSON object')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    events = load_events(args.replay) if args.replay else generate_events(args.events, args.seed)
+    if args.save:
+        save_events(args.save, events)
+
+    results = run_benchmark(events, args.rate, store_text=not args.no_text, journal=not args.no_journal)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
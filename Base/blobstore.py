@@ -0,0 +1,182 @@
+import os
+import sys
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+
+from Base import config as cfg
+from Base import metrics
+from Base import models
+
+DIGEST_SIZE = 20  # bytes of blake2b, the name of a blob
+SUFFIX = '.blobs'
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def blob_dir(sqlite_file):
+    """ The segments live in a directory next to the database. """
+    return os.path.join(os.path.dirname(sqlite_file), cfg.BLOB_DIR)
+
+
+def database_file(conn):
+    """ The file of the main database of a connection. """
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def digest_of(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+class BlobStore:
+    """ Content-addressed storage for screenshot payloads outside of SQLite.
+        Blobs are appended to segment files of about segment_size bytes and named by the
+        hash of their content, so a blob that is stored twice takes the space once. The
+        blob table in the database maps a name to its segment, position and length, and
+        the rows that use a blob only keep its name. A blob is fsynced before its index
+        row is committed, so the index never points past what is on disk; a crash in
+        between leaves unreferenced bytes at the end of a segment, nothing worse.
+        get() returns a memoryview into a read-only mmap of the segment instead of a copy.
+        One store per database and process, see get_blob_store(), which serializes the
+        appends of every thread. """
+
+    def __init__(self, sqlite_file, segment_size=cfg.BLOB_SEGMENT_SIZE):
+        self.directory = blob_dir(sqlite_file)
+        self.segment_size = segment_size
+        self.conn = sqlite3.connect(sqlite_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.file = None
+        self.segment = None
+        self.size = 0
+        self.maps = {}
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'{segment:08d}{SUFFIX}')
+
+    def segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SUFFIX))
+
+    def open_segment(self):
+        """ Continues the last segment, or starts the next one once it is full. """
+        if self.file is not None:
+            self.file.close()
+            segment = self.segment + 1
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            segment = max(self.segments(), default=0)
+        self.file = open(self.segment_path(segment), 'ab')
+        self.segment = segment
+        self.size = self.file.seek(0, os.SEEK_END)
+        if self.size >= self.segment_size:
+            self.open_segment()
+
+    def locate(self, digest):
+        return self.conn.execute("SELECT segment, position, length FROM blob WHERE digest = ?",
+                                 (digest,)).fetchone()
+
+    def put(self, data):
+        """ Stores data unless a blob with the same content exists. Returns its digest. """
+        started = time.perf_counter()
+        digest = digest_of(data)
+        with self.lock:
+            if self.locate(digest) is not None:
+                metrics.count('blobs.deduplicated')
+                return digest
+            if self.file is None or self.size >= self.segment_size:
+                self.open_segment()
+            position = self.size
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(data)
+            self.conn.execute("INSERT OR IGNORE INTO blob (digest, segment, position, length) VALUES (?, ?, ?, ?)",
+                              (digest, self.segment, position, len(data)))
+            self.conn.commit()
+        metrics.count('blobs.stored')
+        metrics.count('blobs.bytes', len(data))
+        metrics.observe('blobs.put', time.perf_counter() - started)
+        return digest
+
+    def view(self, segment, end):
+        """ A memoryview of the segment that reaches at least to end. A segment that grew
+            since it was mapped is mapped again; the old map stays valid for the views that
+            still use it and goes away with the last of them. """
+        view = self.maps.get(segment)
+        if view is None or len(view) < end:
+            with open(self.segment_path(segment), 'rb') as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self.maps[segment] = view
+        return view
+
+    def get(self, digest):
+        """ The content of a blob as a read-only memoryview, None if there is none with that digest. """
+        with self.lock:
+            location = self.locate(digest)
+            if location is None:
+                return None
+            segment, position, length = location
+            if length == 0:
+                return memoryview(b'')
+            return self.view(segment, position + length)[position:position + length]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.maps.clear()
+            self.conn.close()
+
+
+def get_blob_store(sqlite_file):
+    """ Returns the blob store of the database, creating it on first use in this process. """
+    key = os.path.abspath(sqlite_file)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = BlobStore(sqlite_file)
+        return _stores[key]
+
+
+class BlobMigration:
+    """ Moves screenshots stored inline by older versions into the blob store, batch_size
+        rows per step() on the housekeeping thread, so the database gives their pages to
+        other tables. Stops looking once none are left. The database file keeps its size
+        until it is vacuumed. """
+
+    def __init__(self, db_name, batch_size=cfg.BLOB_MIGRATE_BATCH, interval=cfg.BLOB_MIGRATE_INTERVAL):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.last_id = 0
+        self.done = False
+
+    def move(self, conn, blobs):
+        rows = conn.execute("""
+            SELECT id, image FROM screenshot
+            WHERE id > ? AND digest IS NULL AND length(image) > 0
+            ORDER BY id LIMIT ?
+        """, (self.last_id, self.batch_size)).fetchall()
+        for screenshot_id, image in rows:
+            # older databases declare image NOT NULL, so a moved image leaves an empty blob behind
+            conn.execute("UPDATE screenshot SET digest = ?, image = x'' WHERE id = ?", (blobs.put(image), screenshot_id))
+            self.last_id = screenshot_id
+        conn.commit()
+        metrics.count('blobs.migrated', len(rows))
+        return len(rows)
+
+    def step(self):
+        if self.done:
+            return
+        conn = models.initialize(self.db_name)
+        try:
+            if self.move(conn, get_blob_store(models.database_path(self.db_name))) < self.batch_size:
+                self.done = True
+        except sqlite3.Error as e:
+            print(f'Could not move screenshots into the blob store: {e}', file=sys.stderr)
+        finally:
+            conn.close()
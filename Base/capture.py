@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+
+from Base import config as cfg
+from Base import metrics
+from Base import models
+from Base.changes import ChangeDetector
+from Base.frames import FrameEncoder, FrameStore
+
+DROP_OLDEST = 'drop_oldest'  # keep the newest context, forget stale ones
+DROP_NEWEST = 'drop_newest'  # keep what is queued, ignore new notifications
+BACKPRESSURE_POLICIES = {DROP_OLDEST, DROP_NEWEST}
+
+
+class CaptureRequest:
+    def __init__(self, process_name, window_name, geometry):
+        self.process_name = process_name
+        self.window_name = window_name
+        self.geometry = geometry
+        self.time = time.time()
+
+
+class CaptureWorker:
+    """ Grabs, diffs and stores screenshots on a thread of its own.
+        The X event loop only calls notify() when the focused window or its geometry
+        changes, which never blocks. Frames are taken at most max_fps times per second,
+        and the current window is recaptured every idle_interval seconds so content
+        changes without a focus change are still seen. Requests that queue up while the
+        worker waits for its next frame are stale by then, only the newest is captured. """
+
+    def __init__(self, db_name, dimensions, max_fps=cfg.CAPTURE_MAX_FPS, queue_size=cfg.CAPTURE_QUEUE_SIZE,
+                 policy=cfg.CAPTURE_BACKPRESSURE, idle_interval=cfg.CAPTURE_IDLE_INTERVAL,
+                 codec=cfg.SCREENSHOT_CODEC, quality=cfg.SCREENSHOT_QUALITY, threshold=cfg.CHANGE_THRESHOLD):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f'Unknown backpressure policy {policy}, use one of {sorted(BACKPRESSURE_POLICIES)}')
+        self.db_name = db_name
+        self.dimensions = dimensions
+        self.min_interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.idle_interval = idle_interval
+        self.policy = policy
+        self.encoder = FrameEncoder(codec=codec, quality=quality)
+        self.detector = ChangeDetector(threshold=threshold)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        metrics.gauge('capture.queue', self.queue.qsize)
+        self.dropped = 0
+        self.captured = 0
+        self.stored = 0
+
+        self.current = None
+        self.last_capture = 0.0
+
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name='capture', daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def notify(self, process_name, window_name, geometry):
+        """ Tells the worker that focus or geometry changed. Called from the event loop. """
+        request = CaptureRequest(process_name, window_name, geometry)
+        try:
+            self.queue.put_nowait(request)
+            return
+        except queue.Full:
+            pass
+
+        self.dropped += 1
+        metrics.count('capture.dropped')
+        if self.policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(request)
+            except queue.Full:
+                pass
+
+    def next_request(self):
+        timeout = self.idle_interval if self.current is not None else None
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return self.current  # nothing new, recapture the current window
+
+    def newest(self, request):
+        """ The last request queued after request, or None if the worker is cancelled. The
+            screen shows the window focused last, so the ones before it are skipped. """
+        while True:
+            try:
+                newer = self.queue.get_nowait()
+            except queue.Empty:
+                return request
+            if newer is None:
+                return None
+            metrics.count('capture.stale')
+            request = newer
+
+    def run(self):
+        self.conn = models.initialize(self.db_name)
+        self.frames = FrameStore(self.conn, self.encoder)
+        while self.running:
+            request = self.next_request()
+            if request is None:
+                break
+
+            wait = self.last_capture + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            request = self.newest(request)
+            if request is None:
+                break
+            self.current = request
+            self.last_capture = time.time()
+
+            self.capture(request)
+        self.conn.close()
+
+    def capture(self, request):
+        from PIL import ImageGrab  # loaded by the first capture, not at startup
+
+        started = time.perf_counter()
+        screenshot = ImageGrab.grab()
+        self.captured += 1
+        grabbed = time.perf_counter()
+        metrics.observe('capture.grab', grabbed - started)
+
+        changes = self.detector.detect(screenshot)
+        metrics.observe('capture.detect', time.perf_counter() - grabbed)
+        if not self.detector.should_persist(changes):
+            metrics.count('capture.unchanged')
+            return
+        self.detector.accept()
+
+        geo = request.geometry
+        process_id = self.dimensions.process_id(request.process_name)
+        window_id = self.dimensions.window_id(request.window_name, process_id)
+        geometry_id = self.dimensions.geometry_id(geo.xpos, geo.ypos, geo.width, geo.height)
+        self.frames.store(process_id, window_id, geometry_id, screenshot)
+        self.stored += 1
+        metrics.count('capture.stored')
+
+    def cancel(self):
+        """ Stops the worker after the frame it is working on. """
+        self.running = False
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+        if self.thread.is_alive():
+            self.thread.join()
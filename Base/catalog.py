@@ -0,0 +1,152 @@
+import os
+import datetime
+import threading
+
+import duckdb
+
+from Base import models
+from Base.tiering import TIERED_TABLES, parquet_root, partition_files
+
+COPY_BATCH = 10000  # cold rows copied into SQLite per executemany
+
+HOT_TABLES = ['process', 'window', 'geometry', 'keycode', 'screenshot']
+TIME_COLUMNS = dict(TIERED_TABLES)
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+class Catalog:
+    """ A DuckDB connection with one view per logical table over both storage tiers.
+        keys, click and activity union the SQLite hot tier with every Parquet partition,
+        and both sides carry a `date` column, so a time range given through
+        time_filter() is pushed into the SQLite scan and prunes Parquet partitions by
+        directory. The extension is loaded and the database attached once per process,
+        and every thread gets its own cursor on the shared connection. """
+
+    def __init__(self, db_name, root=None):
+        self.sqlite_file = models.database_path(db_name)
+        self.root = root or parquet_root(db_name)
+        self.con = duckdb.connect()
+        self.con.execute("INSTALL sqlite;")
+        self.con.execute("LOAD sqlite;")
+        self.con.execute(f"ATTACH DATABASE '{self.sqlite_file}' AS sqlite (TYPE sqlite, READ_ONLY);")
+        self.local = threading.local()
+        self.refresh()
+
+    def refresh(self):
+        """ (Re)creates the views, call it when the first partition of a table appears. """
+        for table in HOT_TABLES:
+            # quoted, window is a keyword in DuckDB
+            self.con.execute(f'CREATE OR REPLACE VIEW "{table}" AS SELECT * FROM sqlite."{table}"')
+        for table, column in TIERED_TABLES:
+            hot = f"SELECT *, CAST({column} AS DATE) AS date FROM sqlite.{table}"
+            if partition_files(self.root, table):
+                pattern = os.path.join(self.root, table, '*', '*.parquet')
+                cold = f"SELECT * FROM read_parquet('{pattern}', hive_partitioning = true)"
+                self.con.execute(f"CREATE OR REPLACE VIEW {table} AS {hot} UNION ALL BY NAME {cold}")
+            else:
+                self.con.execute(f"CREATE OR REPLACE VIEW {table} AS {hot}")
+
+    def cold_rows(self, table, start=None, end=None):
+        """ A cursor over the Parquet rows of table in [start, end), without the date column. """
+        pattern = os.path.join(self.root, table, '*', '*.parquet')
+        where, params = self.time_filter(table, start, end)
+        return self.execute(f"""
+            SELECT * EXCLUDE (date) FROM read_parquet('{pattern}', hive_partitioning = true) AS {table}
+            WHERE {where}
+        """, params)
+
+    def cursor(self):
+        if getattr(self.local, 'cursor', None) is None:
+            self.local.cursor = self.con.cursor()
+        return self.local.cursor
+
+    def execute(self, sql, params=None):
+        return self.cursor().execute(sql, params or [])
+
+    def time_filter(self, table, start=None, end=None, alias=None):
+        """ Returns a WHERE clause and its parameters that limit table to [start, end). """
+        column = TIME_COLUMNS[table]
+        prefix = f'{alias or table}.'
+        clauses = []
+        params = []
+        if start is not None:
+            clauses.append(f'{prefix}{column} >= ? AND {prefix}date >= CAST(? AS DATE)')
+            params += [start, start]
+        if end is not None:
+            clauses.append(f'{prefix}{column} < ? AND {prefix}date <= CAST(? AS DATE)')
+            params += [end, end]
+        return ' AND '.join(clauses) or 'TRUE', params
+
+    def close(self):
+        self.con.close()
+
+
+def merge_ranges(ranges):
+    """ Joins the [start, end) ranges that overlap or touch, so that no row is read twice.
+        None stands for an open side. """
+    merged = []
+    for start, end in sorted(ranges, key=lambda r: r[0] or datetime.datetime.min):
+        if merged and (merged[-1][1] is None or (start or datetime.datetime.min) <= merged[-1][1]):
+            last_start, last_end = merged[-1]
+            merged[-1] = (last_start, None if last_end is None or end is None else max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def attach_cold(conn, db_name, tables, ranges):
+    """ Makes the Parquet rows of tables that fall in any of the [start, end) ranges
+        readable through the SQLite connection conn, for readers that only know SQLite. The
+        rows are copied into temp.cold_<table>, and the view temp.tiers_<table> unions them
+        with the hot table. Returns {table: view} for the tables that had cold rows. """
+    catalog = get_catalog(db_name)
+    views = {}
+    for table in tables:
+        if not partition_files(catalog.root, table):
+            continue
+        conn.execute(f"DROP VIEW IF EXISTS temp.tiers_{table}")
+        conn.execute(f"DROP TABLE IF EXISTS temp.cold_{table}")
+        conn.execute(f"CREATE TEMP TABLE cold_{table} AS SELECT * FROM main.{table} WHERE 0")
+        hot = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+        copied = 0
+        for start, end in merge_ranges(ranges):
+            cursor = catalog.cold_rows(table, start, end)
+            # a part written before a column was added lacks it
+            columns = [column[0] for column in cursor.description if column[0] in hot]
+            insert = f"INSERT INTO temp.cold_{table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            indexes = [i for i, column in enumerate(cursor.description) if column[0] in hot]
+            while True:
+                rows = cursor.fetchmany(COPY_BATCH)
+                if not rows:
+                    break
+                conn.executemany(insert, [[row[i] for i in indexes] for row in rows])
+                copied += len(rows)
+        if not copied:
+            conn.execute(f"DROP TABLE temp.cold_{table}")
+            continue
+        conn.execute(f"CREATE INDEX temp.cold_{table}_id ON cold_{table} (id)")
+        conn.execute(f"CREATE TEMP VIEW tiers_{table} AS SELECT * FROM main.{table} UNION ALL SELECT * FROM temp.cold_{table}")
+        views[table] = f'temp.tiers_{table}'
+    conn.commit()
+    return views
+
+
+def get_catalog(db_name, root=None):
+    """ Returns the catalog for db_name, creating it on first use in this process. """
+    key = (models.database_path(db_name), root)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = Catalog(db_name, root)
+        return _catalogs[key]
+
+
+def refresh_catalogs(db_name):
+    """ Rebuilds the views of the catalogs of db_name in this process, a rollover may have
+        written the first partition of a table. """
+    sqlite_file = models.database_path(db_name)
+    with _catalogs_lock:
+        catalogs = [catalog for (path, _), catalog in _catalogs.items() if path == sqlite_file]
+    for catalog in catalogs:
+        catalog.refresh()
@@ -0,0 +1,87 @@
+import hashlib
+
+from Base import config as cfg
+
+
+class ChangeSet:
+    def __init__(self, regions, changed_fraction):
+        self.regions = regions  # (x1, y1, x2, y2) boxes in screen coordinates
+        self.changed_fraction = changed_fraction
+
+    def __bool__(self):
+        return bool(self.regions)
+
+    def __repr__(self):
+        return f"<ChangeSet {len(self.regions)} regions, {self.changed_fraction:.2%}>"
+
+
+class ChangeDetector:
+    """ Finds which parts of the screen changed since the last stored frame.
+        Frames are shrunk by `downsample` in C before hashing. Each band of tiles is hashed
+        as a whole, and only bands that differ are split in tiles with a digest each.
+        Changes are measured against the last accepted frame, so small edits add up until
+        they pass the threshold, while a blinking cursor or a ticking clock never does. """
+
+    def __init__(self, downsample=cfg.CHANGE_DOWNSAMPLE, tile_size=cfg.CHANGE_TILE_SIZE,
+                 threshold=cfg.CHANGE_THRESHOLD):
+        self.downsample = downsample
+        self.tile_size = tile_size
+        self.threshold = threshold
+
+        self.size = None
+        self.digests = None
+        self.pending = None
+
+    def detect(self, image):
+        small = image.reduce(self.downsample) if self.downsample > 1 else image
+        small = small.convert('RGB')
+        width, height = small.size
+        data = small.tobytes()
+        stride = width * 3
+        size = self.tile_size
+
+        # a band is one row of tiles, only bands whose bytes changed are split in tiles
+        baseline = self.digests if self.size == image.size else None
+        bands = []
+        digests = []
+        regions = []
+        changed_area = 0
+        for band_nr, y in enumerate(range(0, height, size)):
+            y2 = min(y + size, height)
+            band = data[y * stride:y2 * stride]
+            band_digest = hashlib.blake2b(band, digest_size=8).digest()
+            bands.append(band_digest)
+            if baseline is not None and baseline[0][band_nr] == band_digest:
+                digests.append(baseline[1][band_nr])
+                continue
+
+            rows = [band[r * stride:(r + 1) * stride] for r in range(y2 - y)]
+            tiles = [hashlib.blake2b(b''.join(row[x * 3:min(x + size, width) * 3] for row in rows),
+                                     digest_size=8).digest()
+                     for x in range(0, width, size)]
+            digests.append(tiles)
+            if baseline is None:
+                continue
+            for tile_nr, (d1, d2) in enumerate(zip(tiles, baseline[1][band_nr])):
+                if d1 != d2:
+                    x = tile_nr * size
+                    x2 = min(x + size, width)
+                    regions.append(self.scale_box(x, y, x2, y2, image))
+                    changed_area += (x2 - x) * (y2 - y)
+
+        self.pending = (image.size, (bands, digests))
+        if baseline is None:
+            return ChangeSet([(0, 0, image.width, image.height)], 1.0)
+        return ChangeSet(regions, changed_area / float(width * height))
+
+    def scale_box(self, x1, y1, x2, y2, image):
+        scale = self.downsample
+        return (x1 * scale, y1 * scale, min(x2 * scale, image.width), min(y2 * scale, image.height))
+
+    def should_persist(self, changes):
+        return changes.changed_fraction > 0 and changes.changed_fraction >= self.threshold
+
+    def accept(self):
+        """ Makes the frame last given to detect() the baseline for the next comparison. """
+        if self.pending is not None:
+            self.size, self.digests = self.pending
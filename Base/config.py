@@ -2,3 +2,80 @@ DATA_DIR = '~/source'
 DBNAME = 'source.sqlite'
 LOCK_FILE = 'selfspy.pid'
 LOCK = None
+
+CAPTURE_MAX_FPS = 1.0  # upper bound on screenshots per second
+CAPTURE_QUEUE_SIZE = 8
+CAPTURE_BACKPRESSURE = 'drop_oldest'
+CAPTURE_IDLE_INTERVAL = 10.0  # seconds between recaptures of an unchanged window
+
+SCREENSHOT_CODEC = 'png'  # png, webp, zstd or zlib
+SCREENSHOT_QUALITY = 80  # only used by webp, 100 means lossless
+SCREENSHOT_KEYFRAME_INTERVAL = 30  # deltas between two keyframes
+SCREENSHOT_TILE_SIZE = 64
+
+CHANGE_DOWNSAMPLE = 4  # screenshots are shrunk this much before change detection
+CHANGE_TILE_SIZE = 16  # in downsampled pixels
+CHANGE_THRESHOLD = 0.005  # share of the screen that must change before a frame is stored
+
+WRITE_BATCH_SIZE = 500  # rows per transaction
+WRITE_FLUSH_INTERVAL = 2.0  # seconds a queued row may wait before it is committed
+WRITE_MAX_QUEUED = 100000
+WRITE_RETRIES = 8
+WRITE_BACKOFF = 0.05  # seconds, doubled for every retry
+WRITE_MAX_BACKOFF = 2.0
+
+DIMENSION_CACHE_SIZE = 10000  # process, window and geometry ids kept in memory, per table
+
+TRAJECTORY_CAPACITY = 1024  # simplified mouse path points kept between two clicks
+TRAJECTORY_MIN_DISTANCE = 8  # pixels
+TRAJECTORY_MIN_ANGLE = 0.2  # radians the path must turn before a point is kept
+
+PARQUET_DIR = 'parquet'  # cold tier, next to the database
+HOT_DAYS = 14  # days of events kept in SQLite before they move to Parquet
+ROLLOVER_INTERVAL = 3600  # seconds between checks for closed days
+COMPACT_MIN_SIZE = 16 * 1024 * 1024  # Parquet parts smaller than this get merged
+
+ROLLUP_ACTIVE_CUTOFF = 180  # seconds after an event counted as active in the rollups, Baseview's default
+ROLLUP_LAG = 3600  # seconds an hour must be over before it is rolled up
+ROLLUP_INTERVAL = 300  # seconds between rollup updates
+
+ACTIVITY_CUTOFF = 180  # seconds after an event counted as active in the activity table, Baseview's default
+ACTIVITY_LAG = 900  # seconds before events are materialized, longer than a key sequence may wait to be stored
+ACTIVITY_INTERVAL = 60  # seconds between activity table updates
+
+KEY_FLUSH_IDLE = 30  # seconds without a key press after which the queued keys are stored
+KEY_FLUSH_LENGTH = 2000  # key presses in one keys row at most
+KEY_FLUSH_AGE = 600  # seconds a key sequence may span before it is stored
+KEY_FLUSH_CHECK = 1.0  # seconds between idle and age checks
+
+METRICS_FILE = 'metrics.json'  # runtime metrics snapshot, next to the database
+CAPTURE_METRICS_FILE = 'metrics-capture.json'  # snapshot of the X capture process when persistence runs in a child
+METRICS_INTERVAL = 10  # seconds between snapshots, 0 turns them off
+
+RECALL_DIR = 'recall'  # vectors of the semantic index, next to the database
+RECALL_EMBEDDER = 'hashing'  # or any embedder class as module:Class
+RECALL_DIMENSIONS = 256
+RECALL_SESSION_GAP = 300  # seconds without typing in a window that end a chunk
+RECALL_CHUNK_LENGTH = 4000  # characters in one chunk at most
+RECALL_SNIPPET_LENGTH = 120  # characters of a chunk shown with a hit
+RECALL_BATCH = 5000  # keys rows indexed per transaction
+RECALL_INTERVAL = 300  # seconds between index updates
+RECALL_IVF_MIN = 4096  # chunks before they are clustered into lists, all are scored below
+RECALL_NPROBE = 8  # lists scored per query
+RECALL_TOP = 10
+
+BLOB_DIR = 'blobs'  # screenshot segments, next to the database
+BLOB_SEGMENT_SIZE = 256 * 1024 * 1024
+BLOB_MIGRATE_BATCH = 100  # inline screenshots of older versions moved into the blob store per run
+BLOB_MIGRATE_INTERVAL = 60  # seconds between two runs until none are left
+
+JOURNAL_DIR = 'journal'  # raw event segments, next to the database
+JOURNAL_SEGMENT_SIZE = 16 * 1024 * 1024
+JOURNAL_SYNC_INTERVAL = 1.0  # seconds between fsyncs of the journal, ingest runs right after
+JOURNAL_INGEST_BATCH = 1000  # records per ingest transaction
+
+RING_SLOTS = 65536  # shared memory ring between the capture and the persistence process
+RING_SLOT_SIZE = 64  # bytes, a record takes as many slots as it needs
+RING_READ_BATCH = 1024  # records taken out of the ring at once
+RING_POLL_INTERVAL = 0.005  # seconds the persistence process sleeps when the ring is empty
+RING_RESTART_INTERVAL = 1.0  # seconds between checks that the persistence process is alive
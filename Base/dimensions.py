@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+
+from Base import config as cfg
+from Base import models
+from Base.trigrams import TrigramIndex
+
+
+class LRU:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Dimensions:
+    """ Interns process, window and geometry rows and hands out their ids.
+        Ids are looked up in bounded in-memory LRU maps keyed by name, (title, process_id)
+        and (x, y, width, height). Only a miss goes to the database, where the row is
+        inserted if it is absent and, for names and titles, added to the trigram index.
+        The object is shared between the event loop and the capture worker, so it owns
+        its connection and serializes access with a lock. """
+
+    def __init__(self, db_name, maxsize=cfg.DIMENSION_CACHE_SIZE):
+        self.conn = models.initialize(db_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.processes = LRU(maxsize)
+        self.windows = LRU(maxsize)
+        self.geometries = LRU(maxsize)
+        self.keycodes = {}  # the key vocabulary is small, so it is never evicted
+        self.trigrams = TrigramIndex(self.conn)
+        self.hits = 0
+        self.misses = 0
+        self.warm()
+
+    def warm(self):
+        """ Fills the maps with the most recently created rows. """
+        with self.lock:
+            for cache, sql in ((self.processes, "SELECT id, name FROM process"),
+                               (self.windows, "SELECT id, title, process_id FROM window"),
+                               (self.geometries, "SELECT id, xpos, ypos, width, height FROM geometry")):
+                rows = self.conn.execute(f"{sql} ORDER BY id DESC LIMIT ?", (cache.maxsize,)).fetchall()
+                for row in reversed(rows):
+                    key = row[1] if len(row) == 2 else tuple(row[1:])
+                    cache.put(key, row[0])
+            self.keycodes = {key: code for code, key in self.conn.execute("SELECT id, key FROM keycode")}
+
+    def intern(self, cache, key, select, insert, params, indexed=None):
+        with self.lock:
+            row_id = cache.get(key)
+            if row_id is not None:
+                self.hits += 1
+                return row_id
+
+            self.misses += 1
+            row = self.conn.execute(select, params).fetchone()
+            if row:
+                row_id = row[0]
+            else:
+                with self.conn:
+                    row_id = self.conn.execute(insert, params).lastrowid
+                if indexed:
+                    self.trigrams.update(indexed)
+            cache.put(key, row_id)
+            return row_id
+
+    def process_id(self, name):
+        return self.intern(self.processes, name,
+                           "SELECT id FROM process WHERE name = ?",
+                           "INSERT INTO process (name) VALUES (?)",
+                           (name,), indexed='process')
+
+    def window_id(self, title, process_id):
+        return self.intern(self.windows, (title, process_id),
+                           "SELECT id FROM window WHERE title = ? AND process_id = ?",
+                           "INSERT INTO window (title, process_id) VALUES (?, ?)",
+                           (title, process_id), indexed='window')
+
+    def geometry_id(self, xpos, ypos, width, height):
+        return self.intern(self.geometries, (xpos, ypos, width, height),
+                           "SELECT id FROM geometry WHERE xpos = ? AND ypos = ? AND width = ? AND height = ?",
+                           "INSERT INTO geometry (xpos, ypos, width, height) VALUES (?, ?, ?, ?)",
+                           (xpos, ypos, width, height))
+
+    def key_code(self, key):
+        code = self.keycodes.get(key)
+        if code is not None:
+            return code
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO keycode (key) VALUES (?)", (key,))
+            self.conn.commit()
+            code = self.conn.execute("SELECT id FROM keycode WHERE key = ?", (key,)).fetchone()[0]
+            self.keycodes[key] = code
+            return code
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,245 @@
+import io
+import time
+import struct
+import zlib
+from collections import OrderedDict
+
+from Base import config as cfg
+from Base import metrics
+from Base.blobstore import get_blob_store, database_file
+
+zstandard = False  # imported by zstd() on first use, None if it is not installed
+
+KEYFRAME = 0
+DELTA = 1
+
+IMAGE_CODECS = {'png', 'webp'}
+BYTE_CODECS = {'zstd', 'zlib'}
+CODECS = IMAGE_CODECS | BYTE_CODECS
+
+DELTA_HEADER = struct.Struct('<HI')  # tile size, number of changed tiles
+RAW_HEADER = struct.Struct('<II')  # width, height of a zstd/zlib keyframe
+
+DELTA_KEYFRAME_RATIO = 0.5  # write a new keyframe when more than this share of tiles changed
+
+
+def zstd():
+    global zstandard
+    if zstandard is False:
+        try:
+            import zstandard as module
+        except ImportError:
+            module = None
+        zstandard = module
+    return zstandard
+
+
+def byte_codec():
+    return 'zstd' if zstd() is not None else 'zlib'
+
+
+def compress(codec, data):
+    if codec == 'zstd':
+        return zstd().ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if zstd() is None:
+            raise RuntimeError('This screenshot is zstd compressed, install zstandard to read it.')
+        return zstd().ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def tile_boxes(width, height, tile_size):
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield (x, y, min(x + tile_size, width), min(y + tile_size, height))
+
+
+def changed_tiles(pixels, key, tile_size):
+    """ The numbers of the tiles, in tile_boxes() order, that differ between two frames of
+        the same size given as (height, width * 3) byte arrays, found in one numpy pass. """
+    import numpy as np
+
+    differ = pixels != key
+    rows = np.logical_or.reduceat(differ, np.arange(0, differ.shape[0], tile_size), axis=0)
+    tiles = np.logical_or.reduceat(rows, np.arange(0, differ.shape[1], tile_size * 3), axis=1)
+    return np.flatnonzero(tiles).tolist()
+
+
+class EncodedFrame:
+    def __init__(self, kind, codec, width, height, payload):
+        self.kind = kind
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.payload = payload
+
+
+class FrameEncoder:
+    """ Encodes a stream of screenshots as keyframes and tile deltas.
+        A delta holds the tiles that differ from the last keyframe (not from the previous
+        frame), so any frame is rebuilt from exactly one keyframe and at most one delta.
+        The pixels of the keyframe are kept, every frame is compared with them at once
+        instead of hashing it tile by tile. """
+
+    def __init__(self, codec=cfg.SCREENSHOT_CODEC, quality=cfg.SCREENSHOT_QUALITY,
+                 keyframe_interval=cfg.SCREENSHOT_KEYFRAME_INTERVAL, tile_size=cfg.SCREENSHOT_TILE_SIZE):
+        if codec not in CODECS:
+            raise ValueError(f'Unknown screenshot codec {codec}, use one of {sorted(CODECS)}')
+        if codec == 'zstd' and zstd() is None:
+            codec = 'zlib'
+        self.codec = codec
+        self.quality = quality
+        self.keyframe_interval = keyframe_interval
+        self.tile_size = tile_size
+
+        self.key_size = None
+        self.key_pixels = None
+        self.since_keyframe = 0
+
+    def encode(self, image):
+        import numpy as np  # loaded by the first frame, not at startup
+
+        image = image.convert('RGB')
+        pixels = np.asarray(image).reshape(image.height, -1)
+        if (self.key_pixels is None
+                or self.key_size != image.size
+                or self.since_keyframe >= self.keyframe_interval):
+            return self.encode_keyframe(image, pixels)
+
+        boxes = list(tile_boxes(image.width, image.height, self.tile_size))
+        changed = changed_tiles(pixels, self.key_pixels, self.tile_size)
+        if len(changed) > DELTA_KEYFRAME_RATIO * len(boxes):
+            return self.encode_keyframe(image, pixels)
+
+        self.since_keyframe += 1
+        codec = byte_codec()
+        index = struct.pack(f'<{len(changed)}I', *changed)
+        tiles = (boxes[i] for i in changed)
+        data = compress(codec, b''.join(pixels[y1:y2, x1 * 3:x2 * 3].tobytes() for x1, y1, x2, y2 in tiles))
+        payload = DELTA_HEADER.pack(self.tile_size, len(changed)) + index + data
+        return EncodedFrame(DELTA, codec, image.width, image.height, payload)
+
+    def encode_keyframe(self, image, pixels):
+        self.key_size = image.size
+        self.key_pixels = pixels
+        self.since_keyframe = 0
+        return EncodedFrame(KEYFRAME, self.codec, image.width, image.height,
+                            encode_image(image, self.codec, self.quality))
+
+
+def encode_image(image, codec, quality):
+    if codec in BYTE_CODECS:
+        return RAW_HEADER.pack(image.width, image.height) + compress(codec, image.tobytes())
+    out = io.BytesIO()
+    if codec == 'webp':
+        image.save(out, format='WEBP', quality=quality, lossless=quality >= 100)
+    else:
+        image.save(out, format='PNG', compress_level=6)
+    return out.getvalue()
+
+
+def decode_image(codec, payload):
+    from PIL import Image
+
+    if codec in BYTE_CODECS:
+        width, height = RAW_HEADER.unpack_from(payload)
+        return Image.frombytes('RGB', (width, height), decompress(codec, payload[RAW_HEADER.size:]))
+    image = Image.open(io.BytesIO(payload))
+    image.load()
+    return image.convert('RGB')
+
+
+def apply_delta(keyframe, codec, payload):
+    from PIL import Image
+
+    tile_size, nrtiles = DELTA_HEADER.unpack_from(payload)
+    offset = DELTA_HEADER.size
+    changed = struct.unpack_from(f'<{nrtiles}I', payload, offset)
+    pixels = decompress(codec, payload[offset + 4 * nrtiles:])
+
+    frame = keyframe.copy()
+    boxes = list(tile_boxes(frame.width, frame.height, tile_size))
+    pos = 0
+    for i in changed:
+        x1, y1, x2, y2 = boxes[i]
+        size = (x2 - x1) * (y2 - y1) * 3
+        frame.paste(Image.frombytes('RGB', (x2 - x1, y2 - y1), pixels[pos:pos + size]), (x1, y1))
+        pos += size
+    return frame
+
+
+class FrameStore:
+    """ Writes screenshots through a FrameEncoder and rebuilds any stored frame again.
+        The encoded frames go to the blob store of the database, the screenshot table only
+        holds their digest. Recently used keyframes are kept decoded, so reading a run
+        of frames costs one keyframe decode plus one small delta each. """
+
+    def __init__(self, conn, encoder=None, cache_size=4, blobs=None):
+        self.conn = conn
+        self.encoder = encoder or FrameEncoder()
+        self.blobs = blobs or get_blob_store(database_file(conn))
+        self.keyframe_id = None
+        self.keyframes = OrderedDict()
+        self.cache_size = cache_size
+
+    def store(self, process_id, window_id, geometry_id, image):
+        started = time.perf_counter()
+        frame = self.encoder.encode(image)
+        encoded = time.perf_counter()
+        metrics.observe('capture.encode', encoded - started)
+        digest = self.blobs.put(frame.payload)
+        cursor = self.conn.execute("""
+            INSERT INTO screenshot (process_id, window_id, geometry_id, image, digest, kind, keyframe_id, codec, width, height)
+            VALUES (?, ?, ?, x'', ?, ?, ?, ?, ?, ?)
+        """, (process_id, window_id, geometry_id, digest, frame.kind,
+              self.keyframe_id if frame.kind == DELTA else None,
+              frame.codec, frame.width, frame.height))
+        self.conn.commit()
+        if frame.kind == KEYFRAME:
+            self.keyframe_id = cursor.lastrowid
+        metrics.observe('capture.store', time.perf_counter() - encoded)
+        return cursor.lastrowid
+
+    def load_keyframe(self, screenshot_id):
+        if screenshot_id in self.keyframes:
+            self.keyframes.move_to_end(screenshot_id)
+            return self.keyframes[screenshot_id]
+        codec, image, digest = self.conn.execute("SELECT codec, image, digest FROM screenshot WHERE id = ?",
+                                                 (screenshot_id,)).fetchone()
+        frame = decode_image(codec, self.payload(image, digest))
+        self.keyframes[screenshot_id] = frame
+        if len(self.keyframes) > self.cache_size:
+            self.keyframes.popitem(last=False)
+        return frame
+
+    def load(self, screenshot_id):
+        """ Returns the screenshot with the given id as a PIL image, or None if it does not exist. """
+        from PIL import Image
+
+        row = self.conn.execute("SELECT kind, keyframe_id, codec, width, height, image, digest FROM screenshot WHERE id = ?",
+                                (screenshot_id,)).fetchone()
+        if row is None:
+            return None
+        kind, keyframe_id, codec, width, height, image, digest = row
+        if codec is None:  # raw RGB frames written before screenshots were encoded
+            return Image.frombytes('RGB', (width, height), self.payload(image, digest)) if width else None
+        if kind == DELTA:
+            return apply_delta(self.load_keyframe(keyframe_id), codec, self.payload(image, digest))
+        return self.load_keyframe(screenshot_id).copy()
+
+    def payload(self, image, digest):
+        """ The stored bytes of a frame, a view of the blob store or the inline image of older rows. """
+        if digest is None:
+            return image
+        payload = self.blobs.get(digest)
+        if payload is None:
+            raise LookupError(f'Screenshot blob {digest.hex()} is missing from {self.blobs.directory}')
+        return payload
+
+
+def decode_frame(conn, screenshot_id):
+    return FrameStore(conn).load(screenshot_id)
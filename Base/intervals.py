@@ -0,0 +1,137 @@
+import numpy as np
+
+EMPTY = np.empty(0)
+
+
+def merge(times, cutoff, maxtime=np.inf, presorted=False):
+    """ Merges event times into active intervals in one sort and sweep.
+        Every event at t makes [t, min(t + cutoff, maxtime)] active, and overlapping or
+        touching intervals are joined. Returns the interval starts and ends as arrays. """
+    times = np.asarray(times, dtype=np.float64)
+    if not len(times):
+        return EMPTY, EMPTY
+    if not presorted:
+        times = np.sort(times, kind='stable')
+    ends = np.minimum(times + cutoff, maxtime)
+    reach = np.maximum.accumulate(ends)
+    first = np.empty(len(times), dtype=bool)
+    first[0] = True
+    first[1:] = times[1:] > reach[:-1]
+    index = np.flatnonzero(first)
+    return times[index], np.maximum.reduceat(ends, index)
+
+
+def union(starts, ends):
+    """ Joins a set of possibly overlapping intervals. """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    if not len(starts):
+        return EMPTY, EMPTY
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+    reach = np.maximum.accumulate(ends)
+    first = np.empty(len(starts), dtype=bool)
+    first[0] = True
+    first[1:] = starts[1:] > reach[:-1]
+    index = np.flatnonzero(first)
+    return starts[index], np.maximum.reduceat(ends, index)
+
+
+def group_merge(keys, times, cutoff, maxtime=np.inf):
+    """ merge() for many groups at once, e.g. one per process or window.
+        Returns the group key, start and end of every interval, sorted by key and start. """
+    keys = np.asarray(keys)
+    times = np.asarray(times, dtype=np.float64)
+    if not len(times):
+        return keys[:0], EMPTY, EMPTY
+    order = np.lexsort((times, keys))
+    keys = keys[order]
+    times = times[order]
+    _, group = np.unique(keys, return_inverse=True)
+
+    # shift every group past the previous one, so a single sweep never joins two groups
+    span = times.max() - times.min() + abs(cutoff) + 1.0
+    shifted = times + group * span
+    ends = np.minimum(times + cutoff, maxtime) + group * span
+    reach = np.maximum.accumulate(ends)
+    first = np.empty(len(times), dtype=bool)
+    first[0] = True
+    first[1:] = shifted[1:] > reach[:-1]
+    index = np.flatnonzero(first)
+    ends = np.maximum.reduceat(ends, index) - group[index] * span
+    return keys[index], times[index], ends
+
+
+def group_union(keys, starts, ends):
+    """ union() for many groups at once. Returns the group key, start and end of every
+        interval, sorted by key and start. """
+    keys = np.asarray(keys)
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    if not len(starts):
+        return keys[:0], EMPTY, EMPTY
+    order = np.lexsort((starts, keys))
+    keys = keys[order]
+    starts = starts[order]
+    ends = ends[order]
+    _, group = np.unique(keys, return_inverse=True)
+
+    span = max(ends.max(), starts.max()) - starts.min() + 1.0
+    reach = np.maximum.accumulate(ends + group * span)
+    first = np.empty(len(starts), dtype=bool)
+    first[0] = True
+    first[1:] = starts[1:] + group[1:] * span > reach[:-1]
+    index = np.flatnonzero(first)
+    return keys[index], starts[index], np.maximum.reduceat(ends, index)
+
+
+class IntervalSet:
+    """ Active intervals built from chunks of event times.
+        Chunks are only collected by extend(); they are merged the first time the
+        intervals are needed, so a long run of small extends costs one sort and one sweep.
+        Presorted chunks are swept right away and joined with the rest as intervals. """
+
+    def __init__(self, cutoff, maxtime=np.inf):
+        self.cutoff = cutoff
+        self.maxtime = maxtime
+        self.chunks = []
+        self.starts = EMPTY
+        self.ends = EMPTY
+
+    def extend(self, times, presorted=False):
+        times = np.asarray(times, dtype=np.float64)
+        if not len(times):
+            return
+        if presorted:
+            starts, ends = merge(times, self.cutoff, self.maxtime, presorted=True)
+            self.starts, self.ends = union(np.concatenate((self.starts, starts)),
+                                           np.concatenate((self.ends, ends)))
+        else:
+            self.chunks.append(times)
+
+    def include(self, starts, ends):
+        """ Adds intervals that were merged already, e.g. rows of the activity table. """
+        if len(starts):
+            self.starts, self.ends = union(np.concatenate((self.starts, starts)), np.concatenate((self.ends, ends)))
+
+    def consolidate(self):
+        if self.chunks:
+            starts, ends = merge(np.concatenate(self.chunks), self.cutoff, self.maxtime)
+            self.chunks = []
+            if len(self.starts):
+                starts, ends = union(np.concatenate((self.starts, starts)), np.concatenate((self.ends, ends)))
+            self.starts, self.ends = starts, ends
+        return self.starts, self.ends
+
+    def total(self):
+        starts, ends = self.consolidate()
+        return float(np.sum(ends - starts))
+
+
+def bucket_overlaps(starts, ends, edges):
+    """ How long each interval overlaps each bucket [edges[k], edges[k + 1]), as an (intervals, buckets) array. """
+    edges = np.asarray(edges, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.float64)[:, None]
+    ends = np.asarray(ends, dtype=np.float64)[:, None]
+    return np.clip(np.minimum(ends, edges[1:]) - np.maximum(starts, edges[:-1]), 0, None)
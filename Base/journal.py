@@ -0,0 +1,327 @@
+import os
+import sys
+import glob
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import datetime
+import threading
+
+from Base import config as cfg
+from Base import metrics
+from Base import models
+
+KEY = 1
+BUTTON = 2
+MOTION = 3
+FOCUS = 4
+
+# payload length, event kind, event time in epoch seconds; the record ends in a crc32 of both
+HEADER = struct.Struct('<IBd')
+CRC = struct.Struct('<I')
+STRING = struct.Struct('<H')
+KEY_FIELDS = struct.Struct('<H?')  # keycode, is_repeat, then modifiers and key name
+BUTTON_FIELDS = struct.Struct('<Bii')  # button, x, y
+MOTION_FIELDS = struct.Struct('<ii')  # x, y
+FOCUS_FIELDS = struct.Struct('<iiii')  # x, y, width, height, then process name and window title
+
+SUFFIX = '.journal'
+
+
+def journal_dir(db_name):
+    return os.path.join(os.path.dirname(models.database_path(db_name)), cfg.JOURNAL_DIR)
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f'{number:012d}{SUFFIX}')
+
+
+def segments(directory):
+    """ The numbers of the segments in directory, oldest first. """
+    return sorted(int(os.path.basename(path)[:-len(SUFFIX)])
+                  for path in glob.glob(os.path.join(directory, f'*{SUFFIX}')))
+
+
+def pack_string(text):
+    data = text.encode('utf8')[:0xffff]
+    return STRING.pack(len(data)) + data
+
+
+def unpack_strings(payload, offset, count):
+    strings = []
+    for _ in range(count):
+        size, = STRING.unpack_from(payload, offset)
+        offset += STRING.size
+        strings.append(payload[offset:offset + size].decode('utf8', 'replace'))
+        offset += size
+    return strings
+
+
+def decode(kind, payload):
+    """ The hook arguments of a record, in the order the sniffer passes them. """
+    if kind == KEY:
+        keycode, is_repeat = KEY_FIELDS.unpack_from(payload)
+        state, string = unpack_strings(payload, KEY_FIELDS.size, 2)
+        return keycode, state.split(' ') if state else [], string, is_repeat
+    if kind == BUTTON:
+        return BUTTON_FIELDS.unpack(payload)
+    if kind == MOTION:
+        return MOTION_FIELDS.unpack(payload)
+    if kind == FOCUS:
+        x, y, width, height = FOCUS_FIELDS.unpack_from(payload)
+        process_name, window_name = unpack_strings(payload, FOCUS_FIELDS.size, 2)
+        return process_name, window_name, x, y, width, height
+    raise ValueError(f'Unknown journal record kind {kind}')
+
+
+def read_records(path, position=0):
+    """ Yields (end position, kind, time, payload) for the complete records from position on.
+        Stops at the first record that is cut short or fails its checksum, which is where a
+        crash or a write still in progress left the segment. """
+    with open(path, 'rb') as f:
+        f.seek(position)
+        data = f.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, kind, moment = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length + CRC.size
+        if end > len(data):
+            break
+        crc, = CRC.unpack_from(data, end - CRC.size)
+        if crc != zlib.crc32(data[offset:end - CRC.size]):
+            break
+        yield position + end, kind, moment, data[offset + HEADER.size:end - CRC.size]
+        offset = end
+
+
+def record_time(path, position):
+    """ The time of the record at position, None if there is no complete record there. """
+    with open(path, 'rb') as f:
+        f.seek(position)
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        length, _, moment = HEADER.unpack(header)
+        rest = f.read(length + CRC.size)
+    if len(rest) < length + CRC.size or CRC.unpack_from(rest, length)[0] != zlib.crc32(header + rest[:length]):
+        return None
+    return moment
+
+
+def ingest_horizon(conn, directory):
+    """ The time of the oldest journal event that is not in the database yet, None if there
+        is none. Rows of later events may still come in, so the rollups and the activity
+        table do not move their watermarks past it. """
+    row = conn.execute("SELECT segment, position FROM journal_state WHERE name = 'ingest'").fetchone()
+    segment, position = row if row else (0, 0)
+    for number in segments(directory):
+        if number < segment:
+            continue
+        moment = record_time(segment_path(directory, number), position if number == segment else 0)
+        if moment is not None:
+            return datetime.datetime.fromtimestamp(moment)
+    return None
+
+
+def record_size(data, offset=0):
+    """ The length of the record starting at offset, from its header. """
+    return HEADER.size + HEADER.unpack_from(data, offset)[0] + CRC.size
+
+
+class RecordEncoder:
+    """ Turns the sniffer hooks into journal records and hands each one to write, a
+        JournalWriter's write() or a RingBuffer's put().
+        Times are wall clock epoch seconds, the monotonic clock stops while the machine is
+        suspended. A record is never stamped earlier than the one before it, so times do
+        not go backwards within one run when the wall clock is set back. Focus events
+        repeating the previous one are skipped, the sniffer reports the focused window for
+        every X event. """
+
+    def __init__(self, write):
+        self.write = write
+        self.last_focus = None
+        self.last_time = 0.0
+
+    def append(self, kind, payload):
+        self.last_time = max(self.last_time, time.time())
+        record = HEADER.pack(len(payload), kind, self.last_time) + payload
+        self.write(record + CRC.pack(zlib.crc32(record)))
+
+    def key(self, keycode, state, string, is_repeat):
+        self.append(KEY, KEY_FIELDS.pack(keycode, is_repeat) + pack_string(' '.join(state)) + pack_string(string))
+
+    def button(self, button, x, y):
+        self.append(BUTTON, BUTTON_FIELDS.pack(button, x, y))
+
+    def motion(self, x, y):
+        self.append(MOTION, MOTION_FIELDS.pack(x, y))
+
+    def focus(self, process_name, window_name, x, y, width, height):
+        args = (process_name, window_name, x, y, width, height)
+        if args == self.last_focus:
+            return
+        self.last_focus = args
+        self.append(FOCUS, FOCUS_FIELDS.pack(x, y, width, height) + pack_string(process_name) + pack_string(window_name))
+
+
+class JournalWriter:
+    """ Appends raw input events to length-prefixed, checksummed segment files.
+        Appending only packs a few fields into a buffered file, so the event loop never waits
+        for the database. sync() flushes and fsyncs the buffer; it runs every sync_interval
+        seconds from the ingest thread. Segments are closed at segment_size bytes and a new
+        writer always starts a new segment, so a torn tail is never appended to. """
+
+    def __init__(self, directory, segment_size=cfg.JOURNAL_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        existing = segments(directory)
+        self.number = existing[-1] if existing else 0
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+        self.rotate()
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.number += 1
+        self.file = open(segment_path(self.directory, self.number), 'ab')
+        self.size = 0
+
+    def write(self, record):
+        """ Appends one encoded record, also used for records encoded in the capture process. """
+        with self.lock:
+            self.file.write(record)
+            self.size += len(record)
+            if self.size >= self.segment_size:
+                self.rotate()
+
+    def write_batch(self, records):
+        """ Appends records and hands them to the OS, after that they outlive this process. """
+        for record in records:
+            self.write(record)
+        with self.lock:
+            self.file.flush()
+
+    def sync(self):
+        started = time.perf_counter()
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        metrics.observe('journal.sync', time.perf_counter() - started)
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+class JournalIngest:
+    """ Replays journal segments into an ActivityStore on a thread of its own.
+        Records go through the store's usual hooks with their journal time, and every batch
+        of records is committed in one transaction together with a checkpoint: the segment,
+        the position after the last record and the store's buffered state (queued key
+        presses, the mouse path, the current window). After a crash ingest restores that
+        state and continues at the checkpoint, so no event is lost or stored twice.
+        Segments before the one being read are deleted once their checkpoint is committed. """
+
+    def __init__(self, store, directory, journal=None, batch_size=cfg.JOURNAL_INGEST_BATCH,
+                 interval=cfg.JOURNAL_SYNC_INTERVAL):
+        self.store = store
+        self.directory = directory
+        self.journal = journal
+        self.batch_size = batch_size
+        self.interval = interval
+        self.hooks = {KEY: store.got_key,
+                      BUTTON: store.got_mouse_click,
+                      MOTION: store.got_mouse_move,
+                      FOCUS: store.got_screen_change}
+
+        conn = models.initialize(store.db_name)
+        row = conn.execute("SELECT segment, position, state FROM journal_state WHERE name = 'ingest'").fetchone()
+        conn.close()
+        self.segment, self.position = (row[0], row[1]) if row else (0, 0)
+        if row and row[2]:
+            store.restore(json.loads(row[2]))
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='ingest', daemon=True)
+
+    def checkpoint(self):
+        """ Queues the checkpoint behind the rows of the batch and waits for their commit.
+            Returns False if it failed, the writer keeps the rows for its next commit. """
+        self.store.writer.put("""
+            INSERT INTO journal_state (name, segment, position, state) VALUES ('ingest', ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET segment = excluded.segment, position = excluded.position, state = excluded.state
+        """, (self.segment, self.position, json.dumps(self.store.state())))
+        return self.store.writer.flush()
+
+    def step(self):
+        """ Ingests up to batch_size records. Returns how many there were. """
+        started = time.perf_counter()
+        done = 0
+        for number in segments(self.directory):
+            if number < self.segment:
+                continue
+            if number > self.segment:
+                self.segment, self.position = number, 0
+            for end, kind, moment, payload in read_records(segment_path(self.directory, number), self.position):
+                self.store.event_time = moment
+                try:
+                    self.hooks[kind](*decode(kind, payload))
+                except (KeyError, ValueError, struct.error, sqlite3.Error) as e:
+                    print(f'Skipping journal record at {number}:{self.position}: {e}', file=sys.stderr)
+                self.position = end
+                done += 1
+                if done >= self.batch_size:
+                    break
+            if done >= self.batch_size:
+                break
+        self.store.event_time = None
+        if done:
+            # until the checkpoint is in the database the journal is the only copy of the batch
+            if self.checkpoint():
+                self.prune()
+            metrics.count('ingest.records', done)
+            metrics.observe('ingest.batch', time.perf_counter() - started)
+        return done
+
+    def prune(self):
+        for number in segments(self.directory):
+            if number >= self.segment:
+                break
+            os.remove(segment_path(self.directory, number))
+
+    def drain(self):
+        while self.step():
+            pass
+
+    def run(self):
+        while True:
+            if self.journal is not None:
+                self.journal.sync()
+            self.drain()
+            if self.store.flush_due():  # an idle gap or an old sequence, with the clock as event time
+                self.checkpoint()
+            if self.stopped.wait(self.interval):
+                break
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def finish(self):
+        """ Ingests the rest of the closed journal and stores the queued keys, on shutdown. """
+        self.drain()
+        self.store.store_keys()
+        self.checkpoint()
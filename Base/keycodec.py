@@ -0,0 +1,121 @@
+import time
+import struct
+
+WIDTHS = {2: 'H', 4: 'I'}  # header byte -> struct format, uint16 or uint32
+NUMPY_WIDTHS = {2: '<u2', 4: '<u4'}
+
+
+def pack(values):
+    """ Packs non-negative integers as a one byte width header followed by uint16 or uint32s. """
+    width = 2 if not values or max(values) < 0x10000 else 4
+    return bytes((width,)) + struct.pack(f'<{len(values)}{WIDTHS[width]}', *values)
+
+
+def unpack(blob):
+    if not blob:
+        return []
+    width = blob[0]
+    return list(struct.unpack(f'<{(len(blob) - 1) // width}{WIDTHS[width]}', blob[1:]))
+
+
+def encode_timings(timings):
+    """ Inter-key intervals in seconds become milliseconds. """
+    return pack([max(0, round(t * 1000)) for t in timings])
+
+
+def decode_timings(blob):
+    return [ms / 1000.0 for ms in unpack(blob)]
+
+
+def count_sql(column):
+    """ An SQL expression for the number of values packed in column, 0 when it is NULL. """
+    return f"COALESCE((length({column}) - 1) / CAST(hex(substr({column}, 1, 1)) AS INTEGER), 0)"
+
+
+def encode_keys(keys, key_code):
+    """ key_code maps a key string to its id in the keycode dictionary table. """
+    return pack([key_code(key) for key in keys])
+
+
+def decode_keys(blob, key_names):
+    return [key_names[code] for code in unpack(blob)]
+
+
+def load_key_names(conn):
+    return dict(conn.execute("SELECT id, key FROM keycode").fetchall())
+
+
+def decode_batch(blobs):
+    """ Decodes a whole batch of packed blobs at once.
+        Returns the concatenated values of all rows as one NumPy array together with the
+        row offsets, so row i is values[offsets[i]:offsets[i + 1]]. """
+    import numpy as np
+
+    counts = np.zeros(len(blobs), dtype=np.int64)
+    widths = np.zeros(len(blobs), dtype=np.int64)
+    for i, blob in enumerate(blobs):
+        if blob:
+            widths[i] = blob[0]
+            counts[i] = (len(blob) - 1) // blob[0]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    values = np.empty(offsets[-1], dtype=np.int64)
+    for width, dtype in NUMPY_WIDTHS.items():
+        rows = np.flatnonzero(widths == width)
+        if not len(rows):
+            continue
+        data = np.frombuffer(b''.join(blobs[i][1:] for i in rows), dtype=dtype)
+        if len(rows) == len(blobs):
+            values[:] = data
+        else:
+            sizes = counts[rows]
+            local = np.arange(len(data)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            values[np.repeat(offsets[rows], sizes) + local] = data
+    return values, offsets
+
+
+def decode_timings_batch(blobs):
+    """ Like decode_batch, but returns the intervals as float seconds. """
+    values, offsets = decode_batch(blobs)
+    return values / 1000.0, offsets
+
+
+def epoch_seconds(timestamps):
+    """ Converts a sequence of local 'YYYY-MM-DD HH:MM:SS[.ffffff]' timestamps to epoch seconds. """
+    import numpy as np
+
+    naive = np.array([str(t) for t in timestamps], dtype='datetime64[us]').astype(np.int64) / 1e6
+    if not len(naive):
+        return naive
+    offsets = {time.localtime(t).tm_gmtoff for t in (naive.min(), naive.max())}
+    if len(offsets) == 1:
+        return naive - offsets.pop()
+    return np.array([time.mktime(time.gmtime(t)) + t % 1 for t in naive])
+
+
+def create_times_batch(created, timings, offsets):
+    """ Vectorized stats.create_times for a batch.
+        created holds the epoch seconds of each row, timings and offsets come from
+        decode_timings_batch. Returns the absolute key times of all rows, each row
+        ascending, with row i at times[offsets[i] + i:offsets[i + 1] + i + 1]. """
+    import numpy as np
+
+    nrows = len(created)
+    counts = np.diff(offsets)
+    # every row gives its created_at followed by created_at minus the running sum of its timings
+    starts = offsets[:-1] + np.arange(nrows)
+    times = np.empty(offsets[-1] + nrows)
+    cums = np.cumsum(timings)
+    row_base = np.concatenate(([0.0], cums))[offsets[:-1]]
+    row_of = np.repeat(np.arange(nrows), counts)
+    position = np.arange(len(timings)) - offsets[:-1][row_of]
+    times[starts] = created
+    times[starts[row_of] + 1 + position] = created[row_of] - (cums - row_base[row_of])
+
+    # reverse each row in place so it is ascending, like create_times does
+    index = np.arange(len(times))
+    row_all = np.repeat(np.arange(nrows), counts + 1)
+    first = starts[row_all]
+    last = first + counts[row_all]
+    return times[first + last - index]
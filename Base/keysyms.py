@@ -0,0 +1,355 @@
+""" Names of the X keysyms, as sniff_x.Sniffer shows keys that are not plain characters.
+    Generated from the keysym groups python-xlib loads by default with generate(), so the
+    daemon does not have to walk dir(Xlib.XK) on every start. """
+
+
+def generate(path=__file__):
+    """ Rewrites this file from Xlib.XK, run it after upgrading python-xlib. """
+    from Xlib import XK
+
+    names = {}
+    for name in dir(XK):
+        if name.startswith('XK_'):
+            names[getattr(XK, name)] = name[3:]
+    with open(path) as f:
+        head = f.read().rsplit('\nKEYSYMS = {', 1)[0]
+    with open(path, 'w') as f:
+        f.write(head + '\nKEYSYMS = {\n')
+        for keysym, name in sorted(names.items()):
+            f.write(f'    {keysym:#06x}: {name!r},\n')
+        f.write('}\n')
+
+
+if __name__ == '__main__':
+    generate()
+
+
+KEYSYMS = {
+    0x0020: 'space',
+    0x0021: 'exclam',
+    0x0022: 'quotedbl',
+    0x0023: 'numbersign',
+    0x0024: 'dollar',
+    0x0025: 'percent',
+    0x0026: 'ampersand',
+    0x0027: 'quoteright',
+    0x0028: 'parenleft',
+    0x0029: 'parenright',
+    0x002a: 'asterisk',
+    0x002b: 'plus',
+    0x002c: 'comma',
+    0x002d: 'minus',
+    0x002e: 'period',
+    0x002f: 'slash',
+    0x0030: '0',
+    0x0031: '1',
+    0x0032: '2',
+    0x0033: '3',
+    0x0034: '4',
+    0x0035: '5',
+    0x0036: '6',
+    0x0037: '7',
+    0x0038: '8',
+    0x0039: '9',
+    0x003a: 'colon',
+    0x003b: 'semicolon',
+    0x003c: 'less',
+    0x003d: 'equal',
+    0x003e: 'greater',
+    0x003f: 'question',
+    0x0040: 'at',
+    0x0041: 'A',
+    0x0042: 'B',
+    0x0043: 'C',
+    0x0044: 'D',
+    0x0045: 'E',
+    0x0046: 'F',
+    0x0047: 'G',
+    0x0048: 'H',
+    0x0049: 'I',
+    0x004a: 'J',
+    0x004b: 'K',
+    0x004c: 'L',
+    0x004d: 'M',
+    0x004e: 'N',
+    0x004f: 'O',
+    0x0050: 'P',
+    0x0051: 'Q',
+    0x0052: 'R',
+    0x0053: 'S',
+    0x0054: 'T',
+    0x0055: 'U',
+    0x0056: 'V',
+    0x0057: 'W',
+    0x0058: 'X',
+    0x0059: 'Y',
+    0x005a: 'Z',
+    0x005b: 'bracketleft',
+    0x005c: 'backslash',
+    0x005d: 'bracketright',
+    0x005e: 'asciicircum',
+    0x005f: 'underscore',
+    0x0060: 'quoteleft',
+    0x0061: 'a',
+    0x0062: 'b',
+    0x0063: 'c',
+    0x0064: 'd',
+    0x0065: 'e',
+    0x0066: 'f',
+    0x0067: 'g',
+    0x0068: 'h',
+    0x0069: 'i',
+    0x006a: 'j',
+    0x006b: 'k',
+    0x006c: 'l',
+    0x006d: 'm',
+    0x006e: 'n',
+    0x006f: 'o',
+    0x0070: 'p',
+    0x0071: 'q',
+    0x0072: 'r',
+    0x0073: 's',
+    0x0074: 't',
+    0x0075: 'u',
+    0x0076: 'v',
+    0x0077: 'w',
+    0x0078: 'x',
+    0x0079: 'y',
+    0x007a: 'z',
+    0x007b: 'braceleft',
+    0x007c: 'bar',
+    0x007d: 'braceright',
+    0x007e: 'asciitilde',
+    0x00a0: 'nobreakspace',
+    0x00a1: 'exclamdown',
+    0x00a2: 'cent',
+    0x00a3: 'sterling',
+    0x00a4: 'currency',
+    0x00a5: 'yen',
+    0x00a6: 'brokenbar',
+    0x00a7: 'section',
+    0x00a8: 'diaeresis',
+    0x00a9: 'copyright',
+    0x00aa: 'ordfeminine',
+    0x00ab: 'guillemotleft',
+    0x00ac: 'notsign',
+    0x00ad: 'hyphen',
+    0x00ae: 'registered',
+    0x00af: 'macron',
+    0x00b0: 'degree',
+    0x00b1: 'plusminus',
+    0x00b2: 'twosuperior',
+    0x00b3: 'threesuperior',
+    0x00b4: 'acute',
+    0x00b5: 'mu',
+    0x00b6: 'paragraph',
+    0x00b7: 'periodcentered',
+    0x00b8: 'cedilla',
+    0x00b9: 'onesuperior',
+    0x00ba: 'masculine',
+    0x00bb: 'guillemotright',
+    0x00bc: 'onequarter',
+    0x00bd: 'onehalf',
+    0x00be: 'threequarters',
+    0x00bf: 'questiondown',
+    0x00c0: 'Agrave',
+    0x00c1: 'Aacute',
+    0x00c2: 'Acircumflex',
+    0x00c3: 'Atilde',
+    0x00c4: 'Adiaeresis',
+    0x00c5: 'Aring',
+    0x00c6: 'AE',
+    0x00c7: 'Ccedilla',
+    0x00c8: 'Egrave',
+    0x00c9: 'Eacute',
+    0x00ca: 'Ecircumflex',
+    0x00cb: 'Ediaeresis',
+    0x00cc: 'Igrave',
+    0x00cd: 'Iacute',
+    0x00ce: 'Icircumflex',
+    0x00cf: 'Idiaeresis',
+    0x00d0: 'Eth',
+    0x00d1: 'Ntilde',
+    0x00d2: 'Ograve',
+    0x00d3: 'Oacute',
+    0x00d4: 'Ocircumflex',
+    0x00d5: 'Otilde',
+    0x00d6: 'Odiaeresis',
+    0x00d7: 'multiply',
+    0x00d8: 'Ooblique',
+    0x00d9: 'Ugrave',
+    0x00da: 'Uacute',
+    0x00db: 'Ucircumflex',
+    0x00dc: 'Udiaeresis',
+    0x00dd: 'Yacute',
+    0x00de: 'Thorn',
+    0x00df: 'ssharp',
+    0x00e0: 'agrave',
+    0x00e1: 'aacute',
+    0x00e2: 'acircumflex',
+    0x00e3: 'atilde',
+    0x00e4: 'adiaeresis',
+    0x00e5: 'aring',
+    0x00e6: 'ae',
+    0x00e7: 'ccedilla',
+    0x00e8: 'egrave',
+    0x00e9: 'eacute',
+    0x00ea: 'ecircumflex',
+    0x00eb: 'ediaeresis',
+    0x00ec: 'igrave',
+    0x00ed: 'iacute',
+    0x00ee: 'icircumflex',
+    0x00ef: 'idiaeresis',
+    0x00f0: 'eth',
+    0x00f1: 'ntilde',
+    0x00f2: 'ograve',
+    0x00f3: 'oacute',
+    0x00f4: 'ocircumflex',
+    0x00f5: 'otilde',
+    0x00f6: 'odiaeresis',
+    0x00f7: 'division',
+    0x00f8: 'oslash',
+    0x00f9: 'ugrave',
+    0x00fa: 'uacute',
+    0x00fb: 'ucircumflex',
+    0x00fc: 'udiaeresis',
+    0x00fd: 'yacute',
+    0x00fe: 'thorn',
+    0x00ff: 'ydiaeresis',
+    0xff08: 'BackSpace',
+    0xff09: 'Tab',
+    0xff0a: 'Linefeed',
+    0xff0b: 'Clear',
+    0xff0d: 'Return',
+    0xff13: 'Pause',
+    0xff14: 'Scroll_Lock',
+    0xff15: 'Sys_Req',
+    0xff1b: 'Escape',
+    0xff20: 'Multi_key',
+    0xff21: 'Kanji',
+    0xff22: 'Muhenkan',
+    0xff23: 'Henkan_Mode',
+    0xff24: 'Romaji',
+    0xff25: 'Hiragana',
+    0xff26: 'Katakana',
+    0xff27: 'Hiragana_Katakana',
+    0xff28: 'Zenkaku',
+    0xff29: 'Hankaku',
+    0xff2a: 'Zenkaku_Hankaku',
+    0xff2b: 'Touroku',
+    0xff2c: 'Massyo',
+    0xff2d: 'Kana_Lock',
+    0xff2e: 'Kana_Shift',
+    0xff2f: 'Eisu_Shift',
+    0xff30: 'Eisu_toggle',
+    0xff3c: 'SingleCandidate',
+    0xff3d: 'Zen_Koho',
+    0xff3e: 'PreviousCandidate',
+    0xff50: 'Home',
+    0xff51: 'Left',
+    0xff52: 'Up',
+    0xff53: 'Right',
+    0xff54: 'Down',
+    0xff55: 'Prior',
+    0xff56: 'Page_Down',
+    0xff57: 'End',
+    0xff58: 'Begin',
+    0xff60: 'Select',
+    0xff61: 'Print',
+    0xff62: 'Execute',
+    0xff63: 'Insert',
+    0xff65: 'Undo',
+    0xff66: 'Redo',
+    0xff67: 'Menu',
+    0xff68: 'Find',
+    0xff69: 'Cancel',
+    0xff6a: 'Help',
+    0xff6b: 'Break',
+    0xff7e: 'script_switch',
+    0xff7f: 'Num_Lock',
+    0xff80: 'KP_Space',
+    0xff89: 'KP_Tab',
+    0xff8d: 'KP_Enter',
+    0xff91: 'KP_F1',
+    0xff92: 'KP_F2',
+    0xff93: 'KP_F3',
+    0xff94: 'KP_F4',
+    0xff95: 'KP_Home',
+    0xff96: 'KP_Left',
+    0xff97: 'KP_Up',
+    0xff98: 'KP_Right',
+    0xff99: 'KP_Down',
+    0xff9a: 'KP_Prior',
+    0xff9b: 'KP_Page_Down',
+    0xff9c: 'KP_End',
+    0xff9d: 'KP_Begin',
+    0xff9e: 'KP_Insert',
+    0xff9f: 'KP_Delete',
+    0xffaa: 'KP_Multiply',
+    0xffab: 'KP_Add',
+    0xffac: 'KP_Separator',
+    0xffad: 'KP_Subtract',
+    0xffae: 'KP_Decimal',
+    0xffaf: 'KP_Divide',
+    0xffb0: 'KP_0',
+    0xffb1: 'KP_1',
+    0xffb2: 'KP_2',
+    0xffb3: 'KP_3',
+    0xffb4: 'KP_4',
+    0xffb5: 'KP_5',
+    0xffb6: 'KP_6',
+    0xffb7: 'KP_7',
+    0xffb8: 'KP_8',
+    0xffb9: 'KP_9',
+    0xffbd: 'KP_Equal',
+    0xffbe: 'F1',
+    0xffbf: 'F2',
+    0xffc0: 'F3',
+    0xffc1: 'F4',
+    0xffc2: 'F5',
+    0xffc3: 'F6',
+    0xffc4: 'F7',
+    0xffc5: 'F8',
+    0xffc6: 'F9',
+    0xffc7: 'F10',
+    0xffc8: 'L1',
+    0xffc9: 'L2',
+    0xffca: 'L3',
+    0xffcb: 'L4',
+    0xffcc: 'L5',
+    0xffcd: 'L6',
+    0xffce: 'L7',
+    0xffcf: 'L8',
+    0xffd0: 'L9',
+    0xffd1: 'L10',
+    0xffd2: 'R1',
+    0xffd3: 'R2',
+    0xffd4: 'R3',
+    0xffd5: 'R4',
+    0xffd6: 'R5',
+    0xffd7: 'R6',
+    0xffd8: 'R7',
+    0xffd9: 'R8',
+    0xffda: 'R9',
+    0xffdb: 'R10',
+    0xffdc: 'R11',
+    0xffdd: 'R12',
+    0xffde: 'R13',
+    0xffdf: 'R14',
+    0xffe0: 'R15',
+    0xffe1: 'Shift_L',
+    0xffe2: 'Shift_R',
+    0xffe3: 'Control_L',
+    0xffe4: 'Control_R',
+    0xffe5: 'Caps_Lock',
+    0xffe6: 'Shift_Lock',
+    0xffe7: 'Meta_L',
+    0xffe8: 'Meta_R',
+    0xffe9: 'Alt_L',
+    0xffea: 'Alt_R',
+    0xffeb: 'Super_L',
+    0xffec: 'Super_R',
+    0xffed: 'Hyper_L',
+    0xffee: 'Hyper_R',
+    0xffff: 'Delete',
+}
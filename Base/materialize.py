@@ -0,0 +1,148 @@
+import sys
+import time
+import sqlite3
+import datetime
+
+from Base import config as cfg
+from Base import models
+from Base import keycodec
+from Base.journal import ingest_horizon, journal_dir
+from Base.rollups import parse_time
+
+DAY = datetime.timedelta(days=1)
+
+
+def epoch(moment):
+    """ Epoch seconds of a local datetime, like keycodec.epoch_seconds(). """
+    return time.mktime(moment.timetuple()) + moment.microsecond / 1e6
+
+
+class ActivityMaterializer:
+    """ Fills the activity table with the active intervals of every window: each key press
+        or click at t makes [t, t + cutoff] active and the intervals of one window are merged.
+        Events are taken in steps from the watermark up to lag seconds ago, as key sequences
+        are stored when they end, and the watermark moves in the transaction that writes
+        the intervals, so a step is done exactly once. An interval that overlaps the last
+        row of its window extends that row instead of adding one. Rows of different windows
+        overlap, a query joins them like Baseview joins raw events, so the active time of a
+        process, a title or in total comes out the same. Rows also hold time made active by
+        events before a queried range, so Baseview reads the first cutoff of the range, like
+        the time after the watermark, from the event rows. A new cutoff starts over. Like the
+        rollups, the watermark stays behind the events still waiting in the journal. """
+
+    def __init__(self, db_name, conn=None, cutoff=cfg.ACTIVITY_CUTOFF, lag=cfg.ACTIVITY_LAG,
+                 interval=cfg.ACTIVITY_INTERVAL):
+        self.db_name = db_name
+        self.conn = conn
+        self.cutoff = cutoff
+        self.lag = lag
+        self.interval = interval  # seconds between two step() calls in the daemon
+
+    def state(self, name):
+        row = self.conn.execute("SELECT value FROM rollup_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name, value):
+        self.conn.execute("""
+            INSERT INTO rollup_state (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (name, value))
+
+    def watermark(self):
+        """ Events before it are in the activity table, None before the first update or with another cutoff. """
+        if self.state('activity_cutoff') != str(self.cutoff):
+            return None
+        value = self.state('activity_watermark')
+        return parse_time(value) if value else None
+
+    def update(self, now=None):
+        """ Materializes every event between the watermark and lag seconds ago. """
+        now = now or datetime.datetime.now()
+        horizon = ingest_horizon(self.conn, journal_dir(self.db_name))
+        if horizon is not None:
+            now = min(now, horizon)
+        end = now - datetime.timedelta(seconds=self.lag)
+        if self.conn.in_transaction:
+            self.conn.commit()
+        while True:
+            with self.conn:
+                # taken before the watermark is read, so the daemon and Baseview never do a step twice
+                self.conn.execute("BEGIN IMMEDIATE")
+                if self.state('activity_cutoff') != str(self.cutoff):
+                    self.conn.execute("DELETE FROM activity")
+                    self.conn.execute("DELETE FROM rollup_state WHERE name = 'activity_watermark'")
+                    self.set_state('activity_cutoff', str(self.cutoff))
+                start = self.watermark() or self.first_event()
+                if start is None or start >= end:
+                    return
+                stop = min(start + DAY, end)
+                self.materialize(start, stop)
+                self.set_state('activity_watermark', stop)
+
+    def first_event(self):
+        first = [row[0] for row in self.conn.execute(
+            "SELECT MIN(started) FROM keys UNION ALL SELECT MIN(created_at) FROM click") if row[0]]
+        return min(parse_time(value) for value in first) if first else None
+
+    def events(self, start, stop):
+        """ Epoch times and window ids of the key presses and clicks in [start, stop), with the process of every window. """
+        import numpy as np
+
+        times, windows = [], []
+        processes = {}
+        # a key sequence is stored when it ends, at most lag seconds after its first press
+        rows = self.conn.execute("""
+            SELECT process_id, window_id, created_at, timings FROM keys
+            WHERE created_at >= ? AND created_at < ? AND started < ?
+        """, (start, stop + datetime.timedelta(seconds=self.lag), stop)).fetchall()
+        if rows:
+            intervals, offsets = keycodec.decode_timings_batch([row[3] for row in rows])
+            created = keycodec.epoch_seconds([row[2] for row in rows])
+            times.append(keycodec.create_times_batch(created, intervals, offsets))
+            windows.append(np.repeat([row[1] for row in rows], np.diff(offsets) + 1))
+            processes.update((row[1], row[0]) for row in rows)
+        rows = self.conn.execute("SELECT process_id, window_id, created_at FROM click WHERE created_at >= ? AND created_at < ?",
+                                 (start, stop)).fetchall()
+        if rows:
+            times.append(keycodec.epoch_seconds([row[2] for row in rows]))
+            windows.append(np.array([row[1] for row in rows]))
+            processes.update((row[1], row[0]) for row in rows)
+        if not times:
+            return None
+        times = np.concatenate(times)
+        windows = np.concatenate(windows).astype(np.int64)
+        # a key sequence that crosses the edges also brings presses of the neighbouring steps
+        inside = (times >= epoch(start)) & (times < epoch(stop))
+        return times[inside], windows[inside], processes
+
+    def materialize(self, start, stop):
+        from Base.intervals import group_merge
+
+        events = self.events(start, stop)
+        if events is None:
+            return
+        times, windows, processes = events
+        for window_id, first, last in zip(*group_merge(windows, times, self.cutoff)):
+            window_id = int(window_id)
+            first = datetime.datetime.fromtimestamp(first)
+            last = datetime.datetime.fromtimestamp(last)
+            row = self.conn.execute("""
+                SELECT id, end_time FROM activity WHERE window_id = ? AND end_time >= ?
+                ORDER BY end_time DESC LIMIT 1
+            """, (window_id, first)).fetchone()
+            if row is not None:
+                if last > parse_time(row[1]):
+                    self.conn.execute("UPDATE activity SET end_time = ? WHERE id = ?", (last, row[0]))
+            else:
+                self.conn.execute("INSERT INTO activity (process_id, window_id, start_time, end_time) VALUES (?, ?, ?, ?)",
+                                  (processes[window_id], window_id, first, last))
+
+    def step(self):
+        """ Brings the activity table up to date on a connection of its own. """
+        self.conn = models.initialize(self.db_name)
+        try:
+            self.update()
+        except sqlite3.Error as e:
+            print(f'Could not update the activity table: {e}', file=sys.stderr)
+        finally:
+            self.conn.close()
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import threading
+
+from Base import config as cfg
+from Base import models
+
+# histogram bucket i counts durations below 2**i microseconds, the last one everything longer
+BUCKETS = 32
+
+
+class Histogram:
+    """ Durations in power of two microsecond buckets. observe() is a handful of integer
+        operations, so it can sit on the event path. """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[min(BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, share):
+        """ Upper bound in seconds of the bucket holding the given share of the observations. """
+        if not self.count:
+            return 0.0
+        rank = share * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.max, 2 ** bucket / 1e6)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.total,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': list(self.counts)}
+
+
+class Registry:
+    """ Counters, duration histograms and gauges of one process.
+        Some metrics are updated from several threads, e.g. the blob store ones by the
+        capture worker and the blob migration, so updates and snapshots hold a lock. It is
+        only contended while a snapshot is taken, which keeps it cheap on the event path. """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # a child forked while another thread holds the lock would wait for it forever
+        os.register_at_fork(after_in_child=self.reset_lock)
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, read):
+        """ Registers a function that returns the current value, e.g. a queue length. """
+        self.gauges[name] = read
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        return {'pid': os.getpid(),
+                'time': time.time(),
+                'uptime': time.time() - self.started,
+                'counters': counters,
+                'gauges': gauges,
+                'histograms': histograms}
+
+
+registry = Registry()
+count = registry.count
+observe = registry.observe
+gauge = registry.gauge
+
+
+def snapshot_path(db_name, name=cfg.METRICS_FILE):
+    """ The snapshot file lives next to the database. """
+    return os.path.join(os.path.dirname(models.database_path(db_name)), name)
+
+
+def write_snapshot(path, snapshot):
+    """ Writes through a temporary file, so readers never see half a snapshot. """
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)
+
+
+def read_snapshot(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_snapshot(snapshot):
+    """ The snapshot as text for Base --metrics. """
+    age = time.time() - snapshot['time']
+    lines = [f"pid {snapshot['pid']}, up {snapshot['uptime']:.0f} s, snapshot taken {age:.0f} s ago", '']
+    if snapshot['counters']:
+        lines.append('Counters')
+        lines += [f'  {name:<32} {value:>12}' for name, value in sorted(snapshot['counters'].items())]
+        lines.append('')
+    if snapshot['gauges']:
+        lines.append('Gauges')
+        lines += [f'  {name:<32} {value:>12}' for name, value in sorted(snapshot['gauges'].items())]
+        lines.append('')
+    if snapshot['histograms']:
+        lines.append(f"Durations{'count':>34} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            mean = histogram['sum'] / histogram['count'] if histogram['count'] else 0.0
+            lines.append(f"  {name:<32} {histogram['count']:>9} {mean * 1e3:>10.3f} {histogram['p50'] * 1e3:>10.3f} "
+                         f"{histogram['p99'] * 1e3:>10.3f} {histogram['max'] * 1e3:>10.3f}")
+    return '\n'.join(lines)
+
+
+class SnapshotWriter:
+    """ Writes the registry to a JSON file, the daemon calls write() every interval seconds. """
+
+    def __init__(self, path, interval=cfg.METRICS_INTERVAL, metrics=registry):
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+
+    def write(self):
+        try:
+            write_snapshot(self.path, self.metrics.snapshot())
+        except OSError as e:
+            print(f'Could not write the metrics snapshot: {e}', file=sys.stderr)
@@ -1,14 +1,15 @@
-import datetime
-import duckdb
 import sqlite3
 import os
-from Base.period import Period
 
-def initialize(fname):
+def database_path(fname):
+    return os.path.join('data', fname)
+
+def initialize(fname, check_same_thread=True):
     os.makedirs('data', exist_ok=True)
-    sqlite_file = os.path.join('data', fname)
-    con = sqlite3.connect(sqlite_file)
-    con.execute("""
+    sqlite_file = database_path(fname)
+    con = sqlite3.connect(sqlite_file, check_same_thread=check_same_thread)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript("""
         CREATE TABLE IF NOT EXISTS process (
             id INTEGER PRIMARY KEY,
             name VARCHAR UNIQUE,
@@ -39,6 +40,7 @@ def initialize(fname):
             x INTEGER NOT NULL,
             y INTEGER NOT NULL,
             nrmoves INTEGER NOT NULL,
+            path BLOB,
             process_id INTEGER NOT NULL,
             window_id INTEGER NOT NULL,
             geometry_id INTEGER NOT NULL,
@@ -56,14 +58,19 @@ def initialize(fname):
             window_id INTEGER NOT NULL,
             geometry_id INTEGER NOT NULL,
             nrkeys INTEGER,
-            keys VARCHAR,
-            timings VARCHAR,
+            keys BLOB,
+            timings BLOB,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (process_id) REFERENCES process(id),
             FOREIGN KEY (window_id) REFERENCES window(id),
             FOREIGN KEY (geometry_id) REFERENCES geometry(id)
         );
 
+        CREATE TABLE IF NOT EXISTS keycode (
+            id INTEGER PRIMARY KEY,
+            key VARCHAR UNIQUE NOT NULL
+        );
+
         CREATE TABLE IF NOT EXISTS activity (
             id INTEGER PRIMARY KEY,
             process_id INTEGER NOT NULL,
@@ -81,30 +88,146 @@ def initialize(fname):
             window_id INTEGER NOT NULL,
             geometry_id INTEGER NOT NULL,
             image BLOB NOT NULL,
+            kind INTEGER,
+            keyframe_id INTEGER,
+            codec VARCHAR,
+            width INTEGER,
+            height INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (process_id) REFERENCES process(id),
             FOREIGN KEY (window_id) REFERENCES window(id),
             FOREIGN KEY (geometry_id) REFERENCES geometry(id)
         );
 
+        CREATE TABLE IF NOT EXISTS trigram (
+            kind VARCHAR NOT NULL,
+            gram VARCHAR NOT NULL,
+            ref_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, gram, ref_id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS trigram_state (
+            kind VARCHAR PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS rollup (
+            level VARCHAR NOT NULL,
+            bucket TIMESTAMP NOT NULL,
+            process_id INTEGER NOT NULL,
+            window_id INTEGER NOT NULL,
+            nr INTEGER NOT NULL DEFAULT 0,
+            keystrokes INTEGER NOT NULL DEFAULT 0,
+            clicks INTEGER NOT NULL DEFAULT 0,
+            noscroll_clicks INTEGER NOT NULL DEFAULT 0,
+            mousings INTEGER NOT NULL DEFAULT 0,
+            button1 INTEGER NOT NULL DEFAULT 0,
+            button2 INTEGER NOT NULL DEFAULT 0,
+            button3 INTEGER NOT NULL DEFAULT 0,
+            button4 INTEGER NOT NULL DEFAULT 0,
+            button5 INTEGER NOT NULL DEFAULT 0,
+            active REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (level, bucket, process_id, window_id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name VARCHAR PRIMARY KEY,
+            value VARCHAR NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS recall_chunk (
+            id INTEGER PRIMARY KEY,
+            process_id INTEGER NOT NULL,
+            window_id INTEGER NOT NULL,
+            first_key_id INTEGER NOT NULL,
+            last_key_id INTEGER NOT NULL,
+            started TIMESTAMP NOT NULL,
+            ended TIMESTAMP NOT NULL,
+            length INTEGER NOT NULL,
+            snippet VARCHAR,
+            FOREIGN KEY (process_id) REFERENCES process(id),
+            FOREIGN KEY (window_id) REFERENCES window(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS recall_state (
+            name VARCHAR PRIMARY KEY,
+            value VARCHAR NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS blob (
+            digest BLOB PRIMARY KEY,
+            segment INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS journal_state (
+            name VARCHAR PRIMARY KEY,
+            segment INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            state TEXT
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_window_title ON window (title, process_id);
+        CREATE INDEX IF NOT EXISTS idx_geometry_dims ON geometry (xpos, ypos, width, height);
         CREATE INDEX IF NOT EXISTS idx_click_created_at ON click (created_at);
         CREATE INDEX IF NOT EXISTS idx_keys_created_at ON keys (created_at);
         CREATE INDEX IF NOT EXISTS idx_activity_start_time ON activity (start_time);
         CREATE INDEX IF NOT EXISTS idx_activity_end_time ON activity (end_time);
         CREATE INDEX IF NOT EXISTS idx_screenshot_created_at ON screenshot (created_at);
     """)
+    add_columns(con, 'screenshot', [('kind', 'INTEGER'),
+                                    ('keyframe_id', 'INTEGER'),
+                                    ('codec', 'VARCHAR'),
+                                    ('width', 'INTEGER'),
+                                    ('height', 'INTEGER'),
+                                    ('digest', 'BLOB')])
+    add_columns(con, 'click', [('path', 'BLOB')])
+    add_text_index(con)
     return con
 
-def export_to_parquet(sqlite_file):
-    parquet_file = sqlite_file.replace('.db', '_' + datetime.datetime.now().strftime('%m-%d-%y') + '.parquet')
-    duckdb_con = duckdb.connect()
-    duckdb_con.execute(f"INSTALL sqlite;")
-    duckdb_con.execute(f"LOAD sqlite;")
-    duckdb_con.execute(f"ATTACH DATABASE '{sqlite_file}' AS sqlite;")
-    for table_name in ['process', 'window', 'geometry', 'click', 'keys', 'activity', 'screenshot']:
-        duckdb_con.execute(f"""
-            COPY (SELECT * FROM sqlite.{table_name}) TO '{parquet_file}_{table_name}.parquet' (FORMAT 'parquet');
+def add_text_index(con):
+    """ Creates the FTS5 index over keys.text, kept current by triggers and filled from the
+        existing rows the first time. Returns False if SQLite lacks FTS5 or its trigram tokenizer. """
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'keys_fts'").fetchone():
+        return True
+    try:
+        con.executescript("""
+            BEGIN;
+            CREATE VIRTUAL TABLE IF NOT EXISTS keys_fts USING fts5 (
+                text, content='keys', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS keys_fts_insert AFTER INSERT ON keys BEGIN
+                INSERT INTO keys_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS keys_fts_delete AFTER DELETE ON keys BEGIN
+                INSERT INTO keys_fts (keys_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS keys_fts_update AFTER UPDATE OF text ON keys BEGIN
+                INSERT INTO keys_fts (keys_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                INSERT INTO keys_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            INSERT INTO keys_fts (keys_fts) VALUES ('rebuild');
+            COMMIT;
         """)
+    except sqlite3.OperationalError:
+        if con.in_transaction:
+            con.rollback()
+        return False
+    return True
+
+def add_columns(con, table, columns):
+    """ Adds the (name, type) columns that an older database is missing. """
+    existing = {row[1] for row in con.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns:
+        if name not in existing:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+    con.commit()
+
+def export_to_parquet(sqlite_file):
+    """ Moves closed days out of SQLite into the partitioned Parquet cold tier. """
+    from Base.tiering import ColdTier
+    return ColdTier(sqlite_file).rollover()
 
 class Process:
     def __init__(self, name):
@@ -171,30 +294,25 @@ class Activity:
 
     @staticmethod
     def get_for_process(process_id, start_time, end_time, sqlite_file):
-        duckdb_con = duckdb.connect()
-        duckdb_con.execute("INSTALL sqlite;")
-        duckdb_con.execute("LOAD sqlite;")
-        duckdb_con.execute(f"ATTACH DATABASE '{sqlite_file}' AS sqlite;")
-        
-        parquet_files = [f for f in os.listdir('data') if f.endswith('.parquet')]
-        for parquet_file in parquet_files:
-            duckdb_con.execute(f"""
-                CREATE VIEW IF NOT EXISTS {parquet_file} AS 
-                SELECT * FROM parquet_scan('data/{parquet_file}') 
-            """)
-        
-        periods = Period(datetime.timedelta(seconds=5), end_time)
-        rows = duckdb_con.execute("""
-            SELECT process_id, window_id, start_time, end_time 
-            FROM sqlite.activity
-            UNION ALL BY NAME
-            SELECT process_id, window_id, start_time, end_time
-            FROM activity
-            WHERE process_id = ? AND start_time >= ? AND start_time <= ?
+        """ The merged (start, end) active periods of a process that start in [start_time, end_time). """
+        from Base.catalog import get_catalog
+
+        catalog = get_catalog(sqlite_file)
+        where, params = catalog.time_filter('activity', start_time, end_time)
+        rows = catalog.execute(f"""
+            SELECT start_time, end_time FROM activity
+            WHERE process_id = ? AND {where}
             ORDER BY start_time
-        """, [process_id, start_time, end_time])
-        periods.extend(row[2] for row in rows.fetchall())
-        return periods.times
+        """, [process_id] + params)
+        # the rows of different windows of the process overlap
+        periods = []
+        for start, end in rows.fetchall():
+            end = min(end, end_time) if end_time else end
+            if periods and start <= periods[-1][1]:
+                periods[-1] = (periods[-1][0], max(periods[-1][1], end))
+            else:
+                periods.append((start, end))
+        return periods
 
     def __repr__(self):
         return f"<Activity process:{self.process_id} window:{self.window_id} duration:{self.duration()}>"
@@ -1,45 +1,54 @@
-import bisect
 import datetime
 
+import numpy as np
+
+from Base.intervals import IntervalSet
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
 
 class Period:
-    def __init__(self, cutoff: datetime.timedelta, maxtime: datetime.datetime):
-        self.times = []
-        self.cutoff = cutoff
-        self.maxtime = maxtime
-
-    def append(self, time: datetime.datetime):
-        ltimes = len(self.times)
-        end = min(time + self.cutoff, self.maxtime)
-
-        def check_in(i):
-            if self.times[i][0] <= time <= self.times[i][1]:
-                self.times[i] = (self.times[i][0], max(end, self.times[i][1]))
-                return True
-            return False
-
-        def maybe_merge(i):
-            if ltimes > i + 1:
-                if self.times[i][1] >= self.times[i + 1][0]:
-                    self.times[i] = (self.times[i][0], self.times[i + 1][1])
-                    self.times.pop(i + 1)
-
-        if ltimes == 0:
-            self.times.append((time, end))
-            return
-
-        i = bisect.bisect(self.times, (time,))
-        if i >= 1 and check_in(i - 1):
-            maybe_merge(i - 1)
-        elif i < ltimes and check_in(i):
-            maybe_merge(i)
-        else:
-            self.times.insert(i, (time, end))
-            maybe_merge(i)
-
-    def extend(self, times):
-        for time in times:
-            self.append(time)
-
-    def calc_total(self) -> datetime.timedelta:
-        return sum((t2 - t1 for t1, t2 in self.times), start=datetime.timedelta())
+    """ Active periods: every time appended makes [time, min(time + cutoff, maxtime)] active.
+        Times are buffered and merged in one vectorized pass when .times or calc_total()
+        is first used after a change. Times may be datetimes with a timedelta cutoff or
+        seconds with a numeric cutoff, and come back in the same form. """
+
+    def __init__(self, cutoff, maxtime):
+        self.dates = isinstance(maxtime, datetime.datetime)
+        self.tzinfo = maxtime.tzinfo if self.dates else None
+        if self.dates:
+            cutoff = cutoff.total_seconds()
+            maxtime = self.to_seconds(maxtime)
+        self.intervals = IntervalSet(cutoff, maxtime)
+
+    def to_seconds(self, time):
+        return (time - EPOCH.replace(tzinfo=self.tzinfo)).total_seconds()
+
+    def from_seconds(self, seconds):
+        return EPOCH.replace(tzinfo=self.tzinfo) + datetime.timedelta(seconds=seconds)
+
+    def append(self, time):
+        self.extend([time])
+
+    def extend(self, times, presorted=False):
+        if self.dates:
+            times = [self.to_seconds(time) for time in times]
+        self.intervals.extend(times, presorted)
+
+    def include(self, starts, ends):
+        """ Adds intervals given as seconds, clipped to maxtime. """
+        self.intervals.include(starts, np.minimum(ends, self.intervals.maxtime))
+
+    @property
+    def times(self):
+        starts, ends = self.intervals.consolidate()
+        if self.dates:
+            return [(self.from_seconds(t1), self.from_seconds(t2)) for t1, t2 in zip(starts.tolist(), ends.tolist())]
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def calc_total(self):
+        """ The active time, a timedelta for datetime periods and seconds otherwise. """
+        total = self.intervals.total()
+        if self.dates:
+            return datetime.timedelta(seconds=total)
+        return total
@@ -0,0 +1,82 @@
+import sys
+import signal
+import threading
+import multiprocessing
+
+from Base import config as cfg
+from Base import metrics
+from Base.journal import RecordEncoder
+from Base.ringbuffer import RingBuffer, RingSource
+
+
+def persist(ring_name, db_name, options):
+    """ Entry point of the persistence process: everything but reading X events. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the capture process decides when to stop
+    from Base.activity_store import ActivityStore
+    ring = RingBuffer(ring_name)
+    store = ActivityStore(db_name, **options)
+    store.run(RingSource(ring, store.capture))
+    store.close()
+    ring.close()
+
+
+class Supervisor:
+    """ Runs the X capture loop in this process and persistence in a child process.
+        The capture process only reads X events and copies them into a shared memory ring,
+        so neither GIL contention nor disk stalls in the child can hold up input. A child
+        that dies is started again and carries on at the ring's read index, and events that
+        come in while the ring is full are dropped and counted. The metrics of the event loop
+        are kept in this process and written to a snapshot file of their own. """
+
+    def __init__(self, db_name, options, slots=cfg.RING_SLOTS, interval=cfg.RING_RESTART_INTERVAL):
+        self.db_name = db_name
+        self.options = options
+        self.interval = interval
+        self.ring = RingBuffer(slots=slots)
+        self.metrics = metrics.SnapshotWriter(metrics.snapshot_path(db_name, cfg.CAPTURE_METRICS_FILE))
+        self.process = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name='supervisor', daemon=True)
+
+    def spawn(self):
+        self.process = multiprocessing.Process(target=persist, name='Base persistence',
+                                               args=(self.ring.name, self.db_name, self.options))
+        self.process.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            if not self.process.is_alive():
+                print(f'Persistence process exited with {self.process.exitcode}, restarting it', file=sys.stderr)
+                self.spawn()
+
+    def run(self, source=None):
+        """ Blocks on the event source, the X sniffer unless another object with the same
+            hooks and run()/cancel() is given. """
+        self.spawn()
+        self.thread.start()
+        if source is None:
+            from Base.sniff_x import Sniffer
+            source = Sniffer()
+        self.sniffer = source
+        if self.metrics.interval > 0:
+            source.scheduler.every(self.metrics.interval, self.metrics.write, name='metrics')
+        producer = RecordEncoder(self.ring.put)  # the hooks of the capture process only encode the event into the ring
+        source.screen_hook = producer.focus
+        source.key_hook = producer.key
+        source.mouse_button_hook = producer.button
+        source.mouse_move_hook = producer.motion
+        source.run()
+
+    def close(self):
+        """ Stops capturing and waits until the child has stored what is left in the ring. """
+        self.sniffer.cancel()
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.ring.close_writer()
+        if not self.process.is_alive():
+            self.spawn()
+        self.process.join()
+        self.ring.close()
+        self.ring.unlink()
+        self.metrics.write()
@@ -0,0 +1,355 @@
+import os
+import re
+import sys
+import math
+import time
+import zlib
+import fcntl
+import sqlite3
+import datetime
+import importlib
+from collections import Counter
+
+import numpy as np
+
+from Base import config as cfg
+from Base import metrics
+from Base import models
+
+WORD = re.compile(r'\w+')
+BLOCK = 65536  # matrix rows scored or assigned at once
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 64  # training vectors per list
+
+
+class HashingEmbedder:
+    """ The baseline embedder: words and their character trigrams hashed into a fixed
+        number of signed buckets, weighted by log term frequency and scaled to unit length.
+        It needs no model and no training, and a vector never changes once computed, so
+        the index can grow one chunk at a time. Trigrams let typos and word fragments,
+        which typed text is full of, still match. """
+
+    name = 'hashing'
+
+    def __init__(self, dimensions=cfg.RECALL_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def features(self, text):
+        for word in WORD.findall(text.lower()):
+            yield word
+            padded = f' {word} '
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in Counter(self.features(text)).items():
+                # crc32 and not hash(), the vectors must be the same in every process
+                h = zlib.crc32(feature.encode())
+                vectors[row, h % self.dimensions] += (1.0 + math.log(count)) * (1 if h & 0x80000000 else -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+EMBEDDERS = {'hashing': HashingEmbedder}
+
+
+def make_embedder(spec=cfg.RECALL_EMBEDDER):
+    """ An embedder by name, or any class given as 'module:Class'. An embedder has a name,
+        its dimensions and embed(texts), which returns one unit length float32 row per text. """
+    if spec in EMBEDDERS:
+        return EMBEDDERS[spec]()
+    module, _, attribute = spec.partition(':')
+    if not attribute:
+        raise ValueError(f'Unknown embedder {spec}, use one of {sorted(EMBEDDERS)} or module:Class')
+    return getattr(importlib.import_module(module), attribute)()
+
+
+def recall_dir(db_name):
+    """ The vector files live in a directory next to the database. """
+    return os.path.join(os.path.dirname(models.database_path(db_name)), cfg.RECALL_DIR)
+
+
+class Chunk:
+    """ Consecutive keys rows typed in one window, without a long pause in between. """
+
+    def __init__(self, chunk_id, process_id, window_id, first_key_id, last_key_id, started, ended, length, ended_day):
+        self.id = chunk_id
+        self.process_id = process_id
+        self.window_id = window_id
+        self.first_key_id = first_key_id
+        self.last_key_id = last_key_id
+        self.started = started
+        self.ended = ended
+        self.length = length
+        self.ended_day = ended_day  # julian day of ended
+
+    def continues(self, window_id, started_day, length, gap, max_length):
+        return (window_id == self.window_id
+                and (started_day - self.ended_day) * 86400 <= gap
+                and self.length + length <= max_length)
+
+
+class RecallIndex:
+    """ Semantic search over what was typed, with the window title it was typed in.
+        keys rows are chunked into window sessions (see Chunk), and every chunk is one
+        float16 row of a matrix that is appended to a file and read through a memmap.
+        recall_chunk holds the metadata of row id - 1 and is committed after the vectors
+        are written, so a crash leaves at most rows that are dropped on the next update.
+        The last chunk is embedded again when its session goes on.
+
+        Once there are ivf_min chunks, k-means puts them into about sqrt(n) lists, an
+        inverted file, and a query only scores the rows of the nprobe lists closest to it.
+        The lists are trained again whenever the index doubled. A generation of lists is
+        a centroids-<n>.npy file with the list of every row in lists-<n>.i4, which is
+        written completely before the centroids appear. Rows added after the training
+        are appended to the newest lists file; rows it does not cover yet are always scored.
+
+        update() takes a file lock, so the daemon and Baseview never write at the same
+        time, and search() needs no lock. keys rows that moved to the Parquet cold tier
+        before they were indexed, say after a reset, are read through the catalog. """
+
+    def __init__(self, db_name, conn=None, embedder=None, interval=cfg.RECALL_INTERVAL, batch_size=cfg.RECALL_BATCH,
+                 gap=cfg.RECALL_SESSION_GAP, max_length=cfg.RECALL_CHUNK_LENGTH, ivf_min=cfg.RECALL_IVF_MIN,
+                 nprobe=cfg.RECALL_NPROBE):
+        self.db_name = db_name
+        self.conn = conn
+        self.embedder = embedder or make_embedder()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.gap = gap
+        self.max_length = max_length
+        self.ivf_min = ivf_min
+        self.nprobe = nprobe
+        self.directory = recall_dir(db_name)
+        self.vectors_path = os.path.join(self.directory, 'vectors.f16')
+        self.row_size = self.embedder.dimensions * 2
+        self.identity = f'{self.embedder.name}:{self.embedder.dimensions}'
+        self.source = 'keys'  # or a view over both storage tiers
+
+    def rows(self, path, row_size):
+        try:
+            return os.path.getsize(path) // row_size
+        except OSError:
+            return 0
+
+    def write_rows(self, path, row, data):
+        with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+            f.seek(row * (data.nbytes // len(data)))
+            f.write(data.tobytes())
+
+    def truncate(self, path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            os.truncate(path, size)
+
+    def vectors(self, n):
+        if n == 0:
+            return np.empty((0, self.embedder.dimensions), dtype=np.float16)
+        return np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(n, self.embedder.dimensions))
+
+    def generation(self):
+        """ The newest trained lists as (rows trained on, centroids, lists file), or None before the first training. """
+        trained = [int(name[10:-4]) for name in os.listdir(self.directory)
+                   if re.fullmatch(r'centroids-\d+\.npy', name)] if os.path.isdir(self.directory) else []
+        if not trained:
+            return None
+        n = max(trained)
+        return n, np.load(os.path.join(self.directory, f'centroids-{n}.npy')), os.path.join(self.directory, f'lists-{n}.i4')
+
+    def lists(self, path, n):
+        rows = min(self.rows(path, 4), n)
+        if rows == 0:
+            return np.empty(0, dtype=np.int32)
+        return np.memmap(path, dtype=np.int32, mode='r', shape=(rows,))
+
+    def state(self, name):
+        row = self.conn.execute("SELECT value FROM recall_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def reset(self):
+        """ Starts over, for an index built by another embedder. """
+        for name in os.listdir(self.directory):
+            if name != 'lock':
+                os.remove(os.path.join(self.directory, name))
+        self.conn.execute("DELETE FROM recall_chunk")
+        self.conn.execute("INSERT OR REPLACE INTO recall_state (name, value) VALUES ('embedder', ?)", (self.identity,))
+        self.conn.commit()
+
+    def repair(self):
+        """ Makes the vector file and recall_chunk agree after a crash. """
+        chunks = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM recall_chunk").fetchone()[0]
+        n = min(chunks, self.rows(self.vectors_path, self.row_size))
+        self.conn.execute("DELETE FROM recall_chunk WHERE id > ?", (n,))
+        self.conn.commit()
+        self.truncate(self.vectors_path, n * self.row_size)
+        generation = self.generation()
+        if generation is not None:
+            _, centroids, path = generation
+            self.truncate(path, n * 4)
+            self.assign(centroids, path, self.rows(path, 4), n)
+        return n
+
+    def last_chunk(self):
+        row = self.conn.execute("""
+            SELECT id, process_id, window_id, first_key_id, last_key_id, started, ended, length, julianday(ended)
+            FROM recall_chunk ORDER BY id DESC LIMIT 1
+        """).fetchone()
+        return Chunk(*row) if row else None
+
+    def assign(self, centroids, path, start, end):
+        """ Writes the nearest list of the rows start to end. """
+        vectors = self.vectors(end)
+        for block in range(start, end, BLOCK):
+            rows = vectors[block:min(end, block + BLOCK)].astype(np.float32)
+            self.write_rows(path, block, np.argmax(rows @ centroids.T, axis=1).astype(np.int32))
+
+    def texts(self, chunks):
+        texts = []
+        for chunk in chunks:
+            process, title = self.conn.execute("""
+                SELECT process.name, window.title FROM window JOIN process ON process.id = window.process_id
+                WHERE window.id = ?
+            """, (chunk.window_id,)).fetchone()
+            typed = ''.join(row[0] for row in self.conn.execute(
+                f"SELECT text FROM {self.source} WHERE id BETWEEN ? AND ? ORDER BY id", (chunk.first_key_id, chunk.last_key_id)))
+            texts.append((f'{process} {title}', typed))
+        return texts
+
+    def attach_cold(self):
+        """ Reads keys through a view over both tiers if Parquet holds rows of the last chunk or newer ones. """
+        from Base.tiering import parquet_root, partition_days
+
+        last = self.last_chunk()
+        since = datetime.datetime.fromisoformat(str(last.started)) if last else None
+        self.source = 'keys'
+        if any(since is None or day >= since.date() for day in partition_days(parquet_root(self.db_name), 'keys')):
+            from Base.catalog import attach_cold
+            self.source = attach_cold(self.conn, self.db_name, ['keys'], [(since, None)]).get('keys', 'keys')
+
+    def add(self):
+        """ Chunks and embeds up to batch_size new keys rows. Returns how many there were. """
+        last = self.last_chunk()
+        rows = self.conn.execute(f"""
+            SELECT id, process_id, window_id, started, created_at, julianday(started), julianday(created_at), length(text)
+            FROM {self.source} WHERE id > ? ORDER BY id LIMIT ?
+        """, (last.last_key_id if last else 0, self.batch_size)).fetchall()
+        if not rows:
+            return 0
+
+        changed = []
+        chunk = last
+        for key_id, process_id, window_id, started, ended, started_day, ended_day, length in rows:
+            if chunk is not None and chunk.continues(window_id, started_day, length, self.gap, self.max_length):
+                chunk.last_key_id = key_id
+                chunk.ended = ended
+                chunk.ended_day = ended_day
+                chunk.length += length
+            else:
+                chunk = Chunk((chunk.id if chunk else 0) + 1, process_id, window_id, key_id, key_id,
+                              started, ended, length, ended_day)
+            if not changed or changed[-1] is not chunk:
+                changed.append(chunk)
+
+        first = changed[0].id - 1
+        texts = self.texts(changed)
+        vectors = self.embedder.embed([f'{title}\n{typed}' for title, typed in texts]).astype(np.float16)
+        self.write_rows(self.vectors_path, first, vectors)
+        generation = self.generation()
+        if generation is not None:
+            _, centroids, path = generation
+            self.assign(centroids, path, min(first, self.rows(path, 4)), first + len(changed))
+
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO recall_chunk (id, process_id, window_id, first_key_id, last_key_id, started, ended, length, snippet)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(chunk.id, chunk.process_id, chunk.window_id, chunk.first_key_id, chunk.last_key_id, chunk.started,
+               chunk.ended, chunk.length, ' '.join(typed.split())[:cfg.RECALL_SNIPPET_LENGTH])
+              for chunk, (_, typed) in zip(changed, texts)])
+        self.conn.commit()
+        metrics.count('recall.rows', len(rows))
+        return len(rows)
+
+    def train(self, n):
+        """ Clusters the rows into about sqrt(n) lists with spherical k-means on a sample. """
+        nlists = max(1, int(math.sqrt(n)))
+        vectors = self.vectors(n)
+        rng = np.random.default_rng(n)
+        sample = vectors[np.sort(rng.choice(n, min(n, nlists * KMEANS_SAMPLE), replace=False))].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # an empty list keeps its centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        path = os.path.join(self.directory, f'lists-{n}.i4')
+        self.truncate(path, 0)
+        self.assign(centroids, path, 0, n)
+        temporary = os.path.join(self.directory, 'centroids.tmp.npy')
+        np.save(temporary, centroids)
+        os.replace(temporary, os.path.join(self.directory, f'centroids-{n}.npy'))
+        for name in os.listdir(self.directory):
+            if (name.startswith('centroids-') or name.startswith('lists-')) and not name.startswith((f'centroids-{n}.', f'lists-{n}.')):
+                os.remove(os.path.join(self.directory, name))
+
+    def update(self, wait=True):
+        """ Indexes the keys rows added since the last update. Without wait, returns False
+            at once if another process is updating. """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return False
+            started = time.perf_counter()
+            if self.state('embedder') != self.identity:
+                self.reset()
+            self.repair()
+            self.attach_cold()
+            while self.add() == self.batch_size:
+                pass
+            n = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM recall_chunk").fetchone()[0]
+            generation = self.generation()
+            if n >= self.ivf_min and n >= 2 * (generation[0] if generation else 0):
+                self.train(n)
+            metrics.observe('recall.update', time.perf_counter() - started)
+        return True
+
+    def step(self):
+        """ Brings the index up to date on a connection of its own. """
+        self.conn = models.initialize(self.db_name)
+        try:
+            self.update()
+        except (sqlite3.Error, OSError) as e:
+            print(f'Could not update the recall index: {e}', file=sys.stderr)
+        finally:
+            self.conn.close()
+
+    def search(self, query, top=cfg.RECALL_TOP):
+        """ The top chunks for query as (score, chunk id) pairs, best first. """
+        n = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM recall_chunk").fetchone()[0]
+        n = min(n, self.rows(self.vectors_path, self.row_size))
+        if n == 0 or self.state('embedder') != self.identity:
+            return []
+        q = self.embedder.embed([query])[0]
+        vectors = self.vectors(n)
+
+        generation = self.generation()
+        if generation is not None:
+            _, centroids, path = generation
+            lists = self.lists(path, n)
+            probes = np.argsort(centroids @ q)[-self.nprobe:]
+            candidates = np.concatenate([np.flatnonzero(np.isin(lists, probes)), np.arange(len(lists), n)])
+        else:
+            candidates = np.arange(n)
+
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for block in range(0, len(candidates), BLOCK):
+            rows = candidates[block:block + BLOCK]
+            scores[block:block + len(rows)] = vectors[rows].astype(np.float32) @ q
+        best = np.argsort(-scores)[:top] if len(scores) <= top else np.argpartition(-scores, top)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), int(candidates[i]) + 1) for i in best]
@@ -0,0 +1,154 @@
+import time
+import struct
+from multiprocessing import shared_memory
+
+from Base import config as cfg
+from Base import metrics
+from Base.scheduler import Scheduler
+from Base.journal import KEY, BUTTON, MOTION, FOCUS, HEADER, CRC, decode, record_size
+from Base.models import Geometry
+
+# header layout; the consumer's read index sits on a cache line of its own
+INDEX = struct.Struct('<Q')
+WRITE = 0
+DROPPED = 8
+CLOSED = 16
+SHAPE = struct.Struct('<II')  # slots, slot size
+SHAPE_AT = 24
+READ = 64
+DATA = 128
+
+
+class RingBuffer:
+    """ A single producer, single consumer queue of journal records in shared memory.
+        The buffer is slots fixed-size slots, a record takes as many consecutive slots as it
+        needs and the last one may wrap to the start. The producer only ever writes the write
+        index and the consumer the read index, both counting slots and never wrapping, and
+        each side publishes its index after it is done with the slots, so no lock is needed.
+        A full ring drops the record and counts it rather than making the producer wait.
+        Without a name a new segment is created, otherwise the named one is attached. """
+
+    def __init__(self, name=None, slots=cfg.RING_SLOTS, slot_size=cfg.RING_SLOT_SIZE):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=DATA + slots * slot_size)
+            self.shm.buf[:DATA] = bytes(DATA)
+            SHAPE.pack_into(self.shm.buf, SHAPE_AT, slots, slot_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.slots, self.slot_size = SHAPE.unpack_from(self.buf, SHAPE_AT)
+        self.size = self.slots * self.slot_size
+        self.taken = self.index(READ)  # read index after the last get()
+
+    def index(self, at):
+        return INDEX.unpack_from(self.buf, at)[0]
+
+    def used(self):
+        return self.index(WRITE) - self.index(READ)
+
+    def dropped(self):
+        return self.index(DROPPED)
+
+    def closed(self):
+        return self.buf[CLOSED] == 1
+
+    def close_writer(self):
+        """ Tells the consumer that nothing follows the records in the ring. """
+        self.buf[CLOSED] = 1
+
+    def put(self, record):
+        """ Copies one record into the ring. Returns False if it did not fit. """
+        count = -(-len(record) // self.slot_size)
+        write = self.index(WRITE)
+        if write + count - self.index(READ) > self.slots:
+            INDEX.pack_into(self.buf, DROPPED, self.index(DROPPED) + 1)
+            return False
+        start = (write % self.slots) * self.slot_size
+        head = min(len(record), self.size - start)
+        self.buf[DATA + start:DATA + start + head] = record[:head]
+        if head < len(record):
+            self.buf[DATA:DATA + len(record) - head] = record[head:]
+        INDEX.pack_into(self.buf, WRITE, write + count)
+        return True
+
+    def get(self, limit=cfg.RING_READ_BATCH):
+        """ Copies up to limit records out of the ring, oldest first. They keep their slots
+            until release(), so a consumer that dies before it stored them does not lose them. """
+        read = self.index(READ)
+        write = self.index(WRITE)
+        records = []
+        while read < write and len(records) < limit:
+            start = DATA + (read % self.slots) * self.slot_size
+            length = record_size(self.buf, start)  # the header never wraps, slots are larger
+            head = min(length, DATA + self.size - start)
+            record = bytes(self.buf[start:start + head])
+            if head < length:
+                record += bytes(self.buf[DATA:DATA + length - head])
+            records.append(record)
+            read += -(-length // self.slot_size)
+        self.taken = read
+        return records
+
+    def release(self):
+        """ Gives the slots of the records returned by the last get() back to the producer. """
+        INDEX.pack_into(self.buf, READ, self.taken)
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class RingSource:
+    """ Event source of a persistence process, in place of sniff_x.Sniffer.
+        Records from the ring go to records_hook as they are, a batch at a time, when it is
+        set, or else are decoded and passed to the usual hooks. Their slots are released
+        only after that, so a restarted process takes up a batch the dead one had not stored,
+        at the risk of storing part of it twice. Focus changes are also handed to the capture
+        worker, which takes the screenshots in this process. run() returns once the
+        producer closed the ring and every record in it is handled. """
+
+    def __init__(self, ring, capture=None, interval=cfg.RING_POLL_INTERVAL):
+        self.ring = ring
+        self.capture = capture
+        self.interval = interval
+        self.key_hook = lambda *args: True
+        self.mouse_button_hook = lambda *args: True
+        self.mouse_move_hook = lambda *args: True
+        self.screen_hook = lambda *args: True
+        self.records_hook = None
+        self.scheduler = Scheduler()
+        self.running = False
+        metrics.gauge('ring.used', ring.used)
+        metrics.gauge('ring.dropped', ring.dropped)
+
+    def run(self):
+        self.running = True
+        hooks = {KEY: self.key_hook, BUTTON: self.mouse_button_hook, MOTION: self.mouse_move_hook, FOCUS: self.screen_hook}
+        while self.running:
+            self.scheduler.run_due()
+            records = self.ring.get()
+            if not records:
+                if self.ring.closed() and not self.ring.used():
+                    break
+                timeout = self.scheduler.timeout()
+                time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+                continue
+            for record in records:
+                kind = HEADER.unpack_from(record)[1]
+                payload = record[HEADER.size:-CRC.size]
+                if kind == FOCUS and self.capture is not None:
+                    process_name, window_name, x, y, width, height = decode(kind, payload)
+                    self.capture.notify(process_name, window_name, Geometry(x, y, width, height))
+                if self.records_hook is None:
+                    hooks[kind](*decode(kind, payload))
+            if self.records_hook is not None:
+                self.records_hook(records)
+            self.ring.release()
+            metrics.count('ring.records', len(records))
+
+    def cancel(self):
+        self.running = False
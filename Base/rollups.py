@@ -0,0 +1,225 @@
+import sys
+import time
+import sqlite3
+import datetime
+
+from Base import config as cfg
+from Base import models
+from Base import keycodec
+from Base.journal import ingest_horizon, journal_dir
+
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+
+# (column, aggregate) pairs rolled up from each event table
+KEY_COUNTS = [('nr', 'COUNT(*)'),
+              ('keystrokes', f"SUM({keycodec.count_sql('keys.timings')})")]
+CLICK_COUNTS = ([('clicks', 'COUNT(*)'),
+                 ('noscroll_clicks', 'SUM(click.button NOT IN (4, 5))'),
+                 ('mousings', 'SUM(click.nrmoves)')] +
+                [(f'button{button}', f'SUM(click.button = {button})') for button in range(1, 6)])
+COUNT_COLUMNS = [column for column, _ in KEY_COUNTS + CLICK_COUNTS]
+
+
+def floor_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(moment):
+    floor = floor_hour(moment)
+    return floor if floor == moment else floor + HOUR
+
+
+def parse_time(value):
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+
+
+class Rollups:
+    """ Hourly and daily totals per (bucket, process_id, window_id).
+        Every closed hour, one that ended at least lag seconds ago, is rolled up once and
+        the watermark moves past it. Counts are bucketed by the row's created_at, like
+        Baseview filters rows. Active seconds are bucketed by the time of the events, with
+        each merged interval split exactly at the hour edges, so an hour also holds time made
+        active by events of the hour before and none of the time its last events make active
+        after it; Baseview takes both edges of a range from the event rows. Active periods of
+        different groups overlap and cannot be added up, so they are kept in their own rows,
+        one per window title (process_id 0 and the lowest window_id with that title), one per
+        process (window_id 0) and one in total (both ids 0). Day rows are sums of their
+        hours. The daemon and Baseview both update, so a step reads the watermark after it
+        takes the write lock and replaces the hour rows it covers instead of adding to them.
+        Events still waiting in the journal hold the watermark back. """
+
+    def __init__(self, db_name, conn=None, cutoff=cfg.ROLLUP_ACTIVE_CUTOFF, lag=cfg.ROLLUP_LAG,
+                 interval=cfg.ROLLUP_INTERVAL):
+        self.db_name = db_name
+        self.conn = conn
+        self.cutoff = cutoff
+        self.lag = lag
+        self.interval = interval  # seconds between two step() calls in the daemon
+
+    def watermark(self):
+        row = self.conn.execute("SELECT value FROM rollup_state WHERE name = 'watermark'").fetchone()
+        return parse_time(row[0]) if row else None
+
+    def first_hour(self):
+        first = [row[0] for row in self.conn.execute(
+            "SELECT MIN(created_at) FROM keys UNION ALL SELECT MIN(created_at) FROM click") if row[0]]
+        return floor_hour(min(parse_time(value) for value in first)) if first else None
+
+    def update(self, now=None):
+        """ Rolls up every closed hour after the watermark, a day at a time. """
+        now = now or datetime.datetime.now()
+        horizon = ingest_horizon(self.conn, journal_dir(self.db_name))
+        if horizon is not None:
+            now = min(now, horizon)
+        end = floor_hour(now - datetime.timedelta(seconds=self.lag))
+        if self.conn.in_transaction:
+            self.conn.commit()
+        while True:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                start = self.watermark() or self.first_hour()
+                if start is None or start >= end:
+                    return
+                stop = min(start + DAY, end)
+                self.materialize(start, stop)
+
+    def materialize(self, start, stop):
+        """ Writes the rollups of [start, stop) and moves the watermark, inside the caller's transaction. """
+        active = self.active_seconds(start, stop)
+        self.conn.execute("DELETE FROM rollup WHERE level = 'hour' AND bucket >= ? AND bucket < ?", (start, stop))
+        for table, counts in (('keys', KEY_COUNTS), ('click', CLICK_COUNTS)):
+            columns = ', '.join(column for column, _ in counts)
+            self.conn.execute(f"""
+                INSERT INTO rollup (level, bucket, process_id, window_id, {columns})
+                SELECT 'hour', strftime('%Y-%m-%d %H:00:00', created_at), process_id, window_id,
+                       {', '.join(aggregate for _, aggregate in counts)}
+                FROM {table} WHERE created_at >= ? AND created_at < ?
+                GROUP BY 2, 3, 4
+                ON CONFLICT (level, bucket, process_id, window_id) DO UPDATE SET
+                {', '.join(f'{column} = {column} + excluded.{column}' for column, _ in counts)}
+            """, (start, stop))
+        self.conn.executemany("""
+            INSERT INTO rollup (level, bucket, process_id, window_id, active) VALUES ('hour', ?, ?, ?, ?)
+            ON CONFLICT (level, bucket, process_id, window_id) DO UPDATE SET active = active + excluded.active
+        """, active)
+
+        # rebuild the days the hours belong to
+        first_day = datetime.datetime.combine(start.date(), datetime.time())
+        last_day = datetime.datetime.combine((stop - HOUR).date(), datetime.time()) + DAY
+        sums = ', '.join(f'SUM({column})' for column in COUNT_COLUMNS + ['active'])
+        self.conn.execute("DELETE FROM rollup WHERE level = 'day' AND bucket >= ? AND bucket < ?",
+                          (first_day, last_day))
+        self.conn.execute(f"""
+            INSERT INTO rollup (level, bucket, process_id, window_id, {', '.join(COUNT_COLUMNS)}, active)
+            SELECT 'day', substr(bucket, 1, 10) || ' 00:00:00', process_id, window_id, {sums}
+            FROM rollup WHERE level = 'hour' AND bucket >= ? AND bucket < ?
+            GROUP BY 2, 3, 4
+        """, (first_day, last_day))
+        self.conn.execute("""
+            INSERT INTO rollup_state (name, value) VALUES ('watermark', ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (stop,))
+
+    def events(self, start, stop):
+        """ Epoch times, process ids and window ids of the events that can be active in [start, stop). """
+        import numpy as np
+
+        lookback = start - datetime.timedelta(seconds=self.cutoff)
+        times, processes, windows = [], [], []
+        # a key sequence is stored when it ends, so its first keys may lie in an earlier hour
+        rows = self.conn.execute("""
+            SELECT process_id, window_id, created_at, timings FROM keys
+            WHERE created_at >= ? AND created_at < ? AND started < ?
+        """, (lookback, stop + datetime.timedelta(seconds=self.lag), stop)).fetchall()
+        if rows:
+            intervals, offsets = keycodec.decode_timings_batch([row[3] for row in rows])
+            created = keycodec.epoch_seconds([row[2] for row in rows])
+            times.append(keycodec.create_times_batch(created, intervals, offsets))
+            per_row = np.diff(offsets) + 1
+            processes.append(np.repeat([row[0] for row in rows], per_row))
+            windows.append(np.repeat([row[1] for row in rows], per_row))
+        rows = self.conn.execute("SELECT process_id, window_id, created_at FROM click WHERE created_at >= ? AND created_at < ?",
+                                 (lookback, stop)).fetchall()
+        if rows:
+            times.append(keycodec.epoch_seconds([row[2] for row in rows]))
+            processes.append(np.array([row[0] for row in rows]))
+            windows.append(np.array([row[1] for row in rows]))
+        if not times:
+            return None
+        return np.concatenate(times), np.concatenate(processes).astype(np.int64), np.concatenate(windows).astype(np.int64)
+
+    def active_seconds(self, start, stop):
+        """ (bucket, process_id, window_id, seconds) rows for the hours in [start, stop). """
+        import numpy as np
+        from Base.intervals import group_merge, merge
+
+        events = self.events(start, stop)
+        if events is None:
+            return []
+        times, processes, windows = events
+        hours = []
+        moment = start
+        while moment < stop:
+            hours.append(moment)
+            moment += HOUR
+        edges = [time.mktime(hour.timetuple()) for hour in hours] + [time.mktime(stop.timetuple())]
+        buckets = [hour.strftime('%Y-%m-%d %H:00:00') for hour in hours]
+
+        rows = []
+        titles = self.title_ids(windows)
+        keys, starts, ends = group_merge(titles, times, self.cutoff)
+        rows += self.split(np.zeros_like(keys), keys, starts, ends, edges, buckets)
+        keys, starts, ends = group_merge(processes, times, self.cutoff)
+        rows += self.split(keys, np.zeros_like(keys), starts, ends, edges, buckets)
+        starts, ends = merge(times, self.cutoff)
+        rows += self.split(np.zeros(len(starts), dtype=np.int64), np.zeros(len(starts), dtype=np.int64),
+                           starts, ends, edges, buckets)
+        return rows
+
+    def title_ids(self, windows):
+        """ Maps every window id to the lowest id with the same title, Baseview groups windows by title. """
+        import numpy as np
+
+        unique, inverse = np.unique(windows, return_inverse=True)
+        canonical = dict(self.conn.execute(f"""
+            SELECT window.id, (SELECT MIN(other.id) FROM window AS other WHERE other.title = window.title)
+            FROM window WHERE window.id IN ({','.join(str(int(window_id)) for window_id in unique)})
+        """).fetchall())
+        return np.array([canonical.get(int(window_id), int(window_id)) for window_id in unique],
+                        dtype=np.int64)[inverse.reshape(-1)]
+
+    @staticmethod
+    def split(processes, windows, starts, ends, edges, buckets):
+        import numpy as np
+        from Base.intervals import bucket_overlaps
+
+        overlaps = bucket_overlaps(starts, ends, edges)
+        pairs, group = np.unique(np.stack((processes, windows), axis=1), axis=0, return_inverse=True)
+        totals = np.zeros((len(pairs), len(buckets)))
+        np.add.at(totals, group.reshape(-1), overlaps)
+        return [(buckets[b], int(pairs[g, 0]), int(pairs[g, 1]), float(totals[g, b]))
+                for g, b in zip(*np.nonzero(totals))]
+
+    def ranges(self, start, end):
+        """ A WHERE clause and parameters selecting [start, end) with as many day buckets as possible.
+            start and end must be whole hours. """
+        first_day = datetime.datetime.combine(start.date(), datetime.time())
+        if first_day < start:
+            first_day += DAY
+        last_day = datetime.datetime.combine(end.date(), datetime.time())
+        if first_day >= last_day:
+            return "level = 'hour' AND bucket >= ? AND bucket < ?", [start, end]
+        return ("(level = 'day' AND bucket >= ? AND bucket < ?) OR "
+                "(level = 'hour' AND ((bucket >= ? AND bucket < ?) OR (bucket >= ? AND bucket < ?)))",
+                [first_day, last_day, start, first_day, last_day, end])
+
+    def step(self):
+        """ Brings the rollups up to date on a connection of its own. """
+        self.conn = models.initialize(self.db_name)
+        try:
+            self.update()
+        except sqlite3.Error as e:
+            print(f'Could not update the rollups: {e}', file=sys.stderr)
+        finally:
+            self.conn.close()
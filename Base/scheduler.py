@@ -0,0 +1,100 @@
+import sys
+import time
+import heapq
+import queue
+import select
+import threading
+
+from Base import metrics
+
+
+class Scheduler:
+    """ Timers for an event loop that must never sleep past them.
+        The loop waits with wait(), a select() on its file descriptor that returns when the
+        descriptor is readable or the next timer is due, and calls run_due() every time
+        around. Callbacks run on the loop's thread, so they must be quick; slow jobs are
+        handed to a Housekeeping thread instead. """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.timers = []
+        self.added = 0
+
+    def every(self, interval, callback, name=None, delay=None):
+        """ Calls callback every interval seconds, the first time after delay seconds, which defaults to interval. """
+        self.added += 1
+        heapq.heappush(self.timers, (self.clock() + (interval if delay is None else delay), self.added,
+                                     interval, name or callback.__name__, callback))
+
+    def timeout(self):
+        """ Seconds until the next timer is due, None if there is none. """
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - self.clock())
+
+    def run_due(self):
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            due, added, interval, name, callback = heapq.heappop(self.timers)
+            started = time.perf_counter()
+            try:
+                callback()
+            except Exception as e:
+                print(f'Timer {name} failed: {e}', file=sys.stderr)
+            metrics.observe(f'timer.{name}', time.perf_counter() - started)
+            # a late timer is not run several times to catch up
+            heapq.heappush(self.timers, (max(due + interval, now), added, interval, name, callback))
+
+    def wait(self, fileno, limit=None):
+        """ Blocks until fileno is readable or a timer is due, at most limit seconds. Returns True if readable. """
+        timeout = self.timeout()
+        if limit is not None:
+            timeout = limit if timeout is None else min(timeout, limit)
+        readable, _, _ = select.select([fileno], [], [], timeout)
+        return bool(readable)
+
+
+class Housekeeping:
+    """ Runs slow periodic jobs, like the Parquet rollover and the rollups, one after the
+        other on a thread of its own. Timers only queue them, and a job that is still waiting
+        or running is not queued a second time. """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.busy = set()
+        self.thread = threading.Thread(target=self.run, name='housekeeping', daemon=True)
+
+    def submit(self, name, job):
+        if name in self.busy:
+            return
+        self.busy.add(name)
+        self.queue.put((name, job))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, job = item
+            started = time.perf_counter()
+            try:
+                job()
+            except Exception as e:
+                print(f'Housekeeping job {name} failed: {e}', file=sys.stderr)
+            finally:
+                self.busy.discard(name)
+            metrics.observe(f'housekeeping.{name}', time.perf_counter() - started)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        """ Stops after the job that is running, queued jobs are skipped. """
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.queue.put(None)
+        if self.thread.is_alive():
+            self.thread.join()
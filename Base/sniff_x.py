@@ -1,11 +1,14 @@
 import sys
+import time
 import datetime
-from PIL import ImageGrab
-from Xlib import X, XK, display
+from Xlib import X, display
 from Xlib.ext import record
-from Xlib.error import XError
+from Xlib.error import XError, CatchError
 from Xlib.protocol import rq
 
+from Base import metrics
+from Base.keysyms import KEYSYMS
+from Base.scheduler import Scheduler
 from Base.models import Process, Window, Geometry, Click, Keys, Activity, Screenshot
 
 def state_to_idx(state):  # this could be a dict, but I might want to extend it.
@@ -18,12 +21,20 @@ def state_to_idx(state):  # this could be a dict, but I might want to extend it.
     return 0
 
 
+# metric names of the event handling durations, by X event type
+EVENT_METRICS = {X.KeyPress: 'event.key_press',
+                 X.ButtonPress: 'event.button_press',
+                 X.MotionNotify: 'event.motion',
+                 X.MappingNotify: 'event.mapping',
+                 X.FocusIn: 'event.focus',
+                 X.FocusOut: 'event.focus',
+                 X.PropertyNotify: 'event.property',
+                 X.ConfigureNotify: 'event.configure'}
+
+
 class Sniffer:
-    def __init__(self, db_conn):
-        self.keysymdict = {}
-        for name in dir(XK):
-            if name.startswith("XK_"):
-                self.keysymdict[getattr(XK, name)] = name[3:]
+    def __init__(self, capture=None):
+        self.keysymdict = KEYSYMS
 
         self.key_hook = lambda x: True
         self.mouse_button_hook = lambda x: True
@@ -37,19 +48,32 @@ class Sniffer:
 
         self.atom_NET_WM_NAME = self.the_display.intern_atom('_NET_WM_NAME')
         self.atom_UTF8_STRING = self.the_display.intern_atom('UTF8_STRING')
-        
-        self.db_conn = db_conn
-        self.last_screenshot_hash = None
+        self.windows = WindowCache(self)
+
+        self.capture = capture
+        self.last_context = None
+        self.scheduler = Scheduler()
+        self.running = False
 
     def run(self):
-        while True:
-            event = self.the_display.next_event()
-            self.process_event(event)
+        """ Handles the events queued on the X connection, runs the timers that are due and
+            then waits for whichever comes first, more events or the next timer. """
+        self.running = True
+        while self.running:
+            while self.the_display.pending_events():
+                self.process_event(self.the_display.next_event())
+            self.scheduler.run_due()
+            if self.running:
+                self.scheduler.wait(self.the_display.fileno())
+
+    def cancel(self):
+        self.running = False
 
     def process_event(self, event):
-        cur_class, cur_window, cur_name = self.get_cur_window()
+        started = time.perf_counter()
+        self.windows.handle_event(event)
+        cur_class, cur_window, cur_name, cur_geo = self.windows.current()
         if cur_class:
-            cur_geo = self.get_geometry(cur_window)
             if cur_geo:
                 self.screen_hook(cur_class,
                                  cur_name,
@@ -57,16 +81,12 @@ class Sniffer:
                                  cur_geo.ypos,
                                  cur_geo.width,
                                  cur_geo.height)
-                                 
-                screenshot = ImageGrab.grab()
-                screenshot_hash = hash(screenshot.tobytes())
-                if screenshot_hash != self.last_screenshot_hash:
-                    self.last_screenshot_hash = screenshot_hash
-                    # Save screenshot to database
-                    process_id = self.get_process_id(cur_class)
-                    window_id = self.get_window_id(cur_name, process_id)
-                    geometry_id = self.save_geometry(cur_geo)
-                    self.save_screenshot(process_id, window_id, geometry_id, screenshot)
+
+                # screenshots are taken by the capture worker, only tell it what changed
+                context = (cur_class, cur_name, cur_geo.xpos, cur_geo.ypos, cur_geo.width, cur_geo.height)
+                if self.capture is not None and context != self.last_context:
+                    self.last_context = context
+                    self.capture.notify(cur_class, cur_name, cur_geo)
 
         if event.type in [X.KeyPress]:
             self.key_hook(*self.key_event(event))
@@ -79,12 +99,13 @@ class Sniffer:
             newkeymap = self.the_display._keymap_codes
             print('Change keymap!', newkeymap == self.keymap)
             self.keymap = newkeymap
+        metrics.observe(EVENT_METRICS.get(event.type, 'event.other'), time.perf_counter() - started)
 
     def get_key_name(self, keycode, state):
         state_idx = state_to_idx(state)
         cn = self.keymap[keycode][state_idx]
         if cn < 256:
-            return chr(cn).decode('latin1')
+            return chr(cn)  # latin1 keysyms are their code points
         else:
             return self.lookup_keysym(cn)
 
@@ -170,38 +191,84 @@ class Sniffer:
             except XError:
                 i += 1
         return Geometry(geo.x, geo.y, geo.width, geo.height) if geo else None
-    
-    def get_process_id(self, process_name):
-        process = self.db_conn.execute("SELECT id FROM process WHERE name = ?", (process_name,)).fetchone()
-        if process:
-            return process[0]
-        else:
-            self.db_conn.execute("INSERT INTO process (name) VALUES (?)", (process_name,))
-            self.db_conn.commit()
-            return self.db_conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-    def get_window_id(self, window_title, process_id):
-        window = self.db_conn.execute("SELECT id FROM window WHERE title = ? AND process_id = ?", 
-                                      (window_title, process_id)).fetchone()
-        if window:
-            return window[0]
-        else:
-            self.db_conn.execute("INSERT INTO window (title, process_id) VALUES (?, ?)", 
-                                 (window_title, process_id))
-            self.db_conn.commit()
-            return self.db_conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-    def save_geometry(self, geometry):
-        self.db_conn.execute("""
-            INSERT INTO geometry (xpos, ypos, width, height) 
-            VALUES (?, ?, ?, ?)
-        """, (geometry.xpos, geometry.ypos, geometry.width, geometry.height))
-        self.db_conn.commit()
-        return self.db_conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-    def save_screenshot(self, process_id, window_id, geometry_id, screenshot):
-        self.db_conn.execute("""
-            INSERT INTO screenshot (process_id, window_id, geometry_id, image)
-            VALUES (?, ?, ?, ?)
-        """, (process_id, window_id, geometry_id, screenshot.tobytes()))
-        self.db_conn.commit()
\ No newline at end of file
+
+
+class WindowCache:
+    """ Keeps class, title and geometry of the focused window in memory.
+        Focus, property and configure events on the root and the focused window mark
+        parts of the state stale, and only those parts are asked from the X server again
+        on the next call to current(). Without such events current() costs no round trip. """
+
+    def __init__(self, sniffer):
+        self.sniffer = sniffer
+        self.the_display = sniffer.the_display
+        self.root = self.the_display.screen().root
+
+        self.atom_NET_ACTIVE_WINDOW = self.the_display.intern_atom('_NET_ACTIVE_WINDOW')
+        self.name_atoms = {sniffer.atom_NET_WM_NAME, self.the_display.intern_atom('WM_NAME')}
+        self.atom_WM_CLASS = self.the_display.intern_atom('WM_CLASS')
+
+        self.root.change_attributes(event_mask=X.PropertyChangeMask | X.FocusChangeMask)
+
+        self.window = None
+        self.cur_class = None
+        self.cur_name = None
+        self.geometry = None
+
+        self.focus_dirty = True
+        self.name_dirty = True
+        self.geometry_dirty = True
+
+    def handle_event(self, event):
+        if event.type in (X.FocusIn, X.FocusOut):
+            self.focus_dirty = True
+        elif event.type == X.PropertyNotify:
+            if event.atom == self.atom_NET_ACTIVE_WINDOW or event.atom == self.atom_WM_CLASS:
+                self.focus_dirty = True
+            elif event.atom in self.name_atoms and self.is_watched(event.window):
+                self.name_dirty = True
+        elif event.type == X.ConfigureNotify and self.is_watched(event.window):
+            self.geometry = Geometry(event.x, event.y, event.width, event.height)
+        elif event.type in (X.DestroyNotify, X.UnmapNotify) and self.is_watched(event.window):
+            self.focus_dirty = True
+
+    def is_watched(self, window):
+        return self.window is not None and window is not None and window.id == self.window.id
+
+    def watch(self, window):
+        if self.is_watched(window):
+            return
+        ec = CatchError()
+        if self.window is not None:
+            self.window.change_attributes(event_mask=X.NoEventMask, onerror=ec)
+        window.change_attributes(event_mask=X.PropertyChangeMask | X.StructureNotifyMask | X.FocusChangeMask,
+                                 onerror=ec)
+        self.window = window
+
+    def current(self):
+        """ Returns class, window, title and geometry of the focused window. """
+        if self.name_dirty and not self.focus_dirty:
+            started = time.perf_counter()
+            try:
+                self.cur_name = self.sniffer.get_wm_name(self.window) or ''
+                self.name_dirty = False
+            except XError:
+                self.focus_dirty = True
+            metrics.observe('x.name', time.perf_counter() - started)
+
+        if self.focus_dirty:
+            started = time.perf_counter()
+            self.cur_class, window, self.cur_name = self.sniffer.get_cur_window()
+            if window is not None and self.cur_class:
+                self.watch(window)
+            self.focus_dirty = False
+            self.name_dirty = False
+            self.geometry_dirty = True
+            metrics.observe('x.focus', time.perf_counter() - started)
+
+        if self.geometry_dirty and self.cur_class:
+            started = time.perf_counter()
+            self.geometry = self.sniffer.get_geometry(self.window)
+            self.geometry_dirty = False
+            metrics.observe('x.geometry', time.perf_counter() - started)
+        return self.cur_class, self.window, self.cur_name, self.geometry
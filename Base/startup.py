@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import builtins
+
+TOP_IMPORTS = 15  # slowest modules listed in the report
+
+
+def process_age():
+    """ Seconds since the process was started, to 10 ms or so. None where /proc is missing. """
+    try:
+        with open('/proc/self/stat') as f:
+            started = int(f.read().rsplit(')', 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupProfile:
+    """ Times the phases of a start and the modules first imported during them, for
+        --startup-profile. A module's time includes the modules it imports in turn. What
+        happened before the profile was created, interpreter start and the imports at the
+        top of the entry point, is reported as one phase. """
+
+    def __init__(self):
+        age = process_age()
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = [('interpreter and entry point imports', age)] if age is not None else []
+        self.imports = {}
+        self.original_import = None
+
+    def watch_imports(self):
+        original = self.original_import = builtins.__import__
+        imports = self.imports
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            new = name if name not in sys.modules else next(
+                (f'{name}.{item}' for item in fromlist or () if f'{name}.{item}' not in sys.modules), None)
+            if level or new is None:
+                return original(name, globals, locals, fromlist, level)
+            started = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                imports.setdefault(new, time.perf_counter() - started)
+
+        builtins.__import__ = timed_import
+
+    def phase(self, name):
+        """ Ends the phase that started with the previous call. """
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self, file=sys.stderr):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+        total = sum(seconds for _, seconds in self.phases)
+        print(f'Startup took {total * 1e3:.1f} ms', file=file)
+        for name, seconds in self.phases:
+            print(f'  {name:<40} {seconds * 1e3:>8.1f} ms', file=file)
+        if self.imports:
+            print(f'Slowest imports after the entry point, of {len(self.imports)}', file=file)
+            for name, seconds in sorted(self.imports.items(), key=lambda item: -item[1])[:TOP_IMPORTS]:
+                print(f'  {name:<40} {seconds * 1e3:>8.1f} ms', file=file)
@@ -4,17 +4,24 @@ import sys
 import re
 import datetime
 import time
+import sqlite3
+from itertools import islice
 from collections import Counter
 from typing import Optional, Union, List, Tuple
 
 import argparse
 import configparser
 
+from Base import config as cfg
+from Base import keycodec
 from Base import models
-from Base.period import Period
+from Base.startup import StartupProfile
+from Base.trigrams import TrigramIndex, fts_query
+from Base.rollups import Rollups, COUNT_COLUMNS, KEY_COUNTS, CLICK_COUNTS, HOUR, floor_hour, ceil_hour
+from Base.materialize import ActivityMaterializer, epoch
 
-import codecs
-sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(encoding='utf8')
 
 ACTIVE_SECONDS = 180
 PERIOD_LOOKUP = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
@@ -24,12 +31,27 @@ SUMMARY_ACTIONS = ACTIVITY_ACTIONS.union({'pkeys', 'tkeys', 'key_freqs', 'clicks
 PROCESS_ACTIONS = {'pkeys', 'pactive'}
 WINDOW_ACTIONS = {'tkeys', 'tactive'}
 
+ROW_BATCH = 5000  # rows decoded together in summaries
+
+# keys_fts only indexes the hot tier, temp.cold_fts the cold rows attached to this query
+TEXT_MATCH = ('keys.id IN (SELECT rowid FROM keys_fts WHERE keys_fts MATCH ? '
+              'UNION ALL SELECT rowid FROM temp.cold_fts WHERE cold_fts MATCH ?)')
+
 BUTTON_MAP = [('button1', 'left'),
               ('button2', 'middle'),
               ('button3', 'right'),
               ('button4', 'up'),
               ('button5', 'down')]
 
+KEY_AGGREGATES = ', '.join(f'{aggregate} AS {column}' for column, aggregate in KEY_COUNTS)
+CLICK_AGGREGATES = ', '.join(f'{aggregate} AS {column}' for column, aggregate in CLICK_COUNTS)
+
+# filters the rollups cannot answer
+RAW_ONLY = ['process', 'title', 'body', 'search', 'min_keys', 'key_freqs', 'periods']
+# filters the activity table cannot answer, --key-freqs needs the key rows it would skip
+ACTIVITY_RAW_ONLY = ['body', 'search', 'min_keys', 'key_freqs']
+EPOCH = datetime.datetime(1970, 1, 1)
+
 
 def pretty_seconds(secs: int) -> str:
     secs = int(secs)
@@ -121,7 +143,7 @@ def make_time_string(dates: Optional[Union[List[str], str]], clock: Optional[str
     return now.strftime('%Y-%m-%d %H:%M'), now
 
 
-def make_period(q, period: Union[List[str], str], who: str, start: Optional[datetime.datetime], prop):
+def parse_period(period: Union[List[str], str], who: str) -> datetime.timedelta:
     if isinstance(period, list) and len(period) > 0:
         if isinstance(period[0], str):
             periodstr = "".join(period)
@@ -147,34 +169,117 @@ def make_period(q, period: Union[List[str], str], who: str, start: Optional[date
             print(f'--limit unit "{period[1]}" not one of {list(PERIOD_LOOKUP.keys())}')
             sys.exit(1)
         d[PERIOD_LOOKUP[period[1]]] = val
+    return datetime.timedelta(**d)
 
+
+def make_period(q, period: Union[List[str], str], who: str, start: Optional[datetime.datetime], prop):
+    delta = parse_period(period, who)
     if start:
-        return q.filter(prop <= start + datetime.timedelta(**d))
+        return q.filter(f'{prop} <= ?', start + delta)
     else:
-        start = datetime.datetime.now() - datetime.timedelta(**d)
-        return q.filter(prop >= start), start
+        start = datetime.datetime.now() - delta
+        return q.filter(f'{prop} >= ?', start), start
+
+
+def parse_time(value) -> datetime.datetime:
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
 
 
 def create_times(row) -> List[float]:
-    current_time = time.mktime(row.created_at.timetuple())
+    current_time = time.mktime(parse_time(row['created_at']).timetuple())
     abs_times = [current_time]
-    for t in row.load_timings():
+    for t in keycodec.decode_timings(row['timings']):
         current_time -= t
         abs_times.append(current_time)
     abs_times.reverse()
     return abs_times
 
 
+def regexp(pattern, text) -> bool:
+    """ SQLite's REGEXP operator, case insensitive like the other Baseview filters. """
+    return text is not None and re.search(pattern, text, re.I) is not None
+
+
+def batches(rows, size=ROW_BATCH):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Query:
+    """ A SELECT over one event table, joined with the process and window names. """
+
+    def __init__(self, table: str):
+        self.table = table
+        self.source = table  # a view over both storage tiers once cold rows are attached
+        self.clauses = []
+        self.params = []
+
+    def filter(self, clause: str, *params):
+        self.clauses.append(clause)
+        self.params.extend(params)
+        return self
+
+    def sql(self, columns: str) -> Tuple[str, list]:
+        where = f"WHERE {' AND '.join(self.clauses)}" if self.clauses else ''
+        return f"""
+            SELECT {columns}, process.name AS process, window.title AS title
+            FROM {self.from_clause()}
+            JOIN process ON process.id = {self.table}.process_id
+            JOIN window ON window.id = {self.table}.window_id
+            {where}
+            ORDER BY {self.table}.id
+        """, self.params
+
+    def copy(self) -> 'Query':
+        q = Query(self.table)
+        q.source = self.source
+        q.clauses = list(self.clauses)
+        q.params = list(self.params)
+        return q
+
+    def from_clause(self) -> str:
+        return self.table if self.source == self.table else f'{self.source} AS {self.table}'
+
+    def aggregate(self, columns: str, group: Optional[Tuple[str, str]] = None) -> Tuple[str, list]:
+        """ A SELECT of aggregate columns, grouped by a name column such as ('process', 'name').
+            Only the table that is grouped by is joined, and groups come in order of first appearance. """
+        where = f"WHERE {' AND '.join(self.clauses)}" if self.clauses else ''
+        if group is None:
+            return f"SELECT {columns} FROM {self.from_clause()} {where}", self.params
+        table, column = group
+        return f"""
+            SELECT {table}.{column} AS name, {columns}
+            FROM {self.from_clause()}
+            JOIN {table} ON {table}.id = {self.table}.{table}_id
+            {where}
+            GROUP BY {table}.{column}
+            ORDER BY MIN({self.table}.id)
+        """, self.params
+
+
 class Selfstats:
     def __init__(self, db_name: str, args: argparse.Namespace):
         self.args = args
+        self.db_name = db_name
         self.conn = models.initialize(db_name)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function('regexp', 2, regexp, deterministic=True)
+        self.trigrams = TrigramIndex(self.conn)
+        self.text_index = models.add_text_index(self.conn)
+        self.rollups = Rollups(db_name, self.conn)
         self.inmouse = False
+        self.cold = False  # whether rows of the Parquet cold tier are attached
 
         self.check_needs()
 
     def do(self):
-        if self.need_summary:
+        if self.args['recall'] is not None:
+            self.show_recall()
+        elif self.need_summary:
             self.calc_summary()
             self.show_summary()
         else:
@@ -209,144 +314,316 @@ class Selfstats:
         if any(self.args[k] for k in SUMMARY_ACTIONS):
             self.need_summary = True
 
-    def maybe_reg_filter(self, q, name: str, names: str, table, source_prop: str, target_prop):
+    def maybe_reg_filter(self, q, name: str, names: str, table, target_prop):
         if self.args[name] is not None:
-            ids = []
             try:
-                reg = re.compile(self.args[name], re.I)
+                re.compile(self.args[name], re.I)
             except re.error as e:
                 print(f'Error in regular expression {str(e)}')
                 sys.exit(1)
 
-            for x in self.conn.execute(f"SELECT * FROM {table}").fetchall():
-                if reg.search(getattr(x, source_prop)):
-                    ids.append(x.id)
+            matched = f'matched_{table}'
+            found = self.trigrams.match(table, self.args[name], matched)
             if not self.inmouse:
-                print(f'{len(ids)} {names} matched')
-            if ids:
-                q = q.filter(target_prop.in_(ids))
+                print(f'{found} {names} matched')
+            if found:
+                q = q.filter(f"{target_prop} IN (SELECT id FROM temp.{matched})")
             else:
                 return q, False
         return q, True
 
     def filter_prop(self, prop, startprop):
-        q = self.conn.table(prop).order_by(prop.id)
+        q = Query(prop)
+        startprop = f'{prop}.{startprop}'
+        self.time_range = (None, None)
 
         if self.args['date'] or self.args['clock']:
             s, start = make_time_string(self.args['date'], self.args['clock'])
-            q = q.filter(prop.created_at >= s)
+            q = q.filter(f'{prop}.created_at >= ?', s)
+            self.time_range = (datetime.datetime.strptime(s, '%Y-%m-%d %H:%M'), None)
             if self.args['limit'] is not None:
                 q = make_period(q, self.args['limit'], '--limit', start, startprop)
+                self.time_range = (self.time_range[0], start + parse_period(self.args['limit'], '--limit'))
         elif self.args['id'] is not None:
-            q = q.filter(prop.id >= self.args['id'])
+            q = q.filter(f'{prop}.id >= ?', self.args['id'])
+            self.time_range = None
             if self.args['limit'] is not None:
-                q = q.filter(prop.id < self.args['id'] + int(self.args['limit'][0]))
+                q = q.filter(f'{prop}.id < ?', self.args['id'] + int(self.args['limit'][0]))
         elif self.args['back'] is not None:
             q, start = make_period(q, self.args['back'], '--back', None, startprop)
+            self.time_range = (start, None)
             if self.args['limit'] is not None:
                 q = make_period(q, self.args['limit'], '--limit', start, startprop)
+                self.time_range = (start, start + parse_period(self.args['limit'], '--limit'))
 
-        q, found = self.maybe_reg_filter(q, 'process', 'process(es)', 'process', 'name', prop.process_id)
+        q, found = self.maybe_reg_filter(q, 'process', 'process(es)', 'process', f'{prop}.process_id')
         if not found:
             return None
 
-        q, found = self.maybe_reg_filter(q, 'title', 'title(s)', 'window', 'title', prop.window_id)
+        q, found = self.maybe_reg_filter(q, 'title', 'title(s)', 'window', f'{prop}.window_id')
         if not found:
             return None
 
         return q
 
-    def filter_keys(self):
+    def keys_query(self):
         q = self.filter_prop('keys', 'started')
         if q is None:
-            return
+            return None
 
         if self.args['min_keys'] is not None:
-            q = q.filter(models.Keys.nrkeys >= self.args['min_keys'])
+            q = q.filter('keys.nrkeys >= ?', self.args['min_keys'])
+
+        if self.args['search']:
+            if not self.text_index:
+                print('--search needs SQLite with FTS5 and its trigram tokenizer')
+                sys.exit(1)
+            try:
+                self.conn.execute("SELECT 1 FROM keys_fts WHERE keys_fts MATCH ? LIMIT 1", (self.args['search'],))
+            except sqlite3.OperationalError as e:
+                print(f'Error in full-text query {str(e)}')
+                sys.exit(1)
+            self.add_cold_text_index()
+            q = q.filter(TEXT_MATCH, self.args['search'], self.args['search'])
 
         if self.args['body']:
             try:
-                bodrex = re.compile(self.args['body'], re.I)
+                re.compile(self.args['body'], re.I)
             except re.error as e:
                 print(f'Error in regular expression {str(e)}')
                 sys.exit(1)
-            for x in q.execute().fetchall():
-                body = x.decrypt_text()
-                if bodrex.search(body):
-                    yield x
-        else:
-            for x in q.execute():
-                yield x
+            # the full-text index narrows the rows, the regular expression decides
+            match = fts_query(self.args['body'])
+            if match and self.text_index:
+                self.add_cold_text_index()
+                q = q.filter(TEXT_MATCH, match, match)
+            q = q.filter('keys.text REGEXP ?', self.args['body'])
+        return q
 
-    def filter_clicks(self):
+    def add_cold_text_index(self):
+        """ An empty index for TEXT_MATCH, filled if cold rows are attached. """
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.cold_fts USING fts5 (text, tokenize='trigram')")
+
+    def attach_cold(self, queries, ranges):
+        """ Lets the queries read the rows in the [start, end) ranges that moved to the Parquet
+            cold tier. DuckDB is only loaded when a range reaches a day that has a partition. """
+        from Base.tiering import parquet_root, partition_days
+
+        root = parquet_root(self.db_name)
+        tables = {q.table for q in queries if q is not None}
+        # keys are selected by when they started, but filed by when they were stored
+        ranges = [(start, end + datetime.timedelta(days=1) if end else None) for start, end in ranges
+                  if not (start and end and start >= end)]
+        if not any((start is None or day >= start.date()) and (end is None or day <= end.date())
+                   for table in tables for day in partition_days(root, table) for start, end in ranges):
+            return
+        from Base.catalog import attach_cold
+
+        views = attach_cold(self.conn, self.db_name, tables, ranges)
+        for q in queries:
+            if q is not None and q.table in views:
+                q.source = views[q.table]
+        if 'keys' in views and self.conn.execute("SELECT 1 FROM temp.sqlite_master WHERE name = 'cold_fts'").fetchone():
+            self.conn.execute("INSERT INTO temp.cold_fts (rowid, text) SELECT id, text FROM temp.cold_keys")
+            self.conn.commit()
+        self.cold = self.cold or bool(views)
+
+    def clicks_query(self):
         self.inmouse = True
-        q = self.filter_prop('click', 'created_at')
+        return self.filter_prop('click', 'created_at')
+
+    def filter_keys(self, q=None, columns='keys.*'):
+        q = q or self.keys_query()
+        if q is None:
+            return
+
+        for x in self.conn.execute(*q.sql(columns)):
+            yield x
+
+    def filter_clicks(self, q=None, columns='click.*'):
+        q = q or self.clicks_query()
         if q is None:
             return
 
-        for x in q.execute():
+        for x in self.conn.execute(*q.sql(columns)):
             yield x
 
+    def aggregate(self, q, columns, sumd, processes, windows):
+        """ Adds the grouped counts of q to the summary, the process and the window dicts. """
+        if q is None:
+            return
+
+        def add(d, row):
+            for key in row.keys():
+                if key != 'name' and row[key]:
+                    d[key] = d.get(key, 0) + row[key]
+
+        add(sumd, self.conn.execute(*q.aggregate(columns)).fetchone())
+        if self.need_process:
+            for row in self.conn.execute(*q.aggregate(columns, ('process', 'name'))):
+                add(processes.setdefault(row['name'], {}), row)
+        if self.need_window:
+            for row in self.conn.execute(*q.aggregate(columns, ('window', 'title'))):
+                add(windows.setdefault(row['name'], {}), row)
+
     def show_rows(self):
-        fkeys = self.filter_keys()
-        rows = 0
+        """ Streams the listing: one joined query read in fetchmany batches of plain tuples,
+            with each batch formatted into a single write. """
+        showtext = self.args['showtext']
         print('<RowID> <Starting date and time> <Duration> <Process> <Window title> <Number of keys pressed>',
-              '<Decrypted text>' if self.args['showtext'] else '')
+              '<Decrypted text>' if showtext else '')
 
-        for row in fkeys:
-            rows += 1
-            print(f"{row.id} {row.started} {pretty_seconds((row.created_at - row.started).total_seconds())} "
-                  f"{row.process.name} \"{row.window.title}\" {row.nrkeys}",
-                  f"{row.decrypt_text().decode('utf8')}" if self.args['showtext'] else '')
+        rows = 0
+        q = self.keys_query()
+        if q is not None:
+            self.attach_cold([q], [self.time_range or (None, None)])
+            cursor = self.conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(*q.sql('keys.id, keys.started, keys.created_at, keys.nrkeys, '
+                                  + ('keys.text' if showtext else "''")))
+            write = sys.stdout.write
+            while True:
+                batch = cursor.fetchmany(ROW_BATCH)
+                if not batch:
+                    break
+                rows += len(batch)
+                write(''.join(
+                    f'{row_id} {started} '
+                    f'{pretty_seconds((parse_time(created_at) - parse_time(started)).total_seconds())} '
+                    f'{process} "{title}" {nrkeys} {text}\n'
+                    for row_id, started, created_at, nrkeys, text, process, title in batch))
         print(f'{rows} rows')
 
-    def calc_summary(self):
-        def updict(d1, d2, activity_times, sub=None):
-            if sub is not None:
-                if sub not in d1:
-                    d1[sub] = {}
-                d1 = d1[sub]
-
-            for key, val in d2.items():
-                d1[key] = d1.get(key, 0) + val
-
-            if self.need_activity:
-                if 'activity' not in d1:
-                    d1['activity'] = Period(self.need_activity, time.time())
-                d1['activity'].extend(activity_times)
+    def show_recall(self):
+        """ Lists the window sessions whose typed text and title come closest to the --recall
+            query, best first. The index is brought up to date first unless the daemon is
+            updating it right now. """
+        from Base.recall import RecallIndex  # numpy, like for the summaries
+
+        index = RecallIndex(self.db_name, self.conn)
+        if not index.update(wait=False):
+            print('The recall index is being updated by Base, the newest text may be missing.', file=sys.stderr)
+        started = time.perf_counter()
+        hits = index.search(self.args['recall'], self.args['recall_top'])
+        elapsed = time.perf_counter() - started
+
+        rows = {row['id']: row for row in self.conn.execute(f"""
+            SELECT recall_chunk.id, recall_chunk.started, recall_chunk.ended, recall_chunk.snippet,
+                   process.name AS process, window.title AS title
+            FROM recall_chunk
+            JOIN process ON process.id = recall_chunk.process_id
+            JOIN window ON window.id = recall_chunk.window_id
+            WHERE recall_chunk.id IN ({', '.join('?' * len(hits))})
+        """, [chunk_id for _, chunk_id in hits])}
+        print('<Score> <Starting date and time> <Duration> <Process> <Window title> <Text>')
+        for score, chunk_id in hits:
+            row = rows[chunk_id]
+            duration = pretty_seconds((parse_time(row['ended']) - parse_time(row['started'])).total_seconds())
+            print(f"{score:.3f} {row['started']} {duration} {row['process']} \"{row['title']}\" {row['snippet']}")
+        print(f'{len(hits)} hits in {elapsed * 1e3:.1f} ms')
 
+    def calc_summary(self):
         sumd = {}
         processes = {}
         windows = {}
-        timings = []
-        keys = Counter()
-        for row in self.filter_keys():
-            d = {'nr': 1,
-                 'keystrokes': len(row.load_timings())}
-
-            if self.need_activity:
-                timings = create_times(row)
-            if self.need_process:
-                updict(processes, d, timings, sub=row.process.name)
-            if self.need_window:
-                updict(windows, d, timings, sub=row.window.title)
-            updict(sumd, d, timings)
 
-            if self.args['key_freqs']:
-                keys.update(row.decrypt_keys())
+        keys_query = self.keys_query()
+        clicks_query = self.clicks_query()
 
-        for click in self.filter_clicks():
-            d = {'noscroll_clicks': click.button not in [4, 5],
-                 'clicks': 1,
-                 f'button{click.button}': 1,
-                 'mousings': click.nrmoves}
+        # whole hours come from the rollups, only the rest of the range from the event rows
+        rollup_range = self.rollup_range()
+        start, end = self.time_range or (None, None)
+        ranges = [(start, end)]
+        if rollup_range:
+            first, last = rollup_range
             if self.need_activity:
-                timings = [time.mktime(click.created_at.timetuple())]
-            if self.need_process:
-                updict(processes, d, timings, sub=click.process.name)
-            if self.need_window:
-                updict(windows, d, timings, sub=click.window.title)
-            updict(sumd, d, timings)
+                # the active time on the edges of the rollup hours comes from the event rows
+                first, last = first + HOUR, last - datetime.timedelta(seconds=self.need_activity)
+            ranges = [(start, first), (last, end)]
+        self.attach_cold((keys_query, clicks_query), ranges)
+        # active time up to the watermark of the activity table comes from its intervals
+        activity_range = self.activity_range() if keys_query is not None else None
+        active_range = None
+        if rollup_range:
+            self.add_rollups(*rollup_range, sumd, processes, windows, active=False)
+            active_range = self.active_range(rollup_range) if self.need_activity and activity_range is None else None
+            if active_range:
+                self.add_rollups(*active_range, sumd, processes, windows, counts=False)
+
+        # the counts are computed by the database, grouped by process name and window title
+        for q, columns in ((keys_query, KEY_AGGREGATES), (clicks_query, CLICK_AGGREGATES)):
+            if q is not None and rollup_range:
+                q = q.copy().filter(f'({q.table}.created_at < ? OR {q.table}.created_at >= ?)', *rollup_range)
+            self.aggregate(q, columns, sumd, processes, windows)
+        # the other rows are only needed for their counts
+        for q in (keys_query, clicks_query):
+            if q is not None and (activity_range or active_range):
+                self.edge_events(q, activity_range or active_range)
+
+        # event times are collected per batch and merged into active periods once at the end,
+        # per process and window title with every time tagged by the number of its group
+        if self.need_activity or self.args['key_freqs']:
+            # numpy takes longer to import than the count queries take, so it is only loaded for event times and key codes
+            import numpy as np
+            from Base.intervals import group_merge, group_union, bucket_overlaps
+            from Base.period import Period
+        now = time.time()
+        activity = Period(self.need_activity, now) if self.need_activity else None
+        groups = {}
+        if self.need_process:
+            groups['process'] = ({}, [], processes)
+        if self.need_window:
+            groups['title'] = ({}, [], windows)
+        all_times = []
+
+        def tag(rows, times, per_row):
+            activity.extend(times)
+            all_times.append(times)
+            for column, (names, tags, _) in groups.items():
+                codes = np.array([names.setdefault(row[column], len(names)) for row in rows], dtype=np.int64)
+                tags.append(np.repeat(codes, per_row))
+
+        keys = Counter()
+        key_names = keycodec.load_key_names(self.conn) if self.args['key_freqs'] else None
+        if keys_query is not None and (self.need_activity or self.args['key_freqs']):
+            for batch in batches(self.filter_keys(keys_query, 'keys.keys, keys.timings, keys.created_at')):
+                if self.need_activity:
+                    intervals, offsets = keycodec.decode_timings_batch([row['timings'] for row in batch])
+                    created = keycodec.epoch_seconds([row['created_at'] for row in batch])
+                    tag(batch, keycodec.create_times_batch(created, intervals, offsets), np.diff(offsets) + 1)
+
+                if self.args['key_freqs']:
+                    codes, _ = keycodec.decode_batch([row['keys'] for row in batch])
+                    for code, count in enumerate(np.bincount(codes)):
+                        if count:
+                            keys[key_names[code]] += int(count)
+
+        if clicks_query is not None and self.need_activity:
+            for batch in batches(self.filter_clicks(clicks_query, 'click.created_at')):
+                tag(batch, keycodec.epoch_seconds([click['created_at'] for click in batch]), 1)
+
+        spans = self.add_activity(activity, groups, *activity_range) if activity_range else {}
+
+        if all_times or activity_range:
+            sumd['activity'] = activity
+            times = np.concatenate(all_times) if all_times else np.empty(0)
+            # the rollups already hold the active time inside their hours, unless the activity table answers
+            inner = [time.mktime(moment.timetuple()) for moment in active_range] if active_range else None
+            if inner:
+                starts, ends = activity.intervals.consolidate()
+                sumd['rollup_active'] = sumd.get('rollup_active', 0) - bucket_overlaps(starts, ends, inner).sum()
+            for column, (names, tags, target) in groups.items():
+                codes, starts, ends = group_merge(np.concatenate(tags) if tags else np.empty(0, dtype=np.int64),
+                                                  times, self.need_activity, now)
+                if column in spans:
+                    codes, starts, ends = group_union(*(np.concatenate(pair) for pair in zip((codes, starts, ends), spans[column])))
+                lengths = ends - starts
+                if inner:
+                    lengths -= bucket_overlaps(starts, ends, inner)[:, 0]
+                active = np.bincount(codes, weights=lengths, minlength=len(names))
+                for name, code in names.items():
+                    d = target.setdefault(name, {})
+                    d['active_time'] = d.get('active_time', 0) + float(active[code])
 
         self.processes = processes
         self.windows = windows
@@ -354,6 +631,130 @@ class Selfstats:
         if self.args['key_freqs']:
             self.summary['key_freqs'] = keys
 
+    def activity_range(self):
+        """ The part of the selected range whose active time the activity table gives like the
+            event rows would, up to its watermark after an update. None if the table cannot
+            answer this query: another cutoff, a filter on the key rows, a range given by id,
+            or one that reaches into the cold tier, whose rows are read raw. The first cutoff
+            of the range also holds time made active by earlier events, so it is left out. """
+        if (not self.need_activity or self.time_range is None or self.cold
+                or any(self.args[k] for k in ACTIVITY_RAW_ONLY)):
+            return None
+        materializer = ActivityMaterializer(self.db_name, self.conn, cutoff=self.need_activity)
+        if materializer.watermark() is None:
+            return None
+        materializer.update()
+        start, end = self.time_range
+        first = start + datetime.timedelta(seconds=self.need_activity) if start else EPOCH
+        last = min(end, materializer.watermark()) if end else materializer.watermark()
+        return (first, last) if first < last else None
+
+    def add_activity(self, activity, groups, start, end):
+        """ Adds the intervals of the activity table, clipped to [start, end), to the active
+            periods, and returns them per group as (codes, starts, ends). """
+        import numpy as np
+
+        q = Query('activity')
+        q.filter('activity.end_time > ?', start)
+        q.filter('activity.start_time < ?', end)
+        # the names were matched by keys_query() already
+        if self.args['process'] is not None:
+            q.filter('activity.process_id IN (SELECT id FROM temp.matched_process)')
+        if self.args['title'] is not None:
+            q.filter('activity.window_id IN (SELECT id FROM temp.matched_window)')
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(*q.sql('activity.start_time, activity.end_time')).fetchall()
+        if not rows:
+            return {}
+
+        starts = np.maximum(keycodec.epoch_seconds([row[0] for row in rows]), epoch(start))
+        ends = np.minimum(keycodec.epoch_seconds([row[1] for row in rows]), epoch(end))
+        activity.include(starts, ends)
+        spans = {}
+        for column, (names, _, _) in groups.items():
+            index = 2 if column == 'process' else 3
+            codes = np.array([names.setdefault(row[index], len(names)) for row in rows], dtype=np.int64)
+            spans[column] = (codes, starts, ends)
+        return spans
+
+    def rollup_range(self):
+        """ The whole hours of the selected range that the rollups can answer, or None. """
+        if self.time_range is None or any(self.args[k] for k in RAW_ONLY):
+            return None
+        if self.need_activity and self.need_activity != self.rollups.cutoff:
+            return None
+        self.rollups.update()
+        watermark = self.rollups.watermark()
+        if watermark is None:
+            return None
+        start, end = self.time_range
+        start = ceil_hour(start) if start else EPOCH
+        end = min(floor_hour(end), watermark) if end else watermark
+        if start >= end:
+            return None
+        return start, end
+
+    def active_range(self, rollup_range):
+        """ The hours of rollup_range whose active time the rollups give like the event rows would,
+            or None. A first hour that starts less than a cutoff after the selected range also
+            holds time made active by earlier events, so its time comes from the event rows. """
+        start = self.time_range[0]
+        first, end = rollup_range
+        if start and first - start < datetime.timedelta(seconds=self.need_activity):
+            first += HOUR
+        return (first, end) if first < end else None
+
+    def edge_events(self, q, inner):
+        """ Narrows q to the rows with events that can make time active outside inner, the
+            range whose active time is known already. The events of the other rows lie more
+            than a cutoff before its end, and the time they make active lies inside it. """
+        start, end = inner
+        first = 'keys.started' if q.table == 'keys' else 'click.created_at'
+        q.filter(f'({first} < ? OR {q.table}.created_at >= ?)',
+                 start, end - datetime.timedelta(seconds=self.need_activity))
+
+    def add_rollups(self, start, end, sumd, processes, windows, counts=True, active=True):
+        """ Adds the rollup counts of [start, end) unless counts is False, and the active time unless active is False. """
+        where, params = self.rollups.ranges(start, end)
+        sums = ', '.join(f'SUM(rollup.{column}) AS {column}' for column in COUNT_COLUMNS + ['active'])
+        rows = self.conn.execute(f"""
+            SELECT rollup.process_id, rollup.window_id, process.name AS process, window.title AS title, {sums}
+            FROM rollup
+            LEFT JOIN process ON process.id = rollup.process_id
+            LEFT JOIN window ON window.id = rollup.window_id
+            WHERE {where}
+            GROUP BY rollup.process_id, rollup.window_id
+            ORDER BY MIN(rollup.bucket)
+        """, params)
+        for row in rows:
+            if row['process_id'] and row['window_id'] and not counts:
+                continue  # only the active time is asked for
+            if not (row['process_id'] and row['window_id']) and not active:
+                continue  # the active time comes from elsewhere
+            if not row['process_id']:
+                if not row['window_id']:
+                    sumd['rollup_active'] = row['active']
+                elif self.need_window:
+                    d = windows.setdefault(row['title'], {})
+                    d['active_time'] = d.get('active_time', 0) + row['active']
+                continue
+            if not row['window_id']:
+                if self.need_process:
+                    d = processes.setdefault(row['process'], {})
+                    d['active_time'] = d.get('active_time', 0) + row['active']
+                continue
+
+            targets = [sumd]
+            if self.need_process:
+                targets.append(processes.setdefault(row['process'], {}))
+            if self.need_window:
+                targets.append(windows.setdefault(row['title'], {}))
+            for d in targets:
+                for column in COUNT_COLUMNS:
+                    if row[column]:
+                        d[column] = d.get(column, 0) + row[column]
+
     def show_summary(self):
         print(f"{self.summary.get('keystrokes', 0)} keystrokes in {self.summary.get('nr', 0)} key sequences,",
               f"{self.summary.get('clicks', 0)} clicks ({self.summary.get('noscroll_clicks', 0)} excluding scroll),",
@@ -367,6 +768,7 @@ class Selfstats:
                 act = act.calc_total()
             else:
                 act = 0
+            act += self.summary.get('rollup_active', 0)
             print(f'Total time active: {pretty_seconds(act)}')
             print()
 
@@ -399,8 +801,6 @@ class Selfstats:
             print()
         if self.args['pactive']:
             print('Processes sorted by activity:')
-            for p in self.processes.values():
-                p['active_time'] = int(p['activity'].calc_total())
             pdata = list(self.processes.items())
             pdata.sort(key=lambda x: x[1]['active_time'], reverse=True)
             for name, data in pdata:
@@ -409,8 +809,6 @@ class Selfstats:
 
         if self.args['tactive']:
             print('Window titles sorted by activity:')
-            for w in self.windows.values():
-                w['active_time'] = int(w['activity'].calc_total())
             wdata = list(self.windows.items())
             wdata.sort(key=lambda x: x[1]['active_time'], reverse=True)
             for name, data in wdata:
@@ -478,6 +876,7 @@ def parse_config():
     parser.add_argument('-T', '--title', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the window title matches something. All regular expressions are case insensitive.')
     parser.add_argument('-P', '--process', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the process matches something.')
     parser.add_argument('-B', '--body', type=str, metavar='regexp', help='Only allow entries where a search for this <regexp> in the body matches something. Do not use this filter when summarizing ratios or activity, as it has no effect on mouse clicks. Requires password.')
+    parser.add_argument('-S', '--search', type=str, metavar='query', help='Only allow entries whose body matches this full-text <query>: "quoted phrases" and words of at least three characters, combined with AND, OR and NOT. Matching is case insensitive and finds substrings. Like --body, it has no effect on mouse clicks.')
 
     parser.add_argument('--clicks', action='store_true', help='Summarize number of mouse button clicks for all buttons.')
 
@@ -496,20 +895,39 @@ def parse_config():
     parser.add_argument('--pkeys', action='store_true', help='List processes sorted by number of keystrokes.')
     parser.add_argument('--tkeys', action='store_true', help='List window titles sorted by number of keystrokes.')
 
+    parser.add_argument('--recall', type=str, metavar='query', help='List the stretches of typing, with their window titles, that are closest in meaning to <query>, best match first. Other filters do not apply.')
+    parser.add_argument('--recall-top', type=int, metavar='nr', default=cfg.RECALL_TOP, help='How many matches --recall lists. Default is %d.' % cfg.RECALL_TOP)
+
+    parser.add_argument('--startup-profile', action='store_true', help='After the output, print to stderr how long the imports, opening the database and the query took.')
+
     return parser.parse_args()
 
 
 def main():
+    profile = StartupProfile()
     try:
         args = vars(parse_config())
     except EnvironmentError as e:
         print(str(e))
         sys.exit(1)
+    if args['startup_profile']:
+        profile.watch_imports()
+    profile.phase('arguments')
 
     args['data_dir'] = os.path.expanduser(args['data_dir'])
-    ss = Selfstats(os.path.join(args['data_dir'], models.DBNAME), args)
+    ss = Selfstats(os.path.join(args['data_dir'], cfg.DBNAME), args)
+    profile.phase('open database')
 
-    ss.do()
+    try:
+        ss.do()
+        profile.phase('query and output')
+        if args['startup_profile']:
+            sys.stdout.flush()
+            profile.report()
+    except BrokenPipeError:
+        # the reader went away, e.g. a listing piped to head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,167 @@
+import os
+import sys
+import glob
+import json
+import datetime
+
+from Base import config as cfg
+from Base import models
+
+# event tables that move to the cold tier, with the column they are partitioned by
+TIERED_TABLES = [('keys', 'created_at'),
+                 ('click', 'created_at'),
+                 ('activity', 'start_time')]
+
+MANIFEST = 'compact.json'  # the merge in progress in a partition
+
+
+def parquet_root(db_name):
+    return os.path.join(os.path.dirname(models.database_path(db_name)), cfg.PARQUET_DIR)
+
+
+def partition_dir(root, table, day):
+    return os.path.join(root, table, f'date={day.isoformat()}')
+
+
+def partition_files(root, table):
+    return sorted(glob.glob(os.path.join(root, table, 'date=*', '*.parquet')))
+
+
+def partition_days(root, table):
+    """ The days that have a partition with at least one part file. """
+    return sorted({datetime.date.fromisoformat(os.path.basename(os.path.dirname(path))[len('date='):])
+                   for path in partition_files(root, table)})
+
+
+class ColdTier:
+    """ Moves closed days of event rows out of the SQLite hot tier.
+        Every day older than keep_days is written, sorted by time and zstd compressed, to
+        <root>/<table>/date=YYYY-MM-DD/ and then deleted from SQLite, so the hot database
+        only holds recent rows. Part files are named after the row ids they hold, which
+        makes a rollover that was interrupted between the write and the delete safe to
+        run again. compact() merges the small parts of a partition into one file, see
+        finish_merge() for how it survives a crash. """
+
+    def __init__(self, db_name, root=None, keep_days=cfg.HOT_DAYS, interval=cfg.ROLLOVER_INTERVAL):
+        self.sqlite_file = models.database_path(db_name)
+        self.db_name = db_name
+        self.root = root or parquet_root(db_name)
+        self.keep_days = keep_days
+        self.interval = interval  # seconds between two step() calls in the daemon
+
+    def connect(self):
+        import duckdb
+
+        con = duckdb.connect()
+        con.execute("INSTALL sqlite;")
+        con.execute("LOAD sqlite;")
+        con.execute(f"ATTACH DATABASE '{self.sqlite_file}' AS sqlite (TYPE sqlite, READ_ONLY);")
+        return con
+
+    def rollover(self, today=None):
+        """ Moves every closed day before today - keep_days to Parquet. Returns the written files. """
+        today = today or datetime.date.today()
+        cutoff = today - datetime.timedelta(days=self.keep_days)
+        written = []
+        duck = self.connect()
+        hot = models.initialize(self.db_name)
+        try:
+            for table, column in TIERED_TABLES:
+                days = duck.execute(f"""
+                    SELECT DISTINCT CAST({column} AS DATE) AS day FROM sqlite.{table}
+                    WHERE {column} < ? ORDER BY day
+                """, [cutoff]).fetchall()
+                for (day,) in days:
+                    written.append(self.move_day(duck, hot, table, column, day))
+        finally:
+            duck.close()
+            hot.close()
+        return [path for path in written if path]
+
+    def move_day(self, duck, hot, table, column, day):
+        start = datetime.datetime.combine(day, datetime.time())
+        end = start + datetime.timedelta(days=1)
+        first, last = hot.execute(f"SELECT MIN(id), MAX(id) FROM {table} WHERE {column} >= ? AND {column} < ?",
+                                  (start, end)).fetchone()
+        if first is None:
+            return None
+
+        directory = partition_dir(self.root, table, day)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'part-{first:012d}-{last:012d}.parquet')
+        tmp = path + '.tmp'
+        duck.execute(f"""
+            COPY (SELECT * FROM sqlite.{table}
+                  WHERE {column} >= ? AND {column} < ? AND id BETWEEN ? AND ?
+                  ORDER BY {column})
+            TO '{tmp}' (FORMAT 'parquet', COMPRESSION 'zstd');
+        """, [start, end, first, last])
+        os.replace(tmp, path)
+
+        with hot:
+            hot.execute(f"DELETE FROM {table} WHERE {column} >= ? AND {column} < ? AND id BETWEEN ? AND ?",
+                        (start, end, first, last))
+        return path
+
+    @staticmethod
+    def finish_merge(directory):
+        """ Completes or undoes a merge that was interrupted. A merge writes the merged file
+            under a temporary name, then the manifest naming it and its sources, deletes the
+            sources and only then gives the merged file its name, so a source is never read
+            twice. Once the manifest exists the merge is carried through, before that the
+            temporary file is dropped. """
+        manifest = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                merge = json.load(f)
+            for name in merge['sources']:
+                if name != merge['merged'] and os.path.exists(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+            tmp = os.path.join(directory, merge['merged'] + '.tmp')
+            if os.path.exists(tmp):
+                os.replace(tmp, os.path.join(directory, merge['merged']))
+            os.remove(manifest)
+        for tmp in glob.glob(os.path.join(directory, 'part-*.parquet.tmp')):
+            os.remove(tmp)
+
+    def compact(self, min_size=cfg.COMPACT_MIN_SIZE):
+        """ Merges partitions that consist of several part files smaller than min_size bytes. """
+        import duckdb
+
+        duck = duckdb.connect()
+        try:
+            for table, column in TIERED_TABLES:
+                for directory in sorted(glob.glob(os.path.join(self.root, table, 'date=*'))):
+                    self.finish_merge(directory)
+                    parts = sorted(glob.glob(os.path.join(directory, 'part-*.parquet')))
+                    small = [p for p in parts if os.path.getsize(p) < min_size]
+                    if len(small) < 2:
+                        continue
+                    first = os.path.basename(small[0]).split('-')[1]
+                    last = os.path.basename(small[-1]).split('-')[2].split('.')[0]
+                    path = os.path.join(directory, f'part-{first}-{last}.parquet')
+                    tmp = path + '.tmp'
+                    files = ', '.join(f"'{p}'" for p in small)
+                    duck.execute(f"""
+                        COPY (SELECT * FROM read_parquet([{files}]) ORDER BY {column})
+                        TO '{tmp}' (FORMAT 'parquet', COMPRESSION 'zstd');
+                    """)
+                    manifest = os.path.join(directory, MANIFEST)
+                    with open(manifest + '.tmp', 'w') as f:
+                        json.dump({'merged': os.path.basename(path), 'sources': [os.path.basename(p) for p in small]}, f)
+                    os.replace(manifest + '.tmp', manifest)
+                    self.finish_merge(directory)
+        finally:
+            duck.close()
+
+    def step(self):
+        """ One round of housekeeping: rollover, then compaction. """
+        import duckdb
+
+        try:
+            if self.rollover():
+                from Base.catalog import refresh_catalogs
+                refresh_catalogs(self.db_name)
+            self.compact()
+        except duckdb.Error as e:
+            print(f'Could not move old rows to {self.root}: {e}', file=sys.stderr)
@@ -0,0 +1,104 @@
+import math
+from array import array
+
+from Base import config as cfg
+
+
+class Trajectory:
+    """ Buffers the mouse path between two clicks in a fixed-size array('h') ring.
+        Points are simplified as they arrive: a point closer than min_distance to the
+        previous one is skipped, and a point is only kept as a vertex if the path turns by
+        more than min_angle radians there. When the ring is full the oldest points are
+        overwritten, so memory stays bounded however long the mouse moves without a click. """
+
+    def __init__(self, capacity=cfg.TRAJECTORY_CAPACITY, min_distance=cfg.TRAJECTORY_MIN_DISTANCE,
+                 min_angle=cfg.TRAJECTORY_MIN_ANGLE):
+        self.capacity = capacity
+        self.min_distance = min_distance
+        self.min_angle = min_angle
+        self.points = array('h', bytes(4 * capacity))  # x, y pairs
+        self.reset()
+
+    def reset(self):
+        self.start = 0
+        self.count = 0
+        self.moves = 0
+        self.pending = None
+        self.last = None
+
+    def keep(self, x, y):
+        pos = 2 * ((self.start + self.count) % self.capacity)
+        self.points[pos] = x
+        self.points[pos + 1] = y
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+        self.last = (x, y)
+
+    def add(self, x, y):
+        self.moves += 1
+        if self.last is None:
+            self.keep(x, y)
+            return
+        ref = self.pending or self.last
+        if math.hypot(x - ref[0], y - ref[1]) < self.min_distance:
+            return
+        if self.pending is None:
+            self.pending = (x, y)
+            return
+
+        (lx, ly), (px, py) = self.last, self.pending
+        turn = abs(math.atan2(y - py, x - px) - math.atan2(py - ly, px - lx))
+        turn = min(turn, 2 * math.pi - turn)
+        if turn > self.min_angle:
+            self.keep(px, py)
+        # otherwise the path goes on in the same direction and the segment just gets longer
+        self.pending = (x, y)
+
+    def finish(self, x, y):
+        """ Ends the path at the click position. """
+        if self.pending is not None:
+            self.keep(*self.pending)
+            self.pending = None
+        if self.last != (x, y):
+            self.keep(x, y)
+
+    def state(self):
+        return {'points': list(self.coordinates()), 'moves': self.moves, 'pending': self.pending, 'last': self.last}
+
+    def restore(self, state):
+        self.reset()
+        for x, y in state['points']:
+            self.keep(x, y)
+        self.moves = state['moves']
+        self.pending = tuple(state['pending']) if state['pending'] else None
+        self.last = tuple(state['last']) if state['last'] else None
+
+    def coordinates(self):
+        for i in range(self.count):
+            pos = 2 * ((self.start + i) % self.capacity)
+            yield self.points[pos], self.points[pos + 1]
+
+    def to_blob(self):
+        """ The first point as is, then deltas to the previous point, as int16 pairs. """
+        out = array('h')
+        px, py = 0, 0
+        for x, y in self.coordinates():
+            out.append(x - px)
+            out.append(y - py)
+            px, py = x, y
+        return out.tobytes()
+
+
+def decode_path(blob):
+    """ Returns the (x, y) points of a path stored by Trajectory.to_blob. """
+    deltas = array('h')
+    deltas.frombytes(blob or b'')
+    points = []
+    x, y = 0, 0
+    for i in range(0, len(deltas), 2):
+        x += deltas[i]
+        y += deltas[i + 1]
+        points.append((x, y))
+    return points
@@ -0,0 +1,112 @@
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# dimension tables with a text column that -P/-T filter on
+SOURCES = {'process': 'name', 'window': 'title'}
+
+INDEX_BATCH = 10000
+
+
+def trigrams(text):
+    """ The distinct lower case three character substrings of text. """
+    text = (text or '').lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def literal_runs(items, runs, run):
+    """ Collects the runs of ASCII characters every match of a parsed pattern must contain. """
+    for op, arg in items:
+        if op is sre_parse.LITERAL and arg < 128:
+            run.append(chr(arg))
+        elif op is sre_parse.SUBPATTERN:
+            run = literal_runs(arg[-1], runs, run)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and arg[0] >= 1 \
+                and len(arg[2]) == 1 and arg[2][0][0] is sre_parse.LITERAL and arg[2][0][1] < 128:
+            run.extend(chr(arg[2][0][1]) * arg[0])
+            if arg[1] != arg[0]:
+                runs.append(''.join(run))
+                run = []
+        else:
+            runs.append(''.join(run))
+            run = []
+    return run
+
+
+def required_literals(pattern):
+    """ The runs of ASCII characters that any text matched case insensitively by pattern contains. """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return []
+    runs = []
+    runs.append(''.join(literal_runs(list(parsed), runs, [])))
+    return [run for run in runs if run]
+
+
+def required_trigrams(pattern):
+    """ Trigrams that any text matched case insensitively by pattern contains.
+        An empty set means the pattern gives no usable literal and everything is a candidate. """
+    grams = set()
+    for run in required_literals(pattern):
+        grams |= trigrams(run)
+    return grams
+
+
+def fts_query(pattern):
+    """ An FTS5 trigram query for the rows that can match pattern, or None if there is no usable literal. """
+    phrases = ['"' + run.replace('"', '""') + '"' for run in required_literals(pattern) if len(run) >= 3]
+    return ' AND '.join(phrases) or None
+
+
+class TrigramIndex:
+    """ A persistent trigram index over process names and window titles.
+        Rows are indexed in id order from a per table watermark, so update() only looks at
+        rows added since the last call and is cheap to run after every insert. Lookups
+        narrow a regular expression to the rows containing all its literal trigrams, and
+        the exact, case insensitive match is then checked with SQLite's REGEXP on those
+        candidates only. """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def update(self, table=None):
+        for name in [table] if table else SOURCES:
+            column = SOURCES[name]
+            row = self.conn.execute("SELECT last_id FROM trigram_state WHERE kind = ?", (name,)).fetchone()
+            last_id = row[0] if row else 0
+            while True:
+                rows = self.conn.execute(f"SELECT id, {column} FROM {name} WHERE id > ? ORDER BY id LIMIT ?",
+                                         (last_id, INDEX_BATCH)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                with self.conn:
+                    self.conn.executemany("INSERT OR IGNORE INTO trigram (kind, gram, ref_id) VALUES (?, ?, ?)",
+                                          ((name, gram, row_id) for row_id, text in rows for gram in trigrams(text)))
+                    self.conn.execute("INSERT INTO trigram_state (kind, last_id) VALUES (?, ?) "
+                                      "ON CONFLICT (kind) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                                      (name, last_id))
+
+    def match(self, table, pattern, target):
+        """ Fills the temp table target with the ids of rows in table whose text matches pattern.
+            Returns the number of matches. REGEXP must be registered on the connection. """
+        column = SOURCES[table]
+        self.update(table)
+        self.conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {target} (id INTEGER PRIMARY KEY)")
+        self.conn.execute(f"DELETE FROM temp.{target}")
+
+        grams = sorted(required_trigrams(pattern))
+        if grams:
+            candidates = f"""id IN (SELECT ref_id FROM trigram WHERE kind = ? AND gram IN ({','.join('?' * len(grams))})
+                                    GROUP BY ref_id HAVING COUNT(*) = ?) AND"""
+            params = [table] + grams + [len(grams)]
+        else:
+            candidates = ''
+            params = []
+        cursor = self.conn.execute(f"""
+            INSERT INTO temp.{target} (id)
+            SELECT id FROM {table} WHERE {candidates} {column} REGEXP ?
+        """, params + [pattern])
+        return cursor.rowcount
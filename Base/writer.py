@@ -0,0 +1,173 @@
+import sys
+import time
+import queue
+import sqlite3
+import threading
+from collections import deque
+
+from Base import config as cfg
+from Base import metrics
+from Base import models
+
+FLUSH = object()
+STOP = object()
+
+LATENCY_SAMPLES = 10000  # recent commit durations kept for reporting
+
+
+class FlushRequest:
+    def __init__(self):
+        self.done = threading.Event()
+        self.committed = False
+
+
+class BatchWriter:
+    """ Write-behind persistence for event rows.
+        put() only queues a statement. A writer thread with its own connection groups
+        queued rows into one transaction when batch_size rows are waiting or
+        flush_interval seconds have passed, whichever comes first, so many clicks and
+        key sequences share a single fsync. With batch_size and flush_interval None rows are
+        only committed by flush(), so the caller decides the transactions. A busy database is retried a bounded number
+        of times with exponential backoff, and rows that still fail are kept for the
+        next batch instead of being dropped. A row the database refuses, say one that breaks
+        a constraint, would fail its batch every time, so such a batch is written row by row
+        and the refused rows are dropped and counted. """
+
+    def __init__(self, db_name, batch_size=cfg.WRITE_BATCH_SIZE, flush_interval=cfg.WRITE_FLUSH_INTERVAL,
+                 retries=cfg.WRITE_RETRIES, max_queued=cfg.WRITE_MAX_QUEUED):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.pending = []
+        metrics.gauge('writer.queue', self.queue.qsize)
+        metrics.gauge('writer.pending', lambda: len(self.pending))
+
+        self.commits = 0
+        self.rows = 0
+        self.retried = 0
+        self.failures = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+        self.thread = threading.Thread(target=self.run, name='writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, sql, params):
+        """ Queues one row. Blocks only if max_queued rows are already waiting. """
+        self.queue.put((sql, params))
+
+    def flush(self, timeout=None):
+        """ Waits until everything queued before this call is committed. Returns False if the
+            commit failed or did not happen within timeout seconds. """
+        request = FlushRequest()
+        self.queue.put((FLUSH, request))
+        return request.done.wait(timeout) and request.committed
+
+    def run(self):
+        self.conn = models.initialize(self.db_name)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        stopping = False
+        while not stopping:
+            waiters = []
+            deadline = time.time() + self.flush_interval if self.flush_interval is not None else None
+            # rows left over from a failed commit: take what is queued without waiting, so a
+            # flush or stop is still seen while the database keeps failing
+            backlog = self.batch_size is not None and len(self.pending) >= self.batch_size
+            while backlog or self.batch_size is None or len(self.pending) < self.batch_size:
+                try:
+                    if backlog:
+                        item = self.queue.get_nowait()
+                    else:
+                        item = self.queue.get(timeout=max(0.0, deadline - time.time()) if deadline is not None else None)
+                except queue.Empty:
+                    break
+                if item is STOP:
+                    stopping = True
+                    break
+                if item[0] is FLUSH:
+                    waiters.append(item[1])
+                    break
+                self.pending.append(item)
+
+            committed = self.commit() if self.pending else True
+            for request in waiters:
+                request.committed = committed
+                request.done.set()
+        if self.pending:
+            print(f'Could not write {len(self.pending)} rows before stopping, they are lost', file=sys.stderr)
+        self.conn.close()
+
+    def commit(self):
+        batch = self.pending
+        started = time.perf_counter()
+        by_row = False
+        attempt = 0
+        while attempt < self.retries:
+            try:
+                with self.conn:
+                    dropped = self.execute_rows(batch) if by_row else self.execute_batch(batch)
+            except sqlite3.OperationalError as e:
+                self.retried += 1
+                metrics.count('writer.retries')
+                time.sleep(min(cfg.WRITE_MAX_BACKOFF, cfg.WRITE_BACKOFF * 2 ** attempt))
+                attempt += 1
+                error = e
+                continue
+            except sqlite3.Error as e:
+                # a refused row, it is found by writing the batch row by row
+                if by_row:
+                    attempt += 1
+                by_row = True
+                error = e
+                continue
+            self.commits += 1
+            self.rows += len(batch) - dropped
+            self.latencies.append(time.perf_counter() - started)
+            metrics.observe('writer.commit', self.latencies[-1])
+            metrics.count('writer.commits')
+            metrics.count('writer.rows', len(batch) - dropped)
+            self.pending = []
+            return True
+
+        self.failures += 1
+        metrics.count('writer.failures')
+        print(f'Could not write {len(batch)} rows, will try again with the next batch: {error}', file=sys.stderr)
+        return False
+
+    def execute_batch(self, batch):
+        start = 0
+        while start < len(batch):
+            # consecutive rows for the same statement go in one executemany
+            sql = batch[start][0]
+            end = start
+            while end < len(batch) and batch[end][0] == sql:
+                end += 1
+            self.conn.executemany(sql, [params for _, params in batch[start:end]])
+            start = end
+        return 0
+
+    def execute_rows(self, batch):
+        """ Executes the rows one by one and drops those the database refuses. Returns how many it dropped. """
+        dropped = 0
+        for sql, params in batch:
+            try:
+                self.conn.execute(sql, params)
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.Error as e:
+                dropped += 1
+                print(f'Dropping a row the database refuses: {e}', file=sys.stderr)
+        self.dropped += dropped
+        metrics.count('writer.dropped', dropped)
+        return dropped
+
+    def close(self):
+        """ Commits everything that is queued and stops the writer thread. """
+        self.queue.put(STOP)
+        if self.thread.is_alive():
+            self.thread.join()